@@ -14,6 +14,7 @@ from pathlib import Path
 import os
 import logging
 from decouple import config
+from django.core.exceptions import ImproperlyConfigured
 
 # Load environment variables from .env file
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -93,6 +94,9 @@ CORS_ALLOW_HEADERS = [
 ]
 
 # Logging configuration
+# the error log below goes to logs/, which is not in the repository
+os.makedirs(os.path.join(BASE_DIR, 'logs'), exist_ok=True)
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -294,6 +298,165 @@ CELERY_TIMEZONE = 'Asia/Riyadh'
 CELERY_BEAT_SCHEDULE = {
     "merge-pilgrims-every-second": {
         "task": "pilgrims.tasks.merge_pilgrims_every_second",
-        "schedule": 100.0,
+        "schedule": 1.0,
+    }
+}
+
+# INGESTION PIPELINE
+# Redis shared by all workers for ingestion state (device registry, ...)
+PILGRIMS_REDIS_URL = config("PILGRIMS_REDIS_URL", default="redis://localhost:6379/1")
+
+# Seconds a worker keeps a resolved device locally / between generation checks
+DEVICE_REGISTRY_LOCAL_TTL = config("DEVICE_REGISTRY_LOCAL_TTL", default=300, cast=int)
+DEVICE_REGISTRY_CHECK_INTERVAL = config("DEVICE_REGISTRY_CHECK_INTERVAL", default=1, cast=float)
+# Seconds the shared Redis hash lives / an unknown serial number is remembered,
+# and how many serials a worker keeps before dropping the unknown ones
+DEVICE_REGISTRY_REDIS_TTL = config("DEVICE_REGISTRY_REDIS_TTL", default=3600, cast=int)
+DEVICE_REGISTRY_MISS_TTL = config("DEVICE_REGISTRY_MISS_TTL", default=30, cast=int)
+DEVICE_REGISTRY_LOCAL_MAX = config("DEVICE_REGISTRY_LOCAL_MAX", default=50000, cast=int)
+
+# "direct" writes every reading in the request; "buffered" only validates it,
+# pushes it onto PILGRIMS_BUFFER_STREAM and answers 202 (see pilgrims/ingestion_buffer.py)
+PILGRIMS_INGESTION_MODE = config("PILGRIMS_INGESTION_MODE", default="direct")
+PILGRIMS_BUFFER_BACKEND = config("PILGRIMS_BUFFER_BACKEND", default="redis")  # "redis" or "local"
+PILGRIMS_BUFFER_STREAM = config("PILGRIMS_BUFFER_STREAM", default="pilgrims:ingest")
+PILGRIMS_BUFFER_BATCH_SIZE = config("PILGRIMS_BUFFER_BATCH_SIZE", default=500, cast=int)
+PILGRIMS_BUFFER_MAX_LAG_MS = config("PILGRIMS_BUFFER_MAX_LAG_MS", default=200, cast=int)
+PILGRIMS_BUFFER_CLAIM_IDLE_MS = config("PILGRIMS_BUFFER_CLAIM_IDLE_MS", default=30000, cast=int)
+
+# Seconds a stored reading_id is remembered in Redis to answer retries without the DB
+PILGRIMS_SEEN_TTL = config("PILGRIMS_SEEN_TTL", default=300, cast=int)
+
+# Per-device limits for the single-reading endpoints (pilgrims/rate_limit.py).
+# "rate" readings/second per serial number with bursts of "burst" (rate 0 disables);
+# over the limit a reading is "reject"ed (429), "drop"ped or "coalesce"d into
+# the latest reading of its second.
+PILGRIMS_RATE_LIMITS = {
+    "camera": {
+        "rate": config("PILGRIMS_CAMERA_RATE", default=2.0, cast=float),
+        "burst": config("PILGRIMS_CAMERA_BURST", default=5, cast=int),
+        "policy": config("PILGRIMS_CAMERA_RATE_POLICY", default="coalesce"),
+    },
+    "rfid": {
+        "rate": config("PILGRIMS_RFID_RATE", default=5.0, cast=float),
+        "burst": config("PILGRIMS_RFID_BURST", default=10, cast=int),
+        "policy": config("PILGRIMS_RFID_RATE_POLICY", default="reject"),
+    },
+}
+PILGRIMS_RATE_LIMIT_BACKEND = config("PILGRIMS_RATE_LIMIT_BACKEND", default="redis")  # "redis" or "local"
+# coalesced readings wait in Redis for the flush task, which runs in another process
+if PILGRIMS_RATE_LIMIT_BACKEND != "redis" and any(
+        limit["policy"] == "coalesce" for limit in PILGRIMS_RATE_LIMITS.values()):
+    raise ImproperlyConfigured('The "coalesce" rate limit policy needs PILGRIMS_RATE_LIMIT_BACKEND = "redis"')
+
+CELERY_BEAT_SCHEDULE["flush-coalesced-readings"] = {
+    "task": "pilgrims.tasks.flush_coalesced_readings",
+    "schedule": 1.0,
+}
+
+# Largest camera frame accepted by the streaming upload handler (pilgrims/uploads.py)
+PILGRIMS_MAX_FRAME_BYTES = config("PILGRIMS_MAX_FRAME_BYTES", default=5 * 1024 * 1024, cast=int)
+# Largest binary RFID body (pilgrims/rfid_frames.py) accepted, after inflating
+PILGRIMS_RFID_FRAMES_MAX_BYTES = config("PILGRIMS_RFID_FRAMES_MAX_BYTES", default=8 * 1024 * 1024, cast=int)
+
+# Pilgrim merge (pilgrims/tasks.py): seconds are merged once they are GRACE
+# seconds old, merged again at RECHECK seconds for late readings, and an
+# outage is caught up CHUNK seconds per statement
+PILGRIMS_MERGE_GRACE_SECONDS = config("PILGRIMS_MERGE_GRACE_SECONDS", default=5, cast=int)
+PILGRIMS_MERGE_RECHECK_SECONDS = config("PILGRIMS_MERGE_RECHECK_SECONDS", default=600, cast=int)
+PILGRIMS_MERGE_CHUNK_SECONDS = config("PILGRIMS_MERGE_CHUNK_SECONDS", default=300, cast=int)
+# Pair a camera reading with the nearest RFID reading of its office up to this
+# many seconds away (pilgrims/matching.py); 0 pairs equal seconds only
+PILGRIMS_MATCH_TOLERANCE_SECONDS = config("PILGRIMS_MATCH_TOLERANCE_SECONDS", default=0, cast=int)
+
+# Merge shards (pilgrims/tasks.py): offices are split by office_id % SHARDS
+# and beat sends one merge task per shard, so up to SHARDS workers merge at
+# once; each shard is held by one worker at a time through a Postgres lease
+PILGRIMS_MERGE_SHARDS = config("PILGRIMS_MERGE_SHARDS", default=1, cast=int)
+
+# "merge": the beat task above pairs camera and RFID readings from the tables;
+# "stream": the ingestion consumer pairs them as it writes them (needs
+# PILGRIMS_INGESTION_MODE = buffered, see pilgrims/stream_join.py)
+PILGRIMS_JOIN_MODE = config("PILGRIMS_JOIN_MODE", default="merge")
+PILGRIMS_JOIN_WINDOW_SECONDS = config("PILGRIMS_JOIN_WINDOW_SECONDS", default=60, cast=int)
+PILGRIMS_JOIN_TIMEOUT_SECONDS = config("PILGRIMS_JOIN_TIMEOUT_SECONDS", default=5, cast=float)
+
+# The stream joiner pairs equal seconds only: with a match tolerance the merge
+# task keeps running, re-check pass only, to pair the rows within it
+stream_join = PILGRIMS_JOIN_MODE == "stream" and PILGRIMS_INGESTION_MODE == "buffered"
+merge_entry = CELERY_BEAT_SCHEDULE.pop("merge-pilgrims-every-second")
+if not stream_join or PILGRIMS_MATCH_TOLERANCE_SECONDS:
+    merge_kwargs = {"recheck_only": True} if stream_join else {}
+    if PILGRIMS_MERGE_SHARDS > 1:
+        for shard in range(PILGRIMS_MERGE_SHARDS):
+            CELERY_BEAT_SCHEDULE[f"merge-pilgrims-every-second-{shard}"] = {
+                **merge_entry, "kwargs": {**merge_kwargs, "shard": shard},
+            }
+    else:
+        CELERY_BEAT_SCHEDULE["merge-pilgrims-every-second"] = {**merge_entry, "kwargs": merge_kwargs}
+
+# Daily partitions of the counter and Pilgrim tables (pilgrims/partitions.py):
+# created PREMAKE days ahead; with RETENTION > 0, partitions older than that
+# many days are detached, or dropped with EXPIRED_ACTION = drop
+PILGRIMS_PARTITION_PREMAKE_DAYS = config("PILGRIMS_PARTITION_PREMAKE_DAYS", default=7, cast=int)
+PILGRIMS_PARTITION_RETENTION_DAYS = config("PILGRIMS_PARTITION_RETENTION_DAYS", default=0, cast=int)
+PILGRIMS_PARTITION_EXPIRED_ACTION = config("PILGRIMS_PARTITION_EXPIRED_ACTION", default="detach")
+
+CELERY_BEAT_SCHEDULE["manage-partitions"] = {
+    "task": "pilgrims.tasks.manage_partitions",
+    "schedule": 3600.0,
+}
+
+# Counter history older than ROLLUP_AFTER days (0 keeps it raw) is compacted
+# into per-minute CounterRollup rows and deleted (pilgrims/rollups.py), one
+# transaction per CHUNK minutes
+PILGRIMS_ROLLUP_AFTER_DAYS = config("PILGRIMS_ROLLUP_AFTER_DAYS", default=0, cast=int)
+PILGRIMS_ROLLUP_CHUNK_MINUTES = config("PILGRIMS_ROLLUP_CHUNK_MINUTES", default=10, cast=int)
+
+if PILGRIMS_ROLLUP_AFTER_DAYS:
+    CELERY_BEAT_SCHEDULE["compact-counter-history"] = {
+        "task": "pilgrims.tasks.compact_counter_history",
+        "schedule": 60.0,
     }
+
+# Most points per tent a chart series returns (office/dashboard/series/); a
+# longer range is answered at a coarser interval
+PILGRIMS_SERIES_MAX_POINTS = config("PILGRIMS_SERIES_MAX_POINTS", default=1440, cast=int)
+
+# Live dashboard payloads cached in Redis per visible tent set until the merge
+# writes new rows for the company's tents (pilgrims/dashboard_cache.py); TTL 0
+# turns the cache off, WAIT_MS is how long a request waits for another one
+# computing the payload
+PILGRIMS_DASHBOARD_CACHE_TTL = config("PILGRIMS_DASHBOARD_CACHE_TTL", default=30, cast=int)
+PILGRIMS_DASHBOARD_CACHE_WAIT_MS = config("PILGRIMS_DASHBOARD_CACHE_WAIT_MS", default=2000, cast=int)
+
+# Live dashboard streams (office/async_views.py): a keepalive comment every
+# KEEPALIVE seconds, streams end after MAX seconds and browsers reconnect after
+# RETRY_MS; QUEUE is how many change messages a slow stream may fall behind
+PILGRIMS_DASHBOARD_EVENTS_KEEPALIVE_SECONDS = config("PILGRIMS_DASHBOARD_EVENTS_KEEPALIVE_SECONDS", default=15, cast=int)
+PILGRIMS_DASHBOARD_EVENTS_MAX_SECONDS = config("PILGRIMS_DASHBOARD_EVENTS_MAX_SECONDS", default=600, cast=int)
+PILGRIMS_DASHBOARD_EVENTS_RETRY_MS = config("PILGRIMS_DASHBOARD_EVENTS_RETRY_MS", default=3000, cast=int)
+PILGRIMS_DASHBOARD_EVENTS_QUEUE = config("PILGRIMS_DASHBOARD_EVENTS_QUEUE", default=100, cast=int)
+# Lifetime of the tokens that open a stream from `?token=` (browsers'
+# EventSource cannot send headers); short, as URLs end up in access logs
+PILGRIMS_DASHBOARD_STREAM_TOKEN_SECONDS = config("PILGRIMS_DASHBOARD_STREAM_TOKEN_SECONDS", default=60, cast=int)
+
+# Media GC (pilgrims/media_gc.py): frame files no CameraCounter or Pilgrim row
+# points at are deleted once untouched for GRACE seconds
+PILGRIMS_MEDIA_GC_GRACE_SECONDS = config("PILGRIMS_MEDIA_GC_GRACE_SECONDS", default=3600, cast=int)
+PILGRIMS_MEDIA_GC_BATCH = config("PILGRIMS_MEDIA_GC_BATCH", default=500, cast=int)
+
+CELERY_BEAT_SCHEDULE["collect-media-garbage"] = {
+    "task": "pilgrims.tasks.collect_media_garbage",
+    "schedule": 3600.0,
 }
+
+# Concurrent ORM calls per ASGI process for the async ingestion views
+PILGRIMS_ASYNC_DB_CONCURRENCY = config("PILGRIMS_ASYNC_DB_CONCURRENCY", default=20, cast=int)
+
+if PILGRIMS_INGESTION_MODE == "buffered":
+    # alternatively run `manage.py run_ingestion_consumer` processes
+    CELERY_BEAT_SCHEDULE["drain-ingestion-buffer"] = {
+        "task": "pilgrims.tasks.drain_ingestion_buffer",
+        "schedule": 1.0,
+    }
@@ -0,0 +1,162 @@
+"""
+Live dashboard stream for the ASGI deployment (`uvicorn main.asgi:application`).
+
+    GET /office/dashboard/events/?tent_list=1,2
+
+answers with a text/event-stream instead of being polled. The first
+`snapshot` event holds the rows the live `office/dashboard/` would return
+for the tents the user may see (the same `visible_offices()` rules). After
+that, each `delta` event holds only the tents whose illegal count, people
+count or indicator changed. The changes come from the merge pipeline over
+Redis pub/sub (pilgrims/dashboard_events.py), so a quiet tent costs nothing
+however many screens watch it.
+
+Browsers' EventSource cannot send headers. Besides a session cookie or an
+`Authorization: Bearer` header, a stream token may be passed as `?token=`:
+
+    POST /office/dashboard/events/token/  ->  {"token": ..., "expires_in": 60}
+
+A stream token opens streams and nothing else, and only for
+PILGRIMS_DASHBOARD_STREAM_TOKEN_SECONDS, so one left in a proxy or access
+log is of no use. Access tokens are refused in the query string. Django 4.2
+does not notice a client going away mid-stream, so a stream ends after
+PILGRIMS_DASHBOARD_EVENTS_MAX_SECONDS and EventSource reconnects (getting a
+fresh snapshot); once its token has expired the page asks for a new one.
+"""
+import asyncio
+import json
+import time
+from datetime import timedelta
+
+import redis
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponseNotAllowed, JsonResponse, StreamingHttpResponse
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework.views import APIView
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework_simplejwt.tokens import Token
+
+from pilgrims.buckets import pilgrim_totals
+from pilgrims.dashboard_events import company_channel, get_hub, tent_row
+
+from .views import visible_offices
+
+
+class StreamToken(Token):
+    """Opens dashboard event streams; refused as an access token and vice versa."""
+    token_type = "dashboard_stream"
+    lifetime = timedelta(seconds=settings.PILGRIMS_DASHBOARD_STREAM_TOKEN_SECONDS)
+
+
+class DashboardEventsToken(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        return Response({
+            "token": str(StreamToken.for_user(request.user)),
+            "expires_in": int(StreamToken.lifetime.total_seconds()),
+        })
+
+
+def _authenticate(request):
+    jwt = JWTAuthentication()
+    try:
+        raw = request.GET.get("token")
+        if raw:
+            return jwt.get_user(StreamToken(raw))
+        found = jwt.authenticate(request)
+    except (InvalidToken, TokenError, AuthenticationFailed):
+        return None
+    if found is not None:
+        return found[0]
+    user = request.user
+    return user if user.is_authenticated else None
+
+
+def _snapshot(user, office_ids):
+    offices = visible_offices(user)
+    if office_ids is not None:
+        offices = offices.filter(id__in=office_ids)
+    offices = list(offices.values_list("id", "name"))
+    totals = pilgrim_totals([office_id for office_id, _ in offices])
+    return [
+        {**tent_row(office_id, totals[office_id]), "tent_name": name, "is_sensor_available": True}
+        for office_id, name in offices
+    ]
+
+
+def _event(name, data):
+    return f"event: {name}\ndata: {json.dumps(data, cls=JSONEncoder)}\n\n"
+
+
+def _state(row):
+    return row["illegal_pilgrims"], row["total_people"], row["indicator"]
+
+
+async def _stream(hub, channel, queue, rows):
+    keepalive = settings.PILGRIMS_DASHBOARD_EVENTS_KEEPALIVE_SECONDS
+    deadline = time.monotonic() + settings.PILGRIMS_DASHBOARD_EVENTS_MAX_SECONDS
+    sent = {row["tent_id"]: _state(row) for row in rows}
+    try:
+        yield f"retry: {settings.PILGRIMS_DASHBOARD_EVENTS_RETRY_MS}\n"
+        yield _event("snapshot", rows)
+        while True:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                return
+            try:
+                published = await asyncio.wait_for(queue.get(), min(keepalive, left))
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            if published is None:
+                # Redis went away or this stream fell behind: reconnect
+                return
+            # the channel carries the whole company; keep the visible tents
+            # and what changed since the last event
+            changed = [row for row in published
+                       if row["tent_id"] in sent and sent[row["tent_id"]] != _state(row)]
+            if changed:
+                sent.update((row["tent_id"], _state(row)) for row in changed)
+                yield _event("delta", changed)
+    finally:
+        await hub.unsubscribe(channel, queue)
+
+
+async def dashboard_events(request):
+    if request.method != "GET":
+        return HttpResponseNotAllowed(["GET"])
+    user = await sync_to_async(_authenticate)(request)
+    if user is None:
+        return JsonResponse({"detail": "Authentication credentials were not provided."}, status=401)
+    office_list = request.GET.get("tent_list")
+    office_ids = None
+    if office_list:
+        try:
+            office_ids = [int(t) for t in office_list.split(",") if t.strip().isdigit()]
+        except ValueError:
+            return JsonResponse({"detail": "Invalid tent_list format"}, status=400)
+
+    hub = get_hub()
+    channel = company_channel(user.company_id)
+    try:
+        # subscribed before the snapshot is read, so no change falls between
+        queue = await hub.subscribe(channel, settings.PILGRIMS_DASHBOARD_EVENTS_QUEUE)
+    except redis.RedisError:
+        return JsonResponse({"detail": "Live updates are unavailable; poll office/dashboard/."}, status=503)
+    try:
+        rows = await sync_to_async(_snapshot)(user, office_ids)
+    except BaseException:
+        await hub.unsubscribe(channel, queue)
+        raise
+
+    response = StreamingHttpResponse(_stream(hub, channel, queue, rows), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # nginx must pass events through as they come
+    response["X-Accel-Buffering"] = "no"
+    return response
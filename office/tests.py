@@ -1,3 +1,225 @@
-from django.test import TestCase
+import asyncio
+import json
+from datetime import datetime, timedelta, timezone as dt_timezone
+from unittest import mock
 
-# Create your tests here.
+from django.db import connection
+from django.test import AsyncClient, TestCase
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from authentication.models import Company, MyUser
+from office.async_views import StreamToken
+from office.models import Office
+from pilgrims import dashboard_events
+from pilgrims.buckets import refresh_buckets
+from pilgrims.tests import create_pilgrims
+
+
+class DashboardIllegalPilgrimsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = Company.objects.create(name="company")
+        cls.user = MyUser.objects.create(email="admin@example.com", username="admin",
+                                         company=cls.company, is_admin=True)
+        cls.start = datetime(2025, 6, 1, 7, 0, tzinfo=dt_timezone.utc)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def _add_offices(self, count):
+        offices = Office.objects.bulk_create(
+            Office(company=self.company, name=f"tent {Office.objects.count() + i}", longitude="0", latitude="0")
+            for i in range(count)
+        )
+        create_pilgrims(
+            dict(office=office, time_stamp=self.start + timedelta(seconds=second), camera_count=5,
+                 rfid_count=3, illegal_pilgrims=2)
+            for office in offices for second in range(3)
+        )
+        # as the merge does after writing Pilgrim rows
+        refresh_buckets(self.start, self.start + timedelta(seconds=3), [office.id for office in offices])
+        return offices
+
+    def _get(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/office/dashboard/", {
+                "start_date_time": "2025-06-01T10:00:00", "end_date_time": "2025-06-01T10:01:00",
+            })
+        self.assertEqual(response.status_code, 200)
+        return response.data["results"], len(queries)
+
+    def test_totals_per_office(self):
+        office = self._add_offices(1)[0]
+        results, _ = self._get()
+        # sums of bigint come back as int, not Decimal ("4.0" in the JSON)
+        self.assertIsInstance(results[0]["illegal_pilgrims"], int)
+        self.assertEqual(results, [{
+            "tent_id": office.id,
+            "tent_name": office.name,
+            "illegal_pilgrims": 6,
+            "total_people": 15,
+            "indicator": "red",
+            "is_sensor_available": True,
+        }])
+
+    def test_query_count_does_not_grow_with_offices(self):
+        self._add_offices(3)
+        results, few = self._get()
+        self.assertEqual(len(results), 3)
+
+        self._add_offices(50)
+        results, many = self._get()
+        self.assertEqual(len(results), 53)
+        self.assertEqual(few, many)
+        # offices, the rollup watermark, the grouped bucket and Pilgrim sums
+        self.assertEqual(many, 3)
+
+
+class DashboardPilgrimSeriesTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        company = Company.objects.create(name="company")
+        cls.user = MyUser.objects.create(email="admin@example.com", username="admin",
+                                         company=company, is_admin=True)
+        cls.office = Office.objects.create(company=company, name="tent", longitude="0", latitude="0")
+        # 10:00-10:09:59 Riyadh, one row every 10 seconds
+        start = datetime(2025, 6, 1, 7, 0, tzinfo=dt_timezone.utc)
+        create_pilgrims(
+            dict(office=cls.office, time_stamp=start + timedelta(seconds=second), camera_count=5,
+                 rfid_count=3, illegal_pilgrims=2)
+            for second in range(0, 600, 10)
+        )
+        refresh_buckets(start, start + timedelta(minutes=10), [cls.office.id])
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_bins_in_riyadh_time(self):
+        response = self.client.get("/office/dashboard/series/", {
+            "start_date_time": "2025-06-01T10:02:00", "end_date_time": "2025-06-01T10:14:59", "interval": "5m",
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["interval"], "5m")
+        points = response.data["results"][0]["points"]
+        self.assertEqual([point["time"].strftime("%H:%M") for point in points], ["10:00", "10:05", "10:10"])
+        self.assertEqual([point["camera_count"] for point in points], [150, 150, 0])
+        self.assertEqual([point["illegal_pilgrims"] for point in points], [60, 60, 0])
+
+    def test_long_range_is_downsampled(self):
+        response = self.client.get("/office/dashboard/series/", {
+            "start_date_time": "2025-06-01T00:00:00", "end_date_time": "2025-06-02T23:59:59", "interval": "1m",
+        })
+        self.assertEqual(response.data["requested_interval"], "1m")
+        self.assertEqual(response.data["interval"], "5m")
+        points = response.data["results"][0]["points"]
+        self.assertEqual(len(points), 2 * 24 * 12)
+        self.assertEqual(sum(point["camera_count"] for point in points), 300)
+
+    def test_non_ascii_digits_in_tent_list_are_rejected(self):
+        response = self.client.get("/office/dashboard/series/", {"tent_list": "1,²", "is_live": "true"})
+        self.assertEqual(response.status_code, 400)
+
+
+class DashboardEventsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = Company.objects.create(name="company")
+        other = Company.objects.create(name="other")
+        cls.office = Office.objects.create(company=cls.company, name="tent", longitude="0", latitude="0")
+        cls.other_office = Office.objects.create(company=other, name="tent", longitude="0", latitude="0")
+        cls.user = MyUser.objects.create(email="admin@example.com", username="admin",
+                                         company=cls.company, is_admin=True)
+        # a tent of the same company the viewer is not assigned to
+        cls.unassigned = Office.objects.create(company=cls.company, name="tent 2", longitude="0", latitude="0")
+        cls.viewer = MyUser.objects.create(email="viewer@example.com", username="viewer", company=cls.company)
+        cls.viewer.assigned_office.add(cls.office)
+        start = datetime(2025, 6, 1, 7, 0, tzinfo=dt_timezone.utc)
+        create_pilgrims(
+            dict(office=office, time_stamp=start, camera_count=5, rfid_count=7, illegal_pilgrims=2)
+            for office in (cls.office, cls.other_office)
+        )
+        refresh_buckets(start, start + timedelta(seconds=1))
+
+    def _publish(self, watched):
+        client = mock.MagicMock()
+        client.pubsub_numsub.side_effect = lambda *channels: [(c, int(c in watched)) for c in channels]
+        with mock.patch.object(dashboard_events, "get_redis", return_value=client), \
+                mock.patch.object(dashboard_events, "bump_data_version"):
+            dashboard_events.offices_changed([self.office.id, self.other_office.id])
+        return {call.args[0]: json.loads(call.args[1]) for call in client.pipeline.return_value.publish.call_args_list}
+
+    def test_publishes_totals_to_watched_companies_only(self):
+        channel = dashboard_events.company_channel(self.company.id)
+        self.assertEqual(self._publish({channel}), {channel: [{
+            "tent_id": self.office.id,
+            "illegal_pilgrims": 2,
+            "total_people": 7,
+            "indicator": "red",
+        }]})
+
+    def test_nothing_published_without_watchers(self):
+        self.assertEqual(self._publish(set()), {})
+
+    def test_stream_requires_authentication(self):
+        response = self.client.get("/office/dashboard/events/")
+        self.assertEqual(response.status_code, 401)
+
+    def test_non_ascii_digits_in_tent_list_are_rejected(self):
+        self.client.force_login(self.user)
+        response = self.client.get("/office/dashboard/events/", {"tent_list": "²"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_access_token_is_refused_in_the_query_string(self):
+        response = self.client.get("/office/dashboard/events/", {"token": str(AccessToken.for_user(self.user))})
+        self.assertEqual(response.status_code, 401)
+
+    def test_stream_token_is_issued_to_signed_in_users(self):
+        client = APIClient()
+        self.assertEqual(client.post("/office/dashboard/events/token/").status_code, 401)
+        client.force_authenticate(self.viewer)
+        response = client.post("/office/dashboard/events/token/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(StreamToken(response.data["token"])["user_id"], str(self.viewer.id))
+
+    async def test_viewer_sees_assigned_tents_only(self):
+        published = [
+            dashboard_events.tent_row(office.id, {"camera_count": 9, "rfid_count": 9, "illegal_pilgrims": 0})
+            for office in (self.office, self.unassigned)
+        ]
+        hub = _Hub([published])
+        with mock.patch("office.async_views.get_hub", return_value=hub):
+            response = await AsyncClient().get("/office/dashboard/events/",
+                                               {"token": str(StreamToken.for_user(self.viewer))})
+            self.assertEqual(response.status_code, 200)
+            body = "".join([chunk.decode() async for chunk in response.streaming_content])
+        events = {}
+        for block in body.split("\n\n"):
+            fields = dict(line.split(": ", 1) for line in block.split("\n") if ": " in line)
+            if "event" in fields:
+                events[fields["event"]] = json.loads(fields["data"])
+        self.assertEqual([row["tent_id"] for row in events["snapshot"]], [self.office.id])
+        self.assertEqual(events["delta"], [published[0]])
+        self.assertEqual(hub.channels, [dashboard_events.company_channel(self.company.id)])
+
+
+class _Hub:
+    """Stands in for the pub/sub hub: hands a stream the messages given, then ends it."""
+
+    def __init__(self, published):
+        self.published = published
+        self.channels = []
+
+    async def subscribe(self, channel, maxsize):
+        self.channels.append(channel)
+        queue = asyncio.Queue()
+        for rows in self.published:
+            queue.put_nowait(rows)
+        queue.put_nowait(None)
+        return queue
+
+    async def unsubscribe(self, channel, queue):
+        pass
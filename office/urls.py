@@ -1,6 +1,10 @@
 from django.urls import path, include
-from .views import OfficeApiView, DashboardIllegalPilgrims
+from . import async_views
+from .views import OfficeApiView, DashboardIllegalPilgrims, DashboardPilgrimSeries
 urlpatterns = [
     path('', OfficeApiView.as_view()),
     path('dashboard/', DashboardIllegalPilgrims.as_view()),
+    path('dashboard/series/', DashboardPilgrimSeries.as_view()),
+    path('dashboard/events/', async_views.dashboard_events),
+    path('dashboard/events/token/', async_views.DashboardEventsToken.as_view()),
 ]
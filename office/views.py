@@ -6,8 +6,11 @@ from rest_framework.pagination import PageNumberPagination
 from django.shortcuts import render, get_object_or_404
 from .models import Office
 from .serializers import OfficeSerializer
-from pilgrims.models import Pilgrim
-from django.db.models import Sum
+from pilgrims.buckets import (
+    pilgrim_totals, pilgrim_series, series_interval, series_bounds, REQUESTED_INTERVALS,
+)
+from django.conf import settings
+from pilgrims.dashboard_cache import cached_payload, scope_key
 from django.utils.dateparse import parse_datetime
 from django.utils.timezone import make_aware, is_naive, is_aware
 import pytz
@@ -25,6 +28,13 @@ def Current_saudi_time():
 
     return start_time, end_time
 
+def visible_offices(user):
+    """The offices of the user's company; only the assigned ones unless the user is an admin."""
+    if user.is_admin:
+        return Office.objects.filter(company=user.company)
+    assigned_ids = user.assigned_office.values_list('id', flat=True)
+    return Office.objects.filter(id__in=assigned_ids, company=user.company)
+
 import re
 
 def tent_name_list_dict_sorting(s):
@@ -130,14 +140,8 @@ class DashboardIllegalPilgrims(APIView):
         end_raw = request.GET.get("end_date_time")
         user_provided_date = start_raw and end_raw
         
-        user = request.user
-
         # ✅ Base query: only user's company offices
-        if user.is_admin:
-            offices = Office.objects.filter(company=user.company)
-        else:
-            assigned_ids = user.assigned_office.values_list('id', flat=True)
-            offices = Office.objects.filter(id__in=assigned_ids, company=user.company)
+        offices = visible_offices(request.user)
 
         # ✅ Optional tent_list filter
         if office_list:
@@ -154,41 +158,130 @@ class DashboardIllegalPilgrims(APIView):
         else:
             start_date_time = to_aware_riyadh(parse_datetime(start_raw)) if start_raw else None
             end_date_time = to_aware_riyadh(parse_datetime(end_raw)) if end_raw else None
-        results = []
+        offices = list(offices.values_list("id", "name"))
+
+        def payload():
+            results = []
 
-        for office in offices:
+            # day/hour/minute buckets plus the Pilgrim rows at the edges,
+            # summed for every office in one grouped query
+            office_ids = [office_id for office_id, _ in offices]
             if user_provided_date:
-                filtered_entries = Pilgrim.objects.filter(
-                    office=office,
-                    time_stamp__gte=start_date_time,
-                    time_stamp__lte=end_date_time,
-                )
+                all_totals = pilgrim_totals(office_ids, start_date_time, end_date_time)
             else:
-                filtered_entries = Pilgrim.objects.filter(office=office)
-
-            total_detect_by_camera = filtered_entries.aggregate(total=Sum("camera_count"))["total"] or 0
-            total_detect_by_rfid = filtered_entries.aggregate(total=Sum("rfid_count"))["total"] or 0
-            total_people = max(total_detect_by_camera, total_detect_by_rfid)
-            total_illegal_pilgrims = filtered_entries.aggregate(total=Sum("illegal_pilgrims"))["total"] or 0
-
-            indicator = "red" if total_illegal_pilgrims > 0 else "green"
-
-            results.append({
-                "tent_id": office.id,
-                "tent_name": office.name,
-                "illegal_pilgrims": total_illegal_pilgrims,
-                "total_people": total_people,
-                "indicator": indicator,
-                "is_sensor_available": True,
-            })
-
-        return Response(
-            {
+                all_totals = pilgrim_totals(office_ids)
+
+            for office_id, office_name in offices:
+                totals = all_totals[office_id]
+                total_detect_by_camera = totals["camera_count"]
+                total_detect_by_rfid = totals["rfid_count"]
+                total_people = max(total_detect_by_camera, total_detect_by_rfid)
+                total_illegal_pilgrims = totals["illegal_pilgrims"]
+
+                indicator = "red" if total_illegal_pilgrims > 0 else "green"
+
+                results.append({
+                    "tent_id": office_id,
+                    "tent_name": office_name,
+                    "illegal_pilgrims": total_illegal_pilgrims,
+                    "total_people": total_people,
+                    "indicator": indicator,
+                    "is_sensor_available": True,
+                })
+
+            return {
                 "success": True,
                 "message": "Dashboard Illegal Pilgrims Data",
                 "start_date_time": start_date_time,
                 "end_date_time": end_date_time,
                 "results": results,
+            }
+
+        # live screens poll: one payload per visible tent set until the
+        # merge writes new Pilgrim rows
+        if is_live:
+            key = scope_key(request.user.company_id, offices, user_provided_date and [start_raw, end_raw])
+            return Response(cached_payload(request.user.company_id, key, payload), status=status.HTTP_200_OK)
+        return Response(payload(), status=status.HTTP_200_OK)
+
+
+class DashboardPilgrimSeries(APIView):
+    """
+    Camera count, RFID count and illegal pilgrims per tent in bins of
+    `interval` (1m, 5m, 1h or 1d, Asia/Riyadh time) for the charts:
+
+    GET /office/dashboard/series/?tent_list=1,2&start_date_time=...&end_date_time=...&interval=5m
+
+    A range that would need more than PILGRIMS_SERIES_MAX_POINTS points per
+    tent is answered at the first coarser interval that fits; "interval" in
+    the response is the one used.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        office_list = request.GET.get("tent_list", None)
+        is_live = request.GET.get("is_live", "false").lower() == "true"
+        interval = request.GET.get("interval", "1m" if is_live else "1h")
+        if interval not in REQUESTED_INTERVALS:
+            return Response(
+                {"detail": f"interval must be one of {', '.join(REQUESTED_INTERVALS)}"}, status=400,
+            )
+
+        offices = visible_offices(request.user)
+        if office_list:
+            try:
+                office_ids = [int(t) for t in office_list.split(",") if t.strip().isdigit()]
+            except ValueError:
+                return Response({"detail": "Invalid tent_list format"}, status=400)
+            offices = offices.filter(id__in=office_ids)
+
+        if is_live:
+            end_date_time = timezone.now().astimezone(saudi_tz)
+            start_date_time = end_date_time - timezone.timedelta(minutes=30)
+        else:
+            start_raw = request.GET.get("start_date_time")
+            end_raw = request.GET.get("end_date_time")
+            start_date_time = to_aware_riyadh(parse_datetime(start_raw)) if start_raw else None
+            end_date_time = to_aware_riyadh(parse_datetime(end_raw)) if end_raw else None
+            if not (start_date_time and end_date_time):
+                return Response({"detail": "start_date_time and end_date_time are required"}, status=400)
+            if end_date_time < start_date_time:
+                return Response({"detail": "end_date_time is before start_date_time"}, status=400)
+
+        used = series_interval(start_date_time, end_date_time, interval, settings.PILGRIMS_SERIES_MAX_POINTS)
+        if used is None:
+            return Response({"detail": "Date range too long"}, status=400)
+
+        offices = list(offices.values_list("id", "name"))
+        series = pilgrim_series([office_id for office_id, _ in offices], start_date_time, end_date_time, used)
+        first, last = series_bounds(start_date_time, end_date_time, used)
+
+        results = [
+            {
+                "tent_id": office_id,
+                "tent_name": office_name,
+                "points": [
+                    {
+                        "time": point,
+                        "camera_count": camera_count,
+                        "rfid_count": rfid_count,
+                        "illegal_pilgrims": illegal_pilgrims,
+                    }
+                    for point, camera_count, rfid_count, illegal_pilgrims in series[office_id]
+                ],
+            }
+            for office_id, office_name in offices
+        ]
+
+        return Response(
+            {
+                "success": True,
+                "message": "Dashboard Pilgrim Series Data",
+                "interval": used,
+                "requested_interval": interval,
+                "start_date_time": first,
+                "end_date_time": last,
+                "results": results,
             },
             status=status.HTTP_200_OK,
-        )
\ No newline at end of file
+        )
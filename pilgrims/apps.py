@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class PilgrimsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'pilgrims'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,177 @@
+"""
+Async-native counter ingestion endpoints for the ASGI deployment
+(`uvicorn main.asgi:application`).
+
+They accept the same payloads and return the same responses as
+CameraCounterView / RFIDCounterView. Because they are plain Django async
+views rather than DRF APIViews, a reader waiting on a slow Postgres write
+holds a coroutine, not a worker thread. Rows are written with the async ORM;
+only parsing the body (and streaming its frame to disk) runs in a thread,
+off the event loop.
+"""
+import asyncio
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse, HttpResponseNotAllowed
+
+from .device_registry import camera_registry, rfid_registry
+from .idempotency import aalready_seen, amark_seen
+from .ingestion import (
+    ReadingError, parse_camera_reading, parse_rfid_reading, aupdate_live_tags, aenqueue_readings,
+    build_camera_counter, build_rfid_counter, asave_counter,
+)
+from .ingestion_buffer import is_buffered
+from .uploads import CameraFrameUploadHandler
+from .rate_limit import camera_limiter, rfid_limiter, acoalesce, arecord_shed
+
+
+_db_slots = None
+
+
+def _db_slot():
+    """
+    Caps the ORM calls in flight per process. Django 4.2 runs async ORM calls
+    in threads with a connection per request, so thousands of idle reader
+    connections must not turn into thousands of Postgres connections.
+    """
+    global _db_slots
+    if _db_slots is None:
+        _db_slots = asyncio.Semaphore(settings.PILGRIMS_ASYNC_DB_CONCURRENCY)
+    return _db_slots
+
+
+def _async_post_endpoint(view):
+    # Django 4.2's csrf_exempt/require_POST wrap coroutine views in sync
+    # functions, which turns them into unawaited coroutines; do it by hand.
+    async def wrapper(request, *args, **kwargs):
+        if request.method != "POST":
+            return HttpResponseNotAllowed(["POST"])
+        return await view(request, *args, **kwargs)
+
+    wrapper.csrf_exempt = True
+    wrapper.__name__ = view.__name__
+    wrapper.__doc__ = view.__doc__
+    return wrapper
+
+
+def _payload(request):
+    """Request data as (data, files) for JSON, form and multipart bodies."""
+    if request.content_type == "application/json":
+        try:
+            return json.loads(request.body or b"{}"), {}
+        except ValueError:
+            raise ReadingError("Invalid JSON body")
+    return request.POST, request.FILES
+
+
+async def _apayload(request):
+    # reading the body parses multipart and writes the frame to disk: not on the loop
+    return await sync_to_async(_payload, thread_sensitive=False)(request)
+
+
+def _stored_payload(message, obj):
+    payload = {"message": message, "id": obj.id}
+    if obj.reading_id:
+        payload["reading_id"] = obj.reading_id
+    return payload
+
+
+async def _shed_response(kind, decision, reading):
+    if decision.policy == "reject":
+        await arecord_shed(kind, reading["sn"], "rejected")
+        response = JsonResponse({"error": "Rate limit exceeded", "retry_after": decision.retry_after}, status=429)
+        response["Retry-After"] = str(decision.retry_after)
+        return response
+
+    action = await acoalesce(kind, reading) if decision.policy == "coalesce" else "dropped"
+    await arecord_shed(kind, reading["sn"], action)
+    return JsonResponse({"message": f"Reading {action} (rate limited)", action: True}, status=202)
+
+
+def _duplicate_response(reading):
+    return JsonResponse({
+        "message": "Duplicate reading ignored",
+        "reading_id": reading["reading_id"],
+        "duplicate": True,
+    }, status=200)
+
+
+@_async_post_endpoint
+async def camera_counter(request):
+    # stream the frame straight to counter_image/ instead of spooling it
+    frames = CameraFrameUploadHandler(request)
+    request.upload_handlers.insert(0, frames)
+    try:
+        data, files = await _apayload(request)
+        reading = parse_camera_reading(data)
+    except ReadingError as exc:
+        return JsonResponse({"error": exc.message}, status=exc.status)
+
+    if frames.too_large:
+        return JsonResponse({"error": "Image exceeds the maximum frame size."}, status=413)
+
+    image = files.get("image")
+
+    camera = await camera_registry.aresolve(reading["sn"])
+    if camera is None:
+        return JsonResponse({"error": "Invalid Camera SN"}, status=404)
+    if camera.office_id is None:
+        return JsonResponse({"error": "Device is not assigned to an office"}, status=400)
+
+    reading["office_id"] = camera.office_id
+
+    decision = await camera_limiter.acheck(reading["sn"])
+    if not decision.allowed:
+        return await _shed_response("camera", decision, reading)
+
+    if (await aalready_seen("camera", [reading]))[0]:
+        return _duplicate_response(reading)
+
+    if is_buffered():
+        entry_id, = await aenqueue_readings("camera", [reading], images=[image])
+        await amark_seen("camera", [reading])
+        return JsonResponse({"message": "Camera data queued", "entry_id": entry_id}, status=202)
+
+    async with _db_slot():
+        obj = await asave_counter(build_camera_counter(reading, image=image))
+    await amark_seen("camera", [reading])
+
+    return JsonResponse(_stored_payload("Camera data stored", obj), status=201)
+
+
+@_async_post_endpoint
+async def rfid_counter(request):
+    try:
+        data, _ = await _apayload(request)
+        reading = parse_rfid_reading(data)
+    except ReadingError as exc:
+        return JsonResponse({"error": exc.message}, status=exc.status)
+
+    rfid = await rfid_registry.aresolve(reading["sn"])
+    if rfid is None:
+        return JsonResponse({"error": "Invalid RFID SN"}, status=404)
+    if rfid.office_id is None:
+        return JsonResponse({"error": "Device is not assigned to an office"}, status=400)
+
+    reading["office_id"] = rfid.office_id
+
+    decision = await rfid_limiter.acheck(reading["sn"])
+    if not decision.allowed:
+        return await _shed_response("rfid", decision, reading)
+
+    if (await aalready_seen("rfid", [reading]))[0]:
+        return _duplicate_response(reading)
+
+    if is_buffered():
+        entry_id, = await aenqueue_readings("rfid", [reading])
+        await amark_seen("rfid", [reading])
+        return JsonResponse({"message": "RFID data queued", "entry_id": entry_id}, status=202)
+
+    async with _db_slot():
+        obj = await asave_counter(build_rfid_counter(reading))
+        await aupdate_live_tags(rfid.office_id, reading["sn"], reading["tags"])
+    await amark_seen("rfid", [reading])
+
+    return JsonResponse(_stored_payload("RFID data stored", obj), status=201)
@@ -0,0 +1,384 @@
+"""
+Minute, hour and day sums of Pilgrim rows per office.
+
+Every PilgrimBucket row holds the camera, RFID and illegal-pilgrim sums of
+one office over one Asia/Riyadh minute, hour or day. Whatever writes Pilgrim
+rows (the merge task's `merge_window()`, the stream joiner) takes the bucket
+locks of its offices (`lock_offices()`), returns each row's change of counts
+from the write (`DELTA_RETURNING`) and adds those to the buckets
+(`apply_deltas()`), so a tick costs the rows it wrote. `refresh_buckets()`
+recomputes a range from the Pilgrim rows instead (minutes from the rows,
+hours from the minutes, days from the hours), for bulk rewrites such as
+rebuild_pilgrims.
+
+`pilgrim_totals()` answers a [start, end] range from whole days, then whole
+hours, then whole minutes, and reads Pilgrim rows only for the seconds at
+the edges (`plan_range()`), so a range costs its number of buckets rather
+than its number of seconds. `pilgrim_series()` bins the buckets into the
+points of a chart.
+"""
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+import pytz
+
+from .dashboard_events import offices_changed
+from .models import Pilgrim, PilgrimBucket
+from .rollups import rolled_up_until
+
+saudi_tz = pytz.timezone("Asia/Riyadh")
+
+# coarsest first, with the finer level each is computed from
+GRANULARITIES = ["day", "hour", "minute"]
+_SOURCE = {"day": "hour", "hour": "minute"}
+_STEP = {"day": timedelta(days=1), "hour": timedelta(hours=1), "minute": timedelta(minutes=1)}
+
+_DELTA_SQL = """
+INSERT INTO {bucket} AS b (office_id, granularity, bucket, camera_count, rfid_count, illegal_pilgrims)
+SELECT d.office_id, g.granularity, date_trunc(g.granularity, d.time_stamp, %(tz)s),
+       sum(d.camera_count), sum(d.rfid_count), sum(d.illegal_pilgrims)
+FROM unnest(%(offices)s::bigint[], %(stamps)s::timestamptz[], %(cameras)s::bigint[],
+            %(rfids)s::bigint[], %(illegal)s::bigint[])
+     AS d(office_id, time_stamp, camera_count, rfid_count, illegal_pilgrims)
+CROSS JOIN unnest(ARRAY['minute', 'hour', 'day']) AS g(granularity)
+GROUP BY 1, 2, 3
+HAVING (sum(d.camera_count), sum(d.rfid_count), sum(d.illegal_pilgrims)) <> (0, 0, 0)
+ON CONFLICT (office_id, granularity, bucket) DO UPDATE SET
+    camera_count = b.camera_count + EXCLUDED.camera_count,
+    rfid_count = b.rfid_count + EXCLUDED.rfid_count,
+    illegal_pilgrims = b.illegal_pilgrims + EXCLUDED.illegal_pilgrims
+RETURNING b.office_id, b.granularity
+""".format(bucket=PilgrimBucket._meta.db_table)
+
+# RETURNING clause for an upsert into Pilgrim (`{alias}` is its target): each
+# row written with its counts from before the statement, which a subquery in
+# the same statement still sees. apply_deltas() takes these rows.
+DELTA_RETURNING = """
+RETURNING {alias}.office_id, {alias}.time_stamp,
+          {alias}.camera_count, {alias}.rfid_count, {alias}.illegal_pilgrims,
+          (SELECT ARRAY[o.camera_count, o.rfid_count, o.illegal_pilgrims] FROM {pilgrim} o
+           WHERE o.office_id = {alias}.office_id AND o.time_stamp = {alias}.time_stamp)
+"""
+
+# Two writers of one office at once could each miss the row the other is
+# writing when they read the old counts, so writers take these transaction
+# locks first: one per office_id % BUCKET_LOCK_SLOTS, in order
+BUCKET_LOCK_CLASS = 0x4250  # "BP", first key of the advisory locks
+BUCKET_LOCK_SLOTS = 64
+
+_REFRESH_SQL = """
+WITH fresh AS (
+    SELECT office_id, date_trunc(%(granularity)s, {column}, %(tz)s) AS bucket,
+           COALESCE(sum(camera_count), 0) AS camera_count,
+           COALESCE(sum(rfid_count), 0) AS rfid_count,
+           COALESCE(sum(illegal_pilgrims), 0) AS illegal_pilgrims
+    FROM {source}
+    WHERE {column} >= %(start)s AND {column} < %(end)s {condition}
+      AND (%(offices)s::bigint[] IS NULL OR office_id = ANY(%(offices)s))
+    GROUP BY 1, 2
+), gone AS (
+    DELETE FROM {bucket} b
+    WHERE b.granularity = %(granularity)s AND b.bucket >= %(start)s AND b.bucket < %(end)s
+      AND (%(offices)s::bigint[] IS NULL OR b.office_id = ANY(%(offices)s))
+      AND (b.office_id, b.bucket) NOT IN (SELECT office_id, bucket FROM fresh)
+    RETURNING b.office_id
+), written AS (
+    INSERT INTO {bucket} AS b (office_id, granularity, bucket, camera_count, rfid_count, illegal_pilgrims)
+    SELECT office_id, %(granularity)s, bucket, camera_count, rfid_count, illegal_pilgrims FROM fresh
+    ON CONFLICT (office_id, granularity, bucket) DO UPDATE SET
+        camera_count = EXCLUDED.camera_count,
+        rfid_count = EXCLUDED.rfid_count,
+        illegal_pilgrims = EXCLUDED.illegal_pilgrims
+    WHERE (b.camera_count, b.rfid_count, b.illegal_pilgrims)
+          IS DISTINCT FROM (EXCLUDED.camera_count, EXCLUDED.rfid_count, EXCLUDED.illegal_pilgrims)
+    RETURNING b.office_id
+)
+-- the offices whose buckets changed
+SELECT office_id FROM gone UNION SELECT office_id FROM written
+"""
+
+
+def floor(ts, granularity):
+    """Start of the Asia/Riyadh minute, hour or day `ts` falls in."""
+    local = ts.astimezone(saudi_tz)
+    if granularity == "day":
+        return saudi_tz.localize(datetime.combine(local.date(), datetime.min.time()))
+    if granularity == "hour":
+        return local.replace(minute=0, second=0, microsecond=0)
+    return local.replace(second=0, microsecond=0)
+
+
+def ceil(ts, granularity):
+    start = floor(ts, granularity)
+    return start if start == ts else start + _STEP[granularity]
+
+
+def refresh_buckets(start, end, office_ids=None):
+    """
+    Recompute the buckets of every granularity that overlap [start, end)
+    for `office_ids` (every office when None), after Pilgrim rows in that
+    range were written or deleted. Once committed, the tents whose days
+    changed go to `offices_changed()` (dashboard cache and streams).
+    """
+    offices = list(office_ids) if office_ids is not None else None
+    minutes_from = floor(start, "minute")
+    days = settings.PILGRIMS_ROLLUP_AFTER_DAYS
+    if days and minutes_from < timezone.now() - timedelta(days=days):
+        # the raw rows behind the rollup horizon are gone: keep those minutes
+        horizon = rolled_up_until()
+        if horizon is not None:
+            minutes_from = max(minutes_from, horizon)
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        for granularity in reversed(GRANULARITIES):
+            source = _SOURCE.get(granularity)
+            if source is None:
+                sql = _REFRESH_SQL.format(
+                    source=Pilgrim._meta.db_table, column="time_stamp", condition="",
+                    bucket=PilgrimBucket._meta.db_table,
+                )
+                bucket_start = minutes_from
+            else:
+                sql = _REFRESH_SQL.format(
+                    source=PilgrimBucket._meta.db_table, column="bucket", condition="AND granularity = %(source)s",
+                    bucket=PilgrimBucket._meta.db_table,
+                )
+                bucket_start = floor(start, granularity)
+            cursor.execute(sql, {
+                "granularity": granularity,
+                "source": source,
+                "tz": saudi_tz.zone,
+                "start": bucket_start,
+                "end": ceil(end, granularity),
+                "offices": offices,
+            })
+        # every change reaches the day buckets last
+        changed = [row[0] for row in cursor.fetchall()]
+        if changed:
+            transaction.on_commit(lambda: offices_changed(changed))
+
+
+def lock_offices(office_ids):
+    """Hold the bucket locks of `office_ids` (every office when None) until the transaction ends."""
+    if office_ids is None:
+        slots = list(range(BUCKET_LOCK_SLOTS))
+    else:
+        slots = sorted({office_id % BUCKET_LOCK_SLOTS for office_id in office_ids})
+    if not slots:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT pg_advisory_xact_lock(%s, slot) FROM unnest(%s::int[]) AS slot", [BUCKET_LOCK_CLASS, slots],
+        )
+
+
+def row_deltas(returned):
+    """(office_id, time_stamp, camera, rfid, illegal) changes from rows of DELTA_RETURNING."""
+    for office_id, time_stamp, camera_count, rfid_count, illegal_pilgrims, before in returned:
+        before = before or [None, None, 0]
+        yield (
+            office_id, time_stamp,
+            (camera_count or 0) - (before[0] or 0),
+            (rfid_count or 0) - (before[1] or 0),
+            (illegal_pilgrims or 0) - (before[2] or 0),
+        )
+
+
+def apply_deltas(deltas):
+    """
+    Add (office_id, time_stamp, camera, rfid, illegal) changes of Pilgrim rows
+    to their minute, hour and day buckets, under the writer's lock_offices().
+    Once committed, the tents whose days changed go to `offices_changed()`
+    (dashboard cache and streams).
+    """
+    deltas = [delta for delta in deltas if any(delta[2:])]
+    if not deltas:
+        return
+    offices, stamps, cameras, rfids, illegal = zip(*deltas)
+    with connection.cursor() as cursor:
+        cursor.execute(_DELTA_SQL, {
+            "tz": saudi_tz.zone,
+            "offices": list(offices), "stamps": list(stamps),
+            "cameras": list(cameras), "rfids": list(rfids), "illegal": list(illegal),
+        })
+        changed = sorted({office_id for office_id, granularity in cursor.fetchall() if granularity == "day"})
+    if changed:
+        transaction.on_commit(lambda: offices_changed(changed))
+
+
+def _plan(start, end, levels):
+    if not levels:
+        return [(None, start, end)]
+    granularity = levels[0]
+    low = ceil(start, granularity) if start is not None else None
+    high = floor(end, granularity) if end is not None else None
+    if low is not None and high is not None and low >= high:
+        return _plan(start, end, levels[1:])
+    head = _plan(start, low, levels[1:]) if start is not None else []
+    tail = _plan(high, end, levels[1:]) if end is not None else []
+    return head + [(granularity, low, high)] + tail
+
+
+def plan_range(start, end):
+    """
+    Split [start, end) into (granularity, low, high) pieces: whole days,
+    whole hours, whole minutes and, with granularity None, the seconds left
+    at the edges. An open end (None) is covered by the coarsest level.
+    """
+    return [(granularity, low, high) for granularity, low, high in _plan(start, end, GRANULARITIES)
+            if low is None or high is None or low < high]
+
+
+def _branch(level, low, high, params):
+    # one simple range per branch, so every one is an index range scan
+    if level is None:
+        table, column, conditions = Pilgrim._meta.db_table, "time_stamp", []
+    else:
+        table, column, conditions = PilgrimBucket._meta.db_table, "bucket", ["granularity = %s"]
+        params.append(level)
+    if low is not None:
+        conditions.append(f"{column} >= %s")
+        params.append(low)
+    if high is not None:
+        conditions.append(f"{column} < %s")
+        params.append(high)
+    return (
+        f"SELECT office_id, camera_count, rfid_count, illegal_pilgrims FROM {table} "
+        f"WHERE office_id = ANY(%s) AND {' AND '.join(conditions)}"
+    )
+
+
+def pilgrim_totals(office_ids, start=None, end=None):
+    """
+    {office_id: {"camera_count", "rfid_count", "illegal_pilgrims"}} summed
+    over [start, end] (open ends when None) in one query over the buckets of
+    `plan_range()` and the Pilgrim rows at its edges. Before the rollup
+    horizon the raw rows are gone and a bound inside a minute takes the
+    full minute.
+    """
+    totals = defaultdict(lambda: {"camera_count": 0, "rfid_count": 0, "illegal_pilgrims": 0})
+    office_ids = list(office_ids)
+    if not office_ids:
+        return totals
+
+    # naive bounds mean TIME_ZONE, as they would in a queryset filter
+    if start is not None and timezone.is_naive(start):
+        start = timezone.make_aware(start)
+    if end is not None and timezone.is_naive(end):
+        end = timezone.make_aware(end)
+    # [start, end] -> [start, end)
+    end = end + timedelta(microseconds=1) if end is not None else None
+
+    horizon = rolled_up_until()
+    if horizon is not None:
+        if start is not None and start < horizon:
+            start = floor(start, "minute")
+        if end is not None and end < horizon:
+            end = ceil(end, "minute")
+
+    params, branches = [], []
+    for level, low, high in plan_range(start, end):
+        params.append(office_ids)
+        branches.append(_branch(level, low, high, params))
+    if not branches:
+        return totals
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            # sum() of bigint is numeric: back to bigint, or the sums come out as Decimal
+            "SELECT office_id, sum(camera_count)::bigint, sum(rfid_count)::bigint, sum(illegal_pilgrims)::bigint "
+            f"FROM ({' UNION ALL '.join(branches)}) pieces GROUP BY office_id",
+            params,
+        )
+        for office_id, camera, rfid, illegal in cursor.fetchall():
+            office = totals[office_id]
+            office["camera_count"] = camera or 0
+            office["rfid_count"] = rfid or 0
+            office["illegal_pilgrims"] = illegal or 0
+    return totals
+
+
+# what a series can be asked for, and the coarser steps a long range is
+# downsampled to
+SERIES_INTERVALS = {
+    "1m": timedelta(minutes=1),
+    "5m": timedelta(minutes=5),
+    "15m": timedelta(minutes=15),
+    "1h": timedelta(hours=1),
+    "6h": timedelta(hours=6),
+    "1d": timedelta(days=1),
+    "7d": timedelta(days=7),
+}
+REQUESTED_INTERVALS = ["1m", "5m", "1h", "1d"]
+# bins start at Riyadh midnight (weeks on a Sunday)
+SERIES_ORIGIN = saudi_tz.localize(datetime(2000, 1, 2))
+
+_SERIES_SQL = """
+SELECT office_id, date_bin(%(step)s, bucket, %(origin)s) AS point,
+       sum(camera_count)::bigint, sum(rfid_count)::bigint, sum(illegal_pilgrims)::bigint
+FROM {bucket}
+WHERE granularity = %(granularity)s AND office_id = ANY(%(offices)s)
+  AND bucket >= %(start)s AND bucket < %(end)s
+GROUP BY 1, 2
+""".format(bucket=PilgrimBucket._meta.db_table)
+
+
+def _bin(ts, step):
+    return SERIES_ORIGIN + (ts - SERIES_ORIGIN) // step * step
+
+
+def series_bounds(start, end, interval):
+    """[start, end] widened to whole bins of `interval`: (first point, end of the last)."""
+    step = SERIES_INTERVALS[interval]
+    first = _bin(start, step)
+    last = _bin(end, step) + step
+    return first.astimezone(saudi_tz), last.astimezone(saudi_tz)
+
+
+def series_interval(start, end, interval, max_points):
+    """
+    `interval`, or the first coarser one that keeps [start, end] within
+    `max_points` points per office; None when even the coarsest does not.
+    """
+    names = list(SERIES_INTERVALS)
+    for name in names[names.index(interval):]:
+        first, last = series_bounds(start, end, name)
+        if (last - first) // SERIES_INTERVALS[name] <= max_points:
+            return name
+    return None
+
+
+def pilgrim_series(office_ids, start, end, interval):
+    """
+    {office_id: [(point, camera_count, rfid_count, illegal_pilgrims), ...]}
+    for every bin of `interval` from the one holding `start` to the one
+    holding `end`, zeros where nothing was recorded. Read from the coarsest
+    bucket granularity the interval is a multiple of.
+    """
+    step = SERIES_INTERVALS[interval]
+    granularity = next(name for name in GRANULARITIES if step % _STEP[name] == timedelta(0))
+    first, last = series_bounds(start, end, interval)
+    office_ids = list(office_ids)
+
+    found = {}
+    if office_ids:
+        with connection.cursor() as cursor:
+            cursor.execute(_SERIES_SQL, {
+                "step": step,
+                "origin": SERIES_ORIGIN,
+                "granularity": granularity,
+                "offices": office_ids,
+                "start": first,
+                "end": last,
+            })
+            for office_id, point, camera, rfid, illegal in cursor.fetchall():
+                found[office_id, point] = (camera, rfid, illegal)
+
+    points = [first + step * i for i in range((last - first) // step)]
+    return {
+        office_id: [(point, *found.get((office_id, point), (0, 0, 0))) for point in points]
+        for office_id in office_ids
+    }
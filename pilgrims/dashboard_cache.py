@@ -0,0 +1,115 @@
+"""
+Redis cache of the live dashboard payload.
+
+Pilgrim sums only change when Pilgrim rows are written, so every write that
+changes a bucket bumps the data version of the companies whose tents it
+changed (`bump_data_version()`, called through
+pilgrims.dashboard_events.offices_changed once the writing transaction
+commits). `cached_payload()` keeps one payload per scope (company and
+visible tents) stamped with its company's version at the time; while that
+version stands, every viewer of the scope gets it with a single MGET.
+Writes for other companies leave it alone.
+
+A stale or missing payload is recomputed by one request only: the first
+takes a short lock holding a token of its own, the others poll for its
+result for up to PILGRIMS_DASHBOARD_CACHE_WAIT_MS before computing it
+themselves. The lock is deleted only while it still holds that token, so
+a request whose lock expired cannot delete the next one's. Without Redis
+every request computes its own payload, as before.
+"""
+import hashlib
+import json
+import secrets
+import time
+
+import redis
+from django.conf import settings
+from rest_framework.utils.encoders import JSONEncoder
+
+from .redis_client import get_redis
+
+VERSION_PREFIX = "pilgrims:data_version:"
+_POLL_SECONDS = 0.025
+
+
+def version_key(company_id):
+    return f"{VERSION_PREFIX}{company_id}"
+
+
+def bump_data_version(company_ids):
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        for company_id in company_ids:
+            pipe.incr(version_key(company_id))
+        pipe.execute()
+    except redis.RedisError:
+        pass
+
+
+def scope_key(*parts):
+    digest = hashlib.sha1(json.dumps(parts, cls=JSONEncoder).encode()).hexdigest()
+    return f"pilgrims:dashboard:{digest}"
+
+
+def _fresh(cached, version):
+    if cached is None:
+        return None
+    cached = json.loads(cached)
+    return cached["payload"] if cached["version"] == version else None
+
+
+def _release(client, lock, token):
+    # delete the lock only while it is still ours
+    try:
+        with client.pipeline() as pipe:
+            pipe.watch(lock)
+            if pipe.get(lock) == token:
+                pipe.multi()
+                pipe.delete(lock)
+                pipe.execute()
+    except redis.RedisError:
+        # WatchError too: the lock changed under us, so it is someone else's
+        pass
+
+
+def cached_payload(company_id, key, compute):
+    """
+    The payload cached under `key` for the current data version of
+    `company_id`, or `compute()` (stored for the next viewers). Payloads
+    must be JSON serializable the way DRF renders them.
+    """
+    ttl = settings.PILGRIMS_DASHBOARD_CACHE_TTL
+    if not ttl:
+        return compute()
+
+    client = get_redis()
+    try:
+        version, cached = client.mget(version_key(company_id), key)
+        version = version or "0"
+        payload = _fresh(cached, version)
+        if payload is not None:
+            return payload
+
+        # single flight: one request computes, the rest wait for its result
+        lock, token = f"{key}:lock:{version}", secrets.token_hex(8)
+        if not client.set(lock, token, nx=True, px=settings.PILGRIMS_DASHBOARD_CACHE_WAIT_MS * 2):
+            deadline = time.monotonic() + settings.PILGRIMS_DASHBOARD_CACHE_WAIT_MS / 1000
+            while time.monotonic() < deadline:
+                time.sleep(_POLL_SECONDS)
+                payload = _fresh(client.get(key), version)
+                if payload is not None:
+                    return payload
+            return compute()
+    except redis.RedisError:
+        return compute()
+
+    try:
+        # through JSON, so a cache hit returns exactly what a miss does
+        payload = json.loads(json.dumps(compute(), cls=JSONEncoder))
+        try:
+            client.set(key, json.dumps({"version": version, "payload": payload}), ex=ttl)
+        except redis.RedisError:
+            pass
+        return payload
+    finally:
+        _release(client, lock, token)
@@ -0,0 +1,196 @@
+"""
+Live dashboard changes pushed to control-room screens over Redis pub/sub.
+
+When a write of Pilgrim rows changes day buckets (pilgrims.buckets),
+`offices_changed()` runs once the transaction commits. It bumps the data
+versions of the tents' companies (pilgrims/dashboard_cache.py) and
+publishes the new all-time totals of the changed tents to their company's
+channel, in the same shape as the rows of the live `office/dashboard/`:
+
+    [{"tent_id", "illegal_pilgrims", "total_people", "indicator"}, ...]
+
+Nothing is computed or published for companies nobody is watching.
+
+In the ASGI process, `DashboardHub` holds one pub/sub connection per event
+loop. It hands every message to the queues of the streams subscribed to
+the channel (office/async_views.py), so a thousand screens cost one Redis
+subscription per process, not a thousand.
+"""
+import asyncio
+import json
+import logging
+import weakref
+from collections import defaultdict
+
+import redis
+from django.db.models import Sum
+
+from .dashboard_cache import bump_data_version
+from .models import PilgrimBucket
+from .redis_client import get_async_pubsub, get_redis
+
+logger = logging.getLogger(__name__)
+
+CHANNEL_PREFIX = "pilgrims:dashboard:events:"
+
+
+def company_channel(company_id):
+    return f"{CHANNEL_PREFIX}{company_id}"
+
+
+def tent_row(office_id, totals):
+    """The live dashboard's view of one tent's totals."""
+    illegal = totals["illegal_pilgrims"]
+    return {
+        "tent_id": office_id,
+        "illegal_pilgrims": illegal,
+        "total_people": max(totals["camera_count"], totals["rfid_count"]),
+        "indicator": "red" if illegal > 0 else "green",
+    }
+
+
+def _all_time_totals(office_ids):
+    # all-time totals are the sum of the day buckets, as pilgrim_totals()
+    # answers an open range
+    rows = (
+        PilgrimBucket.objects.filter(granularity="day", office_id__in=office_ids)
+        .values("office_id")
+        .annotate(camera_count=Sum("camera_count"), rfid_count=Sum("rfid_count"),
+                  illegal_pilgrims=Sum("illegal_pilgrims"))
+    )
+    return {row.pop("office_id"): row for row in rows}
+
+
+def offices_changed(office_ids):
+    """The totals of `office_ids` changed: expire their companies' dashboards and publish the new totals."""
+    from office.models import Office
+
+    companies = dict(Office.objects.filter(id__in=office_ids).values_list("id", "company_id"))
+    bump_data_version(set(companies.values()))
+    publish_changes(companies)
+
+
+def publish_changes(companies):
+    """Publish the new totals of the offices in `companies` (office_id -> company_id) to their channels."""
+    try:
+        client = get_redis()
+        channels = {company_channel(company_id) for company_id in companies.values() if company_id}
+        if not channels:
+            return
+        watched = {channel for channel, count in client.pubsub_numsub(*channels) if count}
+        offices = [office_id for office_id, company_id in companies.items()
+                   if company_channel(company_id) in watched]
+        if not offices:
+            return
+
+        empty = {"camera_count": 0, "rfid_count": 0, "illegal_pilgrims": 0}
+        totals = _all_time_totals(offices)
+        rows = defaultdict(list)
+        for office_id in offices:
+            rows[company_channel(companies[office_id])].append(tent_row(office_id, totals.get(office_id, empty)))
+        pipe = client.pipeline(transaction=False)
+        for channel, changed in rows.items():
+            pipe.publish(channel, json.dumps(changed))
+        pipe.execute()
+    except redis.RedisError:
+        # streams end without Redis and screens poll; nothing to publish to
+        pass
+
+
+class DashboardHub:
+    """One pub/sub connection per event loop, fanned out to per-stream queues."""
+
+    def __init__(self):
+        self._pubsub = None
+        self._queues = defaultdict(set)
+        self._reader = None
+
+    async def subscribe(self, channel, maxsize):
+        queue = asyncio.Queue(maxsize=maxsize)
+        if self._pubsub is None:
+            self._pubsub = get_async_pubsub()
+        pubsub = self._pubsub
+        first = channel not in self._queues
+        # registered before any await, so the reader cannot stop under it
+        self._queues[channel].add(queue)
+        if first:
+            try:
+                await pubsub.subscribe(channel)
+            except redis.RedisError:
+                # left registered, the channel would never be subscribed again
+                self._queues[channel].discard(queue)
+                if not self._queues[channel]:
+                    del self._queues[channel]
+                if self._reader is None and not self._queues and self._pubsub is pubsub:
+                    self._pubsub = None
+                    await _close(pubsub)
+                raise
+        # the reader needs the connection the first subscribe opens
+        if self._reader is None:
+            self._reader = asyncio.create_task(self._read(pubsub))
+        return queue
+
+    async def unsubscribe(self, channel, queue):
+        queues = self._queues.get(channel)
+        if queues is None or queue not in queues:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self._queues[channel]
+            try:
+                await self._pubsub.unsubscribe(channel)
+            except redis.RedisError:
+                pass
+
+    async def _read(self, pubsub):
+        try:
+            while self._queues:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if message is None:
+                    continue
+                rows = json.loads(message["data"])
+                for queue in list(self._queues.get(message["channel"], ())):
+                    try:
+                        queue.put_nowait(rows)
+                    except asyncio.QueueFull:
+                        # a stream this far behind resyncs from a snapshot
+                        _end(queue)
+        except redis.RedisError:
+            logger.warning("dashboard subscription lost", exc_info=True)
+        finally:
+            # streams still open end and reconnect on a fresh connection
+            for queues in self._queues.values():
+                for queue in queues:
+                    _end(queue)
+            self._queues.clear()
+            self._pubsub = self._reader = None
+            loop = asyncio.get_running_loop()
+            if _hubs.get(loop) is self:
+                del _hubs[loop]
+            await _close(pubsub)
+
+
+async def _close(pubsub):
+    try:
+        await pubsub.aclose()
+    except redis.RedisError:
+        pass
+
+
+def _end(queue):
+    # drop what is queued and leave None: the stream ends on it
+    while not queue.empty():
+        queue.get_nowait()
+    queue.put_nowait(None)
+
+
+# a hub leaves once its reader stops; one that never started a reader goes with its loop
+_hubs = weakref.WeakKeyDictionary()
+
+
+def get_hub():
+    loop = asyncio.get_running_loop()
+    hub = _hubs.get(loop)
+    if hub is None:
+        hub = _hubs[loop] = DashboardHub()
+    return hub
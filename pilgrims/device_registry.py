@@ -0,0 +1,245 @@
+"""
+Serial-number -> (device_id, office_id) cache for the ingestion endpoints.
+
+Lookups go through three layers: a per-process dict, a Redis hash shared by
+all gunicorn/celery workers, and finally the database. The Redis layer is
+filled with the whole device table in one query (`warm`), and `Camera`/`RFID`
+save and delete signals drop stale entries (see pilgrims/signals.py).
+
+Every invalidation bumps a generation counter in Redis; processes compare it
+at most once per DEVICE_REGISTRY_CHECK_INTERVAL seconds and drop their local
+copy when it moved, so a reassigned device is picked up everywhere quickly.
+A lookup only writes what it read from the database back to Redis while the
+generation is the one it saw before reading, so a lookup racing an
+invalidation cannot put the old row back. The hash expires after
+DEVICE_REGISTRY_REDIS_TTL regardless.
+
+Unknown serial numbers are remembered for DEVICE_REGISTRY_MISS_TTL seconds
+only, and the local dict is pruned past DEVICE_REGISTRY_LOCAL_MAX entries,
+so a stream of made-up serials cannot grow it without bound.
+If Redis is unreachable the registry degrades to local dict + database.
+"""
+from collections import namedtuple
+import logging
+import threading
+import time
+
+import redis
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .models import Camera, RFID
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+DeviceEntry = namedtuple("DeviceEntry", ["device_id", "office_id"])
+
+_ANY = object()
+
+# Redis hash value for a serial number that is known not to exist, followed
+# by the unix time the miss expires at.
+_UNKNOWN = "-"
+
+
+def _encode(entry):
+    if entry is None:
+        return f"{_UNKNOWN}{int(time.time()) + settings.DEVICE_REGISTRY_MISS_TTL}"
+    return f"{entry.device_id}:{entry.office_id if entry.office_id is not None else ''}"
+
+
+def _is_stale(value):
+    return value.startswith(_UNKNOWN) and int(value[len(_UNKNOWN):] or 0) <= time.time()
+
+
+def _decode(value):
+    if value.startswith(_UNKNOWN):
+        return None
+    device_id, office_id = value.split(":")
+    return DeviceEntry(int(device_id), int(office_id) if office_id else None)
+
+
+class DeviceRegistry:
+
+    def __init__(self, model):
+        self.model = model
+        self.label = model.__name__
+        self.hash_key = f"pilgrims:devices:{model._meta.model_name}"
+        self.generation_key = f"{self.hash_key}:generation"
+        self._local = {}
+        self._warmed = False
+        self._generation = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._warm_lock = threading.Lock()
+
+    # ------------------------------------------------------
+    # Lookups
+    # ------------------------------------------------------
+    def resolve(self, sn):
+        """DeviceEntry for `sn`, or None when no such device exists."""
+        return self.resolve_many([sn]).get(sn)
+
+    async def aresolve(self, sn):
+        """
+        Async variant of `resolve` for the ASGI views. A warm local entry is
+        answered on the event loop; Redis/database lookups run in a thread.
+        """
+        cached = self._local.get(sn)
+        generation_due = time.monotonic() - self._checked_at >= settings.DEVICE_REGISTRY_CHECK_INTERVAL
+        if self._warmed and cached and cached[1] > time.monotonic() and not generation_due:
+            return cached[0]
+        return await sync_to_async(self.resolve)(sn)
+
+    def resolve_many(self, sns):
+        """Map each serial number to its DeviceEntry (None for unknown devices)."""
+        if not self._warmed:
+            # gunicorn has no worker-start hook here; warm on the first lookup,
+            # once, even when a burst of requests arrives before it finishes
+            with self._warm_lock:
+                if not self._warmed:
+                    self.warm()
+        self._check_generation()
+
+        now = time.monotonic()
+        found = {}
+        missing = []
+        for sn in set(sns):
+            cached = self._local.get(sn)
+            if cached and cached[1] > now:
+                found[sn] = cached[0]
+            else:
+                missing.append(sn)
+
+        if missing:
+            shared = self._from_redis(missing)
+            generation = self._redis_generation()
+            from_db = self._from_db([sn for sn in missing if sn not in shared])
+            self._to_redis(from_db, generation)
+
+            entries = {**shared, **from_db}
+            self._remember(entries, now)
+            found.update(entries)
+
+        return found
+
+    # ------------------------------------------------------
+    # Maintenance
+    # ------------------------------------------------------
+    def warm(self):
+        """Load every device into Redis and the local dict with a single query."""
+        entries = {
+            sn: DeviceEntry(device_id, office_id)
+            for sn, device_id, office_id in self.model.objects.values_list("sn", "id", "office_id")
+        }
+        self._to_redis(entries)
+
+        expires_at = time.monotonic() + settings.DEVICE_REGISTRY_LOCAL_TTL
+        with self._lock:
+            self._local = {sn: (entry, expires_at) for sn, entry in entries.items()}
+            self._warmed = True
+        return len(entries)
+
+    def _remember(self, entries, now):
+        with self._lock:
+            for sn, entry in entries.items():
+                ttl = settings.DEVICE_REGISTRY_LOCAL_TTL if entry is not None else settings.DEVICE_REGISTRY_MISS_TTL
+                self._local[sn] = (entry, now + ttl)
+            if len(self._local) > settings.DEVICE_REGISTRY_LOCAL_MAX:
+                # misses go first: what is left is bounded by the device table
+                self._local = {sn: cached for sn, cached in self._local.items()
+                               if cached[0] is not None and cached[1] > now}
+
+    def invalidate(self, *sns):
+        """Forget the given serial numbers everywhere (all serials when none given)."""
+        with self._lock:
+            if sns:
+                for sn in sns:
+                    self._local.pop(sn, None)
+            else:
+                self._local = {}
+
+        try:
+            client = get_redis()
+            pipe = client.pipeline()
+            if sns:
+                pipe.hdel(self.hash_key, *sns)
+            else:
+                pipe.delete(self.hash_key)
+            pipe.incr(self.generation_key)
+            pipe.execute()
+        except redis.RedisError:
+            logger.warning("Device registry: could not invalidate %s in Redis", self.label)
+
+    # ------------------------------------------------------
+    # Layers
+    # ------------------------------------------------------
+    def _check_generation(self):
+        now = time.monotonic()
+        if now - self._checked_at < settings.DEVICE_REGISTRY_CHECK_INTERVAL:
+            return
+        self._checked_at = now
+
+        try:
+            generation = get_redis().get(self.generation_key)
+        except redis.RedisError:
+            return
+
+        if generation != self._generation:
+            with self._lock:
+                self._local = {}
+                self._generation = generation
+
+    def _redis_generation(self):
+        try:
+            return get_redis().get(self.generation_key)
+        except redis.RedisError:
+            return None
+
+    def _from_redis(self, sns):
+        try:
+            values = get_redis().hmget(self.hash_key, sns)
+        except redis.RedisError:
+            return {}
+        return {sn: _decode(value) for sn, value in zip(sns, values)
+                if value is not None and not _is_stale(value)}
+
+    def _from_db(self, sns):
+        if not sns:
+            return {}
+        entries = {sn: None for sn in sns}
+        for sn, device_id, office_id in self.model.objects.filter(sn__in=sns).values_list("sn", "id", "office_id"):
+            entries[sn] = DeviceEntry(device_id, office_id)
+        return entries
+
+    def _to_redis(self, entries, generation=_ANY):
+        """
+        Write `entries` to the shared hash. With a `generation`, only while
+        the generation counter still holds it: an invalidation since the
+        entries were read from the database means they may be stale.
+        """
+        if not entries:
+            return
+        mapping = {sn: _encode(entry) for sn, entry in entries.items()}
+        try:
+            with get_redis().pipeline() as pipe:
+                if generation is not _ANY:
+                    pipe.watch(self.generation_key)
+                    if pipe.get(self.generation_key) != generation:
+                        return
+                    pipe.multi()
+                pipe.hset(self.hash_key, mapping=mapping)
+                pipe.expire(self.hash_key, settings.DEVICE_REGISTRY_REDIS_TTL)
+                pipe.execute()
+        except redis.WatchError:
+            pass
+        except redis.RedisError:
+            pass
+
+
+camera_registry = DeviceRegistry(Camera)
+rfid_registry = DeviceRegistry(RFID)
+
+
+def registry_for(model):
+    return camera_registry if model is Camera else rfid_registry
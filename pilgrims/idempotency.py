@@ -0,0 +1,73 @@
+"""
+Short-lived Redis "seen" keys for client-supplied reading ids.
+
+Readers retry on timeouts. A retry of a reading that was stored a moment ago
+is answered from Redis without touching the database; anything older than
+PILGRIMS_SEEN_TTL is still deduplicated by the (sn, reading_id, time_stamp) unique
+constraint on the counter tables. Keys are set only after the reading was
+stored or queued, so a failed attempt never blocks its own retry.
+"""
+import redis
+from django.conf import settings
+
+from .redis_client import get_redis, get_async_redis
+
+
+def _key(kind, reading):
+    return f"pilgrims:seen:{kind}:{reading['sn']}:{reading['reading_id']}"
+
+
+def _keys(kind, readings):
+    return [_key(kind, reading) for reading in readings if reading.get("reading_id")]
+
+
+def _flags(readings, values):
+    values = iter(values)
+    return [bool(next(values)) if reading.get("reading_id") else False for reading in readings]
+
+
+def already_seen(kind, readings):
+    """One flag per reading: True when it is a retry of a recently stored reading."""
+    keys = _keys(kind, readings)
+    if not keys:
+        return [False] * len(readings)
+    try:
+        return _flags(readings, get_redis().mget(keys))
+    except redis.RedisError:
+        return [False] * len(readings)
+
+
+def mark_seen(kind, readings):
+    keys = _keys(kind, readings)
+    if not keys:
+        return
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        for key in keys:
+            pipe.set(key, 1, ex=settings.PILGRIMS_SEEN_TTL)
+        pipe.execute()
+    except redis.RedisError:
+        pass
+
+
+async def aalready_seen(kind, readings):
+    keys = _keys(kind, readings)
+    if not keys:
+        return [False] * len(readings)
+    try:
+        return _flags(readings, await get_async_redis().mget(keys))
+    except redis.RedisError:
+        return [False] * len(readings)
+
+
+async def amark_seen(kind, readings):
+    keys = _keys(kind, readings)
+    if not keys:
+        return
+    try:
+        pipe = get_async_redis().pipeline(transaction=False)
+        for key in keys:
+            pipe.set(key, 1, ex=settings.PILGRIMS_SEEN_TTL)
+        await pipe.execute()
+    except redis.RedisError:
+        pass
@@ -0,0 +1,447 @@
+from datetime import datetime
+import json
+
+from asgiref.sync import sync_to_async
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from django.utils import timezone
+
+from authentication.models import RIYADH_TZ
+from .device_registry import camera_registry, rfid_registry
+from .idempotency import already_seen, mark_seen
+from .ingestion_buffer import check_entry, get_buffer, is_buffered
+from .models import CameraCounter, RFIDCounter, LiveRFIDTag
+
+
+class ReadingError(Exception):
+    """A single reading could not be accepted; carries the HTTP status to report."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def _is_missing(value):
+    return value in [None, ""]
+
+
+def _parse_reading_id(data):
+    """
+    Optional idempotency key: a client UUID ("reading_id") or a per-device
+    sequence number ("seq"). Either way it is unique together with the sn.
+    """
+    reading_id = data.get("reading_id")
+    if not _is_missing(reading_id):
+        reading_id = str(reading_id)
+        if len(reading_id) > 64:
+            raise ReadingError("reading_id must be at most 64 characters")
+        return reading_id
+
+    seq = data.get("seq")
+    if not _is_missing(seq):
+        try:
+            return f"seq:{int(seq)}"
+        except (TypeError, ValueError):
+            raise ReadingError("seq must be an integer")
+
+    return None
+
+
+def _check_limits(model, sn, count_field, count):
+    """
+    Reject values the counter columns cannot hold, so one item fails on its
+    own instead of failing the bulk insert of its whole batch.
+    """
+    if len(sn) > model._meta.get_field("sn").max_length:
+        raise ReadingError("sn is too long")
+    low, high = connection.ops.integer_field_range(model._meta.get_field(count_field).get_internal_type())
+    if not low <= count <= high:
+        raise ReadingError(f"{count_field} is out of range")
+
+
+def parse_camera_reading(data):
+    """
+    Validate one camera reading and return it as a plain dict.
+    Raises ReadingError when a field is missing or malformed.
+    """
+    sn = data.get("camera_sn")
+    camera_count = data.get("camera_count")
+    time_stamp = data.get("time_stamp")
+
+    if _is_missing(sn) or _is_missing(time_stamp) or camera_count is None:
+        raise ReadingError("Missing fields")
+
+    try:
+        reading = {
+            "sn": str(sn),
+            "camera_count": int(camera_count),
+            "time_stamp": datetime.fromisoformat(time_stamp),
+            "reading_id": _parse_reading_id(data),
+        }
+    except (TypeError, ValueError):
+        raise ReadingError("Invalid camera_count or time_stamp")
+
+    _check_limits(CameraCounter, reading["sn"], "camera_count", reading["camera_count"])
+    return reading
+
+
+def parse_rfid_reading(data):
+    """
+    Validate one RFID reading and return it as a plain dict.
+    Raises ReadingError when a field is missing or malformed.
+    """
+    sn = data.get("rfid_sn")
+    rfid_count = data.get("rfid_count")
+    time_stamp = data.get("time_stamp")
+    # multipart/form posts repeat the "tags" field once per EPC
+    epcs = data.getlist("tags") if hasattr(data, "getlist") else data.get("tags", [])
+
+    if _is_missing(sn) or _is_missing(time_stamp) or rfid_count is None:
+        raise ReadingError("Missing fields")
+
+    if not isinstance(epcs, (list, tuple)):
+        raise ReadingError("tags must be a list")
+
+    try:
+        reading = {
+            "sn": str(sn),
+            "rfid_count": int(rfid_count),
+            "time_stamp": datetime.fromisoformat(time_stamp),
+            "tags": list(epcs),
+            "reading_id": _parse_reading_id(data),
+        }
+    except (TypeError, ValueError):
+        raise ReadingError("Invalid rfid_count or time_stamp")
+
+    _check_limits(RFIDCounter, reading["sn"], "rfid_count", reading["rfid_count"])
+    epc_length = RFIDCounter._meta.get_field("tags").base_field.max_length
+    if any(not isinstance(epc, str) or len(epc) > epc_length for epc in reading["tags"]):
+        raise ReadingError(f"tags must be strings of at most {epc_length} characters")
+    return reading
+
+
+def extract_readings(data):
+    """
+    Pull the list of readings out of a batch payload.
+    Accepts a bare JSON array, {"readings": [...]} or a multipart form whose
+    `readings` field holds a JSON-encoded array.
+    """
+    readings = data.get("readings") if hasattr(data, "get") else data
+
+    if isinstance(readings, str):
+        try:
+            readings = json.loads(readings)
+        except ValueError:
+            raise ReadingError("readings must be a JSON array")
+
+    if not isinstance(readings, list) or not readings:
+        raise ReadingError("readings must be a non-empty array")
+
+    return readings
+
+
+_LIVE_TAG_UPSERT = {
+    "update_conflicts": True,
+    "unique_fields": ["epc_code"],
+    "update_fields": ["office", "sn", "last_seen"],
+}
+
+
+def _live_tag_rows(sightings):
+    # ON CONFLICT cannot touch the same row twice in one statement, so keep
+    # only the last sighting of every EPC.
+    latest = {}
+    for epc, office_id, sn, seen_at in sightings:
+        if epc:
+            latest[epc] = LiveRFIDTag(epc_code=epc, office_id=office_id, sn=sn, last_seen=seen_at)
+    # rows in EPC order, so two upserts sharing EPCs lock them in the same
+    # order and cannot deadlock on the unique index
+    return [latest[epc] for epc in sorted(latest)]
+
+
+def upsert_live_tags(sightings):
+    """
+    Record many (epc, office_id, sn, seen_at) sightings with one
+    INSERT ... ON CONFLICT (epc_code) DO UPDATE statement.
+    """
+    rows = _live_tag_rows(sightings)
+    if rows:
+        LiveRFIDTag.objects.bulk_create(rows, **_LIVE_TAG_UPSERT)
+
+
+def update_live_tags(office_id, sn, epcs, seen_at=None):
+    """Mark every EPC in `epcs` as last seen by reader `sn` in `office_id`."""
+    seen_at = seen_at or timezone.now()
+    upsert_live_tags((epc, office_id, sn, seen_at) for epc in epcs)
+
+
+async def aupdate_live_tags(office_id, sn, epcs, seen_at=None):
+    """Async `update_live_tags`, through the async ORM."""
+    seen_at = seen_at or timezone.now()
+    rows = _live_tag_rows((epc, office_id, sn, seen_at) for epc in epcs)
+    if rows:
+        await LiveRFIDTag.objects.abulk_create(rows, **_LIVE_TAG_UPSERT)
+
+
+def _audit_now():
+    """bulk_create skips BaseModel.save, so stamp created_at/updated_at ourselves."""
+    return timezone.now().astimezone(RIYADH_TZ)
+
+
+def _image_value(image):
+    # frames streamed by CameraFrameUploadHandler are in storage already: keep just the name
+    return getattr(image, "stored_name", image)
+
+
+def build_camera_counter(reading, image=None, now=None):
+    now = now or _audit_now()
+    return CameraCounter(
+        created_at=now,
+        updated_at=now,
+        office_id=reading["office_id"],
+        sn=reading["sn"],
+        camera_count=reading["camera_count"],
+        time_stamp=reading["time_stamp"],
+        image=_image_value(image),
+        reading_id=reading.get("reading_id"),
+    )
+
+
+def build_rfid_counter(reading, now=None):
+    now = now or _audit_now()
+    return RFIDCounter(
+        created_at=now,
+        updated_at=now,
+        office_id=reading["office_id"],
+        sn=reading["sn"],
+        rfid_count=reading["rfid_count"],
+        time_stamp=reading["time_stamp"],
+        tags=reading["tags"],
+        reading_id=reading.get("reading_id"),
+    )
+
+
+def _key(sn, reading_id, time_stamp):
+    if timezone.is_naive(time_stamp):
+        time_stamp = timezone.make_aware(time_stamp)
+    return sn, reading_id, time_stamp
+
+
+def save_counters(model, objs, with_ids=True):
+    """
+    Insert counter rows. Rows carrying a reading_id go in with ignore_conflicts,
+    so a retried reading is dropped by the (sn, reading_id, time_stamp)
+    constraint; with `with_ids` their primary keys (the earlier row's, for a
+    retry) are read back in one query.
+    """
+    model.objects.bulk_create([obj for obj in objs if not obj.reading_id])
+    keyed = [obj for obj in objs if obj.reading_id]
+    model.objects.bulk_create(keyed, ignore_conflicts=True)
+    if keyed and with_ids:
+        stored = model.objects.filter(
+            sn__in={obj.sn for obj in keyed},
+            reading_id__in={obj.reading_id for obj in keyed},
+            time_stamp__in={obj.time_stamp for obj in keyed},
+        ).values_list("sn", "reading_id", "time_stamp", "id")
+        ids = {_key(sn, reading_id, time_stamp): pk for sn, reading_id, time_stamp, pk in stored}
+        for obj in keyed:
+            obj.id = ids.get(_key(obj.sn, obj.reading_id, obj.time_stamp))
+    return objs
+
+
+async def asave_counter(obj):
+    """`save_counters` for one row, through the async ORM; returns the row with its id."""
+    model = type(obj)
+    if not obj.reading_id:
+        obj, = await model.objects.abulk_create([obj])
+        return obj
+    await model.objects.abulk_create([obj], ignore_conflicts=True)
+    # the earlier row's id for a retry
+    obj.id = await model.objects.filter(
+        sn=obj.sn, reading_id=obj.reading_id, time_stamp=obj.time_stamp,
+    ).values_list("id", flat=True).afirst()
+    return obj
+
+
+def _store_batch(registry, counter_model, readings, parse, build, max_batch_size, kind, files=None):
+    """
+    Shared skeleton of the batch endpoints: parse every item, resolve all serial
+    numbers through the device registry and bulk insert the accepted items
+    (or push them onto the ingestion buffer in buffered mode).
+
+    Returns (results, created) where `results` holds one status entry per input
+    item (in input order) and `created` pairs each stored reading with its row.
+    """
+    if len(readings) > max_batch_size:
+        raise ReadingError(f"At most {max_batch_size} readings per batch")
+
+    results = [None] * len(readings)
+    parsed = []
+
+    for index, item in enumerate(readings):
+        try:
+            if not isinstance(item, dict):
+                raise ReadingError("Reading must be an object")
+            parsed.append((index, parse(item)))
+        except ReadingError as exc:
+            results[index] = {"index": index, "status": exc.status, "error": exc.message}
+
+    devices = registry.resolve_many([reading["sn"] for _, reading in parsed])
+
+    accepted = []
+    for index, reading in parsed:
+        device = devices.get(reading["sn"])
+        if device is None:
+            results[index] = {"index": index, "status": 404, "error": f"Invalid {registry.label} SN"}
+        elif device.office_id is None:
+            results[index] = {"index": index, "status": 400, "error": "Device is not assigned to an office"}
+        else:
+            reading["office_id"] = device.office_id
+            accepted.append((index, reading))
+
+    # hot retries of readings stored a moment ago are answered from Redis
+    seen = already_seen(kind, [reading for _, reading in accepted])
+    for (index, reading), duplicate in zip(accepted, seen):
+        if duplicate:
+            results[index] = {"index": index, "status": 200, "reading_id": reading["reading_id"], "duplicate": True}
+    accepted = [item for item, duplicate in zip(accepted, seen) if not duplicate]
+
+    if is_buffered():
+        entry_ids = enqueue_readings(
+            kind, [reading for _, reading in accepted],
+            images=[(files or {}).get(f"image_{index}") for index, _ in accepted],
+        )
+        for (index, _), entry_id in zip(accepted, entry_ids):
+            results[index] = {"index": index, "status": 202, "entry_id": entry_id}
+        mark_seen(kind, [reading for _, reading in accepted])
+        return results, []
+
+    objs = save_counters(counter_model, [build(index, reading) for index, reading in accepted])
+    mark_seen(kind, [reading for _, reading in accepted])
+
+    created = []
+    for (index, reading), obj in zip(accepted, objs):
+        results[index] = {"index": index, "status": 201, "id": obj.id}
+        if reading["reading_id"]:
+            results[index]["reading_id"] = reading["reading_id"]
+        created.append((reading, obj))
+
+    return results, created
+
+
+def store_camera_batch(readings, files=None, max_batch_size=500):
+    """
+    Store a batch of camera readings. Images for multipart batches are sent
+    as file fields named `image_<index>`.
+    """
+    files = files or {}
+    now = _audit_now()
+
+    def build(index, reading):
+        return build_camera_counter(reading, image=files.get(f"image_{index}"), now=now)
+
+    results, _ = _store_batch(
+        camera_registry, CameraCounter, readings, parse_camera_reading, build, max_batch_size,
+        kind="camera", files=files,
+    )
+    return results
+
+
+def store_rfid_batch(readings, max_batch_size=500):
+    """Store a batch of RFID readings and refresh the live tag table."""
+    now = _audit_now()
+
+    def build(index, reading):
+        return build_rfid_counter(reading, now=now)
+
+    results, created = _store_batch(
+        rfid_registry, RFIDCounter, readings, parse_rfid_reading, build, max_batch_size,
+        kind="rfid",
+    )
+
+    upsert_live_tags(
+        (epc, reading["office_id"], reading["sn"], now)
+        for reading, _ in created
+        for epc in reading["tags"]
+    )
+
+    return results
+
+
+# ------------------------------------------------------
+# WRITE-BEHIND BUFFER (PILGRIMS_INGESTION_MODE = "buffered")
+# ------------------------------------------------------
+def _stash_image(image):
+    """Save an uploaded frame under counter_image/ now; the consumer only stores its name."""
+    if not image:
+        return None
+    if hasattr(image, "stored_name"):
+        return image.stored_name
+    field = CameraCounter._meta.get_field("image")
+    return default_storage.save(field.generate_filename(None, image.name), image)
+
+
+def _buffer_messages(kind, readings, images=None):
+    received_at = timezone.now().isoformat()
+    images = images or [None] * len(readings)
+
+    messages = []
+    for reading, image in zip(readings, images):
+        message = dict(reading, time_stamp=reading["time_stamp"].isoformat(), received_at=received_at)
+        if kind == "camera":
+            message["image"] = _stash_image(image)
+        messages.append(message)
+    return messages
+
+
+def enqueue_readings(kind, readings, images=None):
+    """
+    Push validated readings (with office_id already resolved) onto the
+    ingestion buffer. Returns one buffer entry id per reading.
+    """
+    return get_buffer().push_many(kind, _buffer_messages(kind, readings, images))
+
+
+async def aenqueue_readings(kind, readings, images=None):
+    """Async `enqueue_readings`: only saving an uploaded frame leaves the event loop."""
+    if images and any(images):
+        messages = await sync_to_async(_buffer_messages)(kind, readings, images)
+    else:
+        messages = _buffer_messages(kind, readings)
+    return await get_buffer().apush_many(kind, messages)
+
+
+def write_buffered_entries(entries):
+    """
+    Bulk insert a batch drained from the ingestion buffer.
+
+    Rows are keyed by (sn, reading_id) and written with ignore_conflicts, so a
+    batch that is delivered again after a consumer crash adds nothing. An
+    entry of the wrong shape raises MalformedEntry.
+    """
+    now = _audit_now()
+    cameras, rfids, sightings = [], [], []
+
+    for entry in entries:
+        check_entry(entry)
+        reading = dict(
+            entry.reading,
+            time_stamp=datetime.fromisoformat(entry.reading["time_stamp"]),
+            # client-supplied id when there is one, else the stream entry id
+            reading_id=entry.reading.get("reading_id") or entry.entry_id,
+        )
+        if entry.kind == "camera":
+            cameras.append(build_camera_counter(reading, image=reading.get("image"), now=now))
+        else:
+            rfids.append(build_rfid_counter(reading, now=now))
+            seen_at = datetime.fromisoformat(reading["received_at"])
+            sightings.extend(
+                (epc, reading["office_id"], reading["sn"], seen_at) for epc in reading["tags"]
+            )
+
+    with transaction.atomic():
+        # nobody waits for these ids
+        save_counters(CameraCounter, cameras, with_ids=False)
+        save_counters(RFIDCounter, rfids, with_ids=False)
+        upsert_live_tags(sightings)
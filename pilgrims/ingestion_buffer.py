@@ -0,0 +1,325 @@
+"""
+Write-behind buffer for counter ingestion.
+
+With PILGRIMS_INGESTION_MODE = "buffered" the ingestion views only validate a
+reading, push it onto the buffer and answer 202. A consumer (the
+`run_ingestion_consumer` command or the `drain_ingestion_buffer` celery task)
+drains the buffer in batches of PILGRIMS_BUFFER_BATCH_SIZE readings, or
+whatever arrived within PILGRIMS_BUFFER_MAX_LAG_MS, and bulk inserts them.
+
+Delivery is at-least-once: entries are acknowledged only after their batch is
+committed, and entries left pending by a dead consumer are reclaimed after
+PILGRIMS_BUFFER_CLAIM_IDLE_MS. Replays are harmless because every buffered
+reading carries a `reading_id` (the client's, else the stream entry id) that
+is unique per device in the counter tables, and rows are written with
+ignore_conflicts.
+
+A batch the database rejects (a value it cannot store, an office deleted
+while the reading waited) or holding a message of the wrong shape
+(`check_entry()`) is written again entry by entry; the entries that still
+fail are moved to a dead-letter stream (`<stream>:dead`) and acknowledged,
+so one bad entry cannot hold up everything behind it.
+"""
+from collections import namedtuple, OrderedDict
+from datetime import datetime
+import json
+import logging
+import threading
+import time
+
+import redis
+from django.conf import settings
+from django.db import DataError, IntegrityError
+
+from .redis_client import get_redis, get_async_redis
+
+logger = logging.getLogger(__name__)
+
+BufferEntry = namedtuple("BufferEntry", ["entry_id", "kind", "reading"])
+
+
+
+class MalformedEntry(Exception):
+    """A buffered message without the fields a reading of its kind needs."""
+
+
+# the fields write_buffered_entries() reads, per kind
+_FIELDS = {
+    "camera": {"sn": str, "office_id": int, "camera_count": int, "time_stamp": str},
+    "rfid": {"sn": str, "office_id": int, "rfid_count": int, "time_stamp": str, "received_at": str, "tags": list},
+}
+
+
+def check_entry(entry):
+    """Raise MalformedEntry unless `entry` holds a reading of its kind."""
+    fields = _FIELDS.get(entry.kind)
+    if fields is None:
+        raise MalformedEntry(f"unknown kind {entry.kind!r}")
+    reading = entry.reading
+    if not isinstance(reading, dict):
+        raise MalformedEntry("reading is not an object")
+    for name, expected in fields.items():
+        if not isinstance(reading.get(name), expected):
+            raise MalformedEntry(f"{name} is missing or not {expected.__name__}")
+    if entry.kind == "rfid" and not all(isinstance(tag, str) for tag in reading["tags"]):
+        raise MalformedEntry("tags must be strings")
+    for name in ("time_stamp", "received_at"):
+        if name in fields:
+            try:
+                datetime.fromisoformat(reading[name])
+            except ValueError:
+                raise MalformedEntry(f"{name} is not an ISO date") from None
+
+
+# what makes one entry unwritable; anything else (the database being down, a
+# bug in the writer) leaves the batch pending and the consumer failing
+_ENTRY_ERRORS = (DataError, IntegrityError, MalformedEntry)
+
+
+class RedisStreamBuffer:
+    """Redis stream + consumer group; shared by every web and consumer process."""
+
+    def __init__(self, stream, group):
+        self.stream = stream
+        self.group = group
+        self._group_ready = False
+
+    def push_many(self, kind, readings):
+        pipe = get_redis().pipeline(transaction=False)
+        for reading in readings:
+            pipe.xadd(self.stream, {"kind": kind, "reading": json.dumps(reading)})
+        return pipe.execute()
+
+    async def apush_many(self, kind, readings):
+        pipe = get_async_redis().pipeline(transaction=False)
+        for reading in readings:
+            pipe.xadd(self.stream, {"kind": kind, "reading": json.dumps(reading)})
+        return await pipe.execute()
+
+    def read(self, consumer, count, block_ms, reclaim=False):
+        self._ensure_group()
+        client = get_redis()
+
+        messages = []
+        if reclaim:
+            # Entries a crashed consumer read but never acknowledged come first.
+            claimed = client.xautoclaim(
+                self.stream, self.group, consumer,
+                min_idle_time=settings.PILGRIMS_BUFFER_CLAIM_IDLE_MS,
+                start_id="0-0", count=count,
+            )
+            messages = [message for message in claimed[1] if message]
+        if not messages:
+            response = client.xreadgroup(
+                self.group, consumer, {self.stream: ">"}, count=count, block=block_ms or None,
+            )
+            messages = response[0][1] if response else []
+
+        return [
+            BufferEntry(entry_id, fields["kind"], json.loads(fields["reading"]))
+            for entry_id, fields in messages
+        ]
+
+    def ack(self, entry_ids):
+        if not entry_ids:
+            return
+        pipe = get_redis().pipeline()
+        pipe.xack(self.stream, self.group, *entry_ids)
+        # acknowledged entries are never needed again; keep the stream short
+        pipe.xdel(self.stream, *entry_ids)
+        pipe.execute()
+
+    def dead_letter(self, failures):
+        """Move (entry, error) pairs to the dead-letter stream and acknowledge them."""
+        if not failures:
+            return
+        pipe = get_redis().pipeline()
+        for entry, error in failures:
+            pipe.xadd(f"{self.stream}:dead", {
+                "entry_id": entry.entry_id, "kind": entry.kind,
+                "reading": json.dumps(entry.reading), "error": error,
+            })
+        entry_ids = [entry.entry_id for entry, _ in failures]
+        pipe.xack(self.stream, self.group, *entry_ids)
+        pipe.xdel(self.stream, *entry_ids)
+        pipe.execute()
+
+    def images(self):
+        """Frame names of the camera readings still queued or dead-lettered."""
+        client = get_redis()
+        for stream in (self.stream, f"{self.stream}:dead"):
+            start = "-"
+            while True:
+                messages = client.xrange(stream, min=start, count=1000)
+                for _, fields in messages:
+                    if fields["kind"] == "camera":
+                        image = json.loads(fields["reading"]).get("image")
+                        if image:
+                            yield image
+                if len(messages) < 1000:
+                    break
+                start = f"({messages[-1][0]}"
+
+    def _ensure_group(self):
+        if self._group_ready:
+            return
+        try:
+            get_redis().xgroup_create(self.stream, self.group, id="0", mkstream=True)
+        except redis.ResponseError as exc:
+            if "BUSYGROUP" not in str(exc):
+                raise
+        self._group_ready = True
+
+
+class LocalBuffer:
+    """In-process stand-in for the Redis stream, used by tests and local runs."""
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._pending = OrderedDict()
+        self.dead = []
+        self._sequence = 0
+        self._lock = threading.Condition()
+
+    def push_many(self, kind, readings):
+        entry_ids = []
+        with self._lock:
+            for reading in readings:
+                self._sequence += 1
+                entry_id = f"{int(time.time() * 1000)}-{self._sequence}"
+                self._entries[entry_id] = BufferEntry(entry_id, kind, json.loads(json.dumps(reading)))
+                entry_ids.append(entry_id)
+            self._lock.notify_all()
+        return entry_ids
+
+    async def apush_many(self, kind, readings):
+        return self.push_many(kind, readings)
+
+    def read(self, consumer, count, block_ms, reclaim=False):
+        with self._lock:
+            if not self._entries and block_ms:
+                self._lock.wait(block_ms / 1000)
+            batch = []
+            while self._entries and len(batch) < count:
+                entry_id, entry = self._entries.popitem(last=False)
+                self._pending[entry_id] = entry
+                batch.append(entry)
+            return batch
+
+    def ack(self, entry_ids):
+        with self._lock:
+            for entry_id in entry_ids:
+                self._pending.pop(entry_id, None)
+
+    def dead_letter(self, failures):
+        with self._lock:
+            for entry, error in failures:
+                self._pending.pop(entry.entry_id, None)
+                self.dead.append((entry, error))
+
+    def images(self):
+        with self._lock:
+            entries = list(self._entries.values()) + list(self._pending.values()) + [entry for entry, _ in self.dead]
+        return [entry.reading["image"] for entry in entries if entry.kind == "camera" and entry.reading.get("image")]
+
+    def requeue_pending(self):
+        """Simulate a consumer crash: unacknowledged entries get delivered again."""
+        with self._lock:
+            self._entries = OrderedDict(list(self._pending.items()) + list(self._entries.items()))
+            self._pending = OrderedDict()
+
+
+_buffer = None
+
+
+def get_buffer():
+    global _buffer
+    if _buffer is None:
+        if settings.PILGRIMS_BUFFER_BACKEND == "local":
+            _buffer = LocalBuffer()
+        else:
+            _buffer = RedisStreamBuffer(settings.PILGRIMS_BUFFER_STREAM, "counter-writers")
+    return _buffer
+
+
+def is_buffered():
+    return settings.PILGRIMS_INGESTION_MODE == "buffered"
+
+
+def collect_batch(buffer, consumer, batch_size=None, max_lag_ms=None):
+    """
+    Read up to `batch_size` entries, waiting at most `max_lag_ms` after the
+    call for the batch to fill up.
+    """
+    batch_size = batch_size or settings.PILGRIMS_BUFFER_BATCH_SIZE
+    max_lag_ms = settings.PILGRIMS_BUFFER_MAX_LAG_MS if max_lag_ms is None else max_lag_ms
+    deadline = time.monotonic() + max_lag_ms / 1000
+
+    entries = []
+    while len(entries) < batch_size:
+        remaining_ms = int((deadline - time.monotonic()) * 1000)
+        if remaining_ms <= 0:
+            break
+        # reclaim abandoned entries once per batch, not on every read
+        chunk = buffer.read(consumer, batch_size - len(entries), remaining_ms, reclaim=not entries)
+        if not chunk and entries:
+            break
+        entries.extend(chunk)
+    return entries
+
+
+def write_isolating(entries):
+    """
+    Write `entries`, isolating the ones the database rejects or that are
+    malformed. Returns (written entries, [(entry, error), ...] not written).
+    """
+    from .ingestion import write_buffered_entries
+
+    try:
+        write_buffered_entries(entries)
+        return entries, []
+    except _ENTRY_ERRORS:
+        logger.warning("Ingestion batch rejected, writing its %d entries one by one", len(entries), exc_info=True)
+
+    written, failures = [], []
+    for entry in entries:
+        try:
+            write_buffered_entries([entry])
+            written.append(entry)
+        except _ENTRY_ERRORS as exc:
+            failures.append((entry, f"{type(exc).__name__}: {exc}"))
+    return written, failures
+
+
+def _write(buffer, entries):
+    """Write `entries`; returns the ones written, the others are dead-lettered."""
+    written, failures = write_isolating(entries)
+    if failures:
+        logger.error("Ingestion buffer: %d entries dead-lettered", len(failures))
+        buffer.dead_letter(failures)
+    return written
+
+
+def drain(consumer, batch_size=None, max_lag_ms=None, buffer=None):
+    """
+    Move one batch from the buffer into the counter tables.
+    Returns the number of entries taken off the buffer (0 when it stayed
+    empty), dead-lettered ones included.
+    """
+    from .stream_join import joining, get_joiner, save_snapshot
+
+    buffer = buffer or get_buffer()
+    received = collect_batch(buffer, consumer, batch_size, max_lag_ms)
+    entries = _write(buffer, received) if received else []
+
+    if joining():
+        # pair the batch into Pilgrim rows, and write the slots that timed out
+        joiner = get_joiner(consumer)
+        joiner.feed_entries(entries)
+        joiner.flush()
+        save_snapshot(consumer, joiner)
+    if not received:
+        return 0
+
+    buffer.ack([entry.entry_id for entry in entries])
+    return len(received)
@@ -0,0 +1,94 @@
+import statistics
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Sum
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from authentication.models import Company, MyUser
+from office.models import Office
+from office.views import DashboardIllegalPilgrims
+from pilgrims.ingestion import _audit_now
+from pilgrims.models import Pilgrim
+
+
+class _Rollback(Exception):
+    pass
+
+
+def _per_office_totals(offices, start, end):
+    # What the dashboard used to cost: three aggregates per office
+    for office in offices:
+        pilgrims = Pilgrim.objects.filter(office=office, time_stamp__range=(start, end))
+        pilgrims.aggregate(total=Sum("camera_count"))
+        pilgrims.aggregate(total=Sum("rfid_count"))
+        pilgrims.aggregate(total=Sum("illegal_pilgrims"))
+
+
+class Command(BaseCommand):
+    help = (
+        "Time the illegal-pilgrims dashboard (one grouped query) against the old "
+        "per-office aggregates. Runs inside a transaction that is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--offices", type=int, nargs="+", default=[100, 500, 1500])
+        parser.add_argument("--minutes", type=int, default=30,
+                            help="Minutes of per-second Pilgrim rows per office (the live window).")
+        parser.add_argument("--repeat", type=int, default=5)
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'offices':>8} {'method':>12} {'median ms':>10} {'queries':>8}")
+        for count in options["offices"]:
+            try:
+                with transaction.atomic():
+                    self._run(count, options["minutes"], options["repeat"])
+                    raise _Rollback
+            except _Rollback:
+                pass
+
+    def _run(self, count, minutes, repeat):
+        now = _audit_now()
+        company = Company.objects.create(name="__benchmark_dashboard__")
+        user = MyUser.objects.create(email="benchmark-dashboard@example.com", username="benchmark",
+                                     company=company, is_admin=True)
+        offices = Office.objects.bulk_create(
+            Office(company=company, name=f"__benchmark_dashboard_{i}__", longitude="0", latitude="0",
+                   created_at=now, updated_at=now)
+            for i in range(count)
+        )
+        end = timezone.now().replace(microsecond=0)
+        start = end - timedelta(minutes=minutes)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {Pilgrim._meta.db_table} (created_at, updated_at, office_id, time_stamp, "
+                f"camera_count, rfid_count, illegal_pilgrims) "
+                f"SELECT %s, %s, o, %s + make_interval(secs => s), 12, 10, 2 "
+                f"FROM unnest(%s::bigint[]) o, generate_series(0, %s - 1) s",
+                [now, now, start, [office.id for office in offices], minutes * 60],
+            )
+            cursor.execute(f"ANALYZE {Pilgrim._meta.db_table}")
+
+        request = APIRequestFactory().get("/office/dashboard/", {
+            "start_date_time": start.isoformat(), "end_date_time": end.isoformat(),
+        })
+        force_authenticate(request, user=user)
+        view = DashboardIllegalPilgrims.as_view()
+
+        for name, run in (
+            ("per-office", lambda: _per_office_totals(offices, start, end)),
+            ("grouped", lambda: view(request)),
+        ):
+            timings = []
+            for _ in range(repeat):
+                # the query log is capped: start each run with an empty one
+                connection.queries_log.clear()
+                with CaptureQueriesContext(connection) as queries:
+                    started = time.perf_counter()
+                    run()
+                    timings.append((time.perf_counter() - started) * 1000)
+            self.stdout.write(f"{count:>8} {name:>12} {statistics.median(timings):>10.1f} {len(queries):>8}")
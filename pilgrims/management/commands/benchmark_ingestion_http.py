@@ -0,0 +1,114 @@
+import asyncio
+import json
+import statistics
+import time
+from datetime import datetime
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand
+
+
+async def _read_response(reader):
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("connection closed by server")
+
+    length, keep_alive = 0, True
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        name, value = name.strip().lower(), value.strip().lower()
+        if name == "content-length":
+            length = int(value)
+        elif name == "connection" and value == "close":
+            keep_alive = False
+
+    await reader.readexactly(length)
+    return int(status_line.split()[1]), keep_alive
+
+
+async def _client(url, body, requests, latencies, failures):
+    # One simulated reader: a single HTTP/1.1 connection posting back to back,
+    # reconnecting whenever the server closes it (gunicorn sync workers do).
+    parts = urlsplit(url)
+    host, port = parts.hostname, parts.port or 80
+    request = (
+        f"POST {parts.path} HTTP/1.1\r\n"
+        f"Host: {host}\r\n"
+        "Content-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n\r\n"
+    ).encode() + body
+
+    reader = writer = None
+    for _ in range(requests):
+        started = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+            writer.write(request)
+            await writer.drain()
+            status, keep_alive = await _read_response(reader)
+        except (OSError, ConnectionError, asyncio.IncompleteReadError):
+            failures.append("connection")
+            writer = None
+            continue
+
+        latencies.append((time.perf_counter() - started) * 1000)
+        if status not in (201, 202):
+            failures.append(status)
+        if not keep_alive:
+            writer.close()
+            writer = None
+
+    if writer is not None:
+        writer.close()
+
+
+class Command(BaseCommand):
+    help = (
+        "HTTP load generator for the RFID ingestion endpoints. Run it once against the "
+        "sync view under gunicorn (/pilgrims/rfid-counter/) and once against the async "
+        "view under uvicorn (/pilgrims/async/rfid-counter/) to compare them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("url", help="e.g. http://127.0.0.1:8000/pilgrims/async/rfid-counter/")
+        parser.add_argument("--sn", required=True, help="Serial number of an existing RFID reader.")
+        parser.add_argument("--concurrency", type=int, default=200, help="Simultaneous reader connections.")
+        parser.add_argument("--requests", type=int, default=20, help="Posts per connection.")
+        parser.add_argument("--tags", type=int, default=50, help="EPCs per reading.")
+
+    def handle(self, *args, **options):
+        body = json.dumps({
+            "rfid_sn": options["sn"],
+            "rfid_count": options["tags"],
+            "time_stamp": datetime.now().replace(microsecond=0).isoformat(),
+            "tags": [f"BENCH{i:019d}" for i in range(options["tags"])],
+        }).encode()
+
+        latencies, failures = [], []
+        started = time.perf_counter()
+        asyncio.run(self._run(options, body, latencies, failures))
+        elapsed = time.perf_counter() - started
+
+        if not latencies:
+            self.stderr.write(f"No successful requests ({len(failures)} failures)")
+            return
+
+        latencies.sort()
+        percentile = lambda p: latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+        self.stdout.write(
+            f"{options['url']} concurrency={options['concurrency']}\n"
+            f"  requests:  {len(latencies)} ok, {len(failures)} failed\n"
+            f"  rate:      {len(latencies) / elapsed:.1f} req/s over {elapsed:.2f} s\n"
+            f"  latency:   p50 {statistics.median(latencies):.1f} ms, "
+            f"p95 {percentile(0.95):.1f} ms, p99 {percentile(0.99):.1f} ms"
+        )
+
+    async def _run(self, options, body, latencies, failures):
+        await asyncio.gather(*(
+            _client(options["url"], body, options["requests"], latencies, failures)
+            for _ in range(options["concurrency"])
+        ))
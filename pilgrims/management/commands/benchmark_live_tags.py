@@ -0,0 +1,78 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from office.models import Office
+from pilgrims.ingestion import update_live_tags
+from pilgrims.models import LiveRFIDTag
+
+
+class _Rollback(Exception):
+    pass
+
+
+class _QueryCounter:
+    """connection.execute_wrapper hook counting database round-trips."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def _legacy_update(office, sn, epcs, now):
+    # The per-EPC loop the RFID views used before the set-based upsert.
+    for epc in epcs:
+        LiveRFIDTag.objects.update_or_create(
+            epc_code=epc,
+            defaults={"office": office, "sn": sn, "last_seen": now},
+        )
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the legacy per-EPC update_or_create loop with the single "
+        "INSERT ... ON CONFLICT upsert. Runs inside a transaction that is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--tags", type=int, nargs="+", default=[10, 100, 400, 1000])
+        parser.add_argument("--repeat", type=int, default=5)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self._run(options["tags"], options["repeat"])
+                raise _Rollback
+        except _Rollback:
+            pass
+
+    def _run(self, tag_counts, repeat):
+        office = Office.objects.create(name="__benchmark_live_tags__", longitude="0", latitude="0")
+
+        self.stdout.write(f"{'tags':>6} {'method':>8} {'queries':>8} {'median ms':>10}")
+        for count in tag_counts:
+            # first pass inserts, the timed passes exercise the update path
+            epcs = [f"BENCH{count:05d}{i:019d}" for i in range(count)]
+            update_live_tags(office.id, "BENCH", epcs)
+
+            for name, run in (
+                ("legacy", lambda now: _legacy_update(office, "BENCH", epcs, now)),
+                ("upsert", lambda now: update_live_tags(office.id, "BENCH", epcs, now)),
+            ):
+                timings = []
+                for _ in range(repeat):
+                    queries = _QueryCounter()
+                    with connection.execute_wrapper(queries):
+                        started = time.perf_counter()
+                        run(timezone.now())
+                        timings.append((time.perf_counter() - started) * 1000)
+
+                self.stdout.write(
+                    f"{count:>6} {name:>8} {queries.count:>8} {statistics.median(timings):>10.2f}"
+                )
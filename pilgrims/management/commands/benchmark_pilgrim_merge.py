@@ -0,0 +1,90 @@
+import statistics
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from office.models import Office
+from pilgrims.ingestion import _audit_now
+from pilgrims.models import CameraCounter, RFIDCounter, Pilgrim
+from pilgrims.tasks import merge_window
+
+
+class _Rollback(Exception):
+    pass
+
+
+def _per_office_merge(offices, target_ts):
+    # What a correct ORM version of the old merge costs: two lookups and an
+    # insert per office, every second.
+    for office in offices:
+        camera = CameraCounter.objects.filter(office=office, time_stamp=target_ts).order_by("-id").first()
+        rfid = RFIDCounter.objects.filter(office=office, time_stamp=target_ts).order_by("-id").first()
+        if not camera and not rfid:
+            continue
+        camera_count = camera.camera_count if camera else None
+        rfid_count = rfid.rfid_count if rfid else None
+        illegal = max(camera_count - rfid_count, 0) if camera and rfid else 0
+        Pilgrim.objects.create(
+            office=office, time_stamp=target_ts, camera_count=camera_count, rfid_count=rfid_count,
+            illegal_pilgrims=illegal, image=camera.image if camera and illegal > 0 else None,
+        )
+
+
+class Command(BaseCommand):
+    help = (
+        "Time the set-based Pilgrim merge against a per-office ORM loop for one second "
+        "of readings. Runs inside a transaction that is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--offices", type=int, nargs="+", default=[1, 100, 2000])
+        parser.add_argument("--history", type=int, default=60,
+                            help="Seconds of older readings per office already in the tables.")
+        parser.add_argument("--repeat", type=int, default=5)
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'offices':>8} {'method':>12} {'median ms':>10} {'rows':>6}")
+        for count in options["offices"]:
+            try:
+                with transaction.atomic():
+                    self._run(count, options["history"], options["repeat"])
+                    raise _Rollback
+            except _Rollback:
+                pass
+
+    def _run(self, count, history, repeat):
+        now = _audit_now()
+        offices = Office.objects.bulk_create(
+            Office(name=f"__benchmark_merge_{i}__", longitude="0", latitude="0", created_at=now, updated_at=now)
+            for i in range(count)
+        )
+        base = timezone.now().replace(microsecond=0) - timedelta(seconds=history + repeat * 2)
+        seconds = [base + timedelta(seconds=i) for i in range(history + repeat * 2)]
+
+        cameras, rfids = [], []
+        for office in offices:
+            for second in seconds:
+                cameras.append(CameraCounter(office=office, sn=f"C{office.id}", camera_count=12,
+                                             time_stamp=second, created_at=now, updated_at=now))
+                rfids.append(RFIDCounter(office=office, sn=f"R{office.id}", rfid_count=10, tags=[],
+                                         time_stamp=second, created_at=now, updated_at=now))
+        CameraCounter.objects.bulk_create(cameras, batch_size=5000)
+        RFIDCounter.objects.bulk_create(rfids, batch_size=5000)
+
+        targets = iter(seconds[history:])
+        for name, merge in (
+            ("per-office", lambda ts: _per_office_merge(offices, ts)),
+            ("set-based", lambda ts: merge_window(ts, ts + timedelta(seconds=1))),
+        ):
+            timings, rows = [], 0
+            for _ in range(repeat):
+                target_ts = next(targets)
+                started = time.perf_counter()
+                with transaction.atomic():
+                    merge(target_ts)
+                timings.append((time.perf_counter() - started) * 1000)
+                rows = Pilgrim.objects.filter(time_stamp=target_ts, office__in=offices).count()
+            self.stdout.write(f"{count:>8} {name:>12} {statistics.median(timings):>10.1f} {rows:>6}")
@@ -0,0 +1,84 @@
+import io
+import json
+import time
+import zlib
+from datetime import datetime
+
+from django.core.files.uploadhandler import MemoryFileUploadHandler
+from django.core.management.base import BaseCommand
+from django.http.multipartparser import MultiPartParser
+from django.test.client import BOUNDARY, MULTIPART_CONTENT, encode_multipart
+from django.utils import timezone
+from rest_framework.parsers import JSONParser
+
+from pilgrims.parsers import RFIDFrameParser
+from pilgrims.rfid_frames import encode_frames
+
+
+class _Request:
+    def __init__(self, encoding=""):
+        self.META = {"HTTP_CONTENT_ENCODING": encoding}
+
+
+def _per_reading_us(parse, rounds):
+    started = time.process_time()
+    for _ in range(rounds):
+        parse()
+    return (time.process_time() - started) / rounds * 1e6
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare bytes on the wire and parser CPU per reading for the multipart, JSON "
+        "and binary (application/x-rfid-frames) RFID encodings."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--tags", type=int, nargs="+", default=[10, 50, 100, 400])
+        parser.add_argument("--rounds", type=int, default=500)
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'tags':>5} {'encoding':>16} {'bytes':>8} {'parse us':>9}")
+        for count in options["tags"]:
+            for name, size, us in self._measure(count, options["rounds"]):
+                self.stdout.write(f"{count:>5} {name:>16} {size:>8} {us:>9.1f}")
+
+    def _measure(self, count, rounds):
+        now = timezone.now().replace(microsecond=0)
+        epcs = [f"E2801160{i:016X}" for i in range(count)]
+        reading = {
+            "rfid_sn": "READER-0001",
+            "rfid_count": count,
+            "time_stamp": datetime.now().replace(microsecond=0).isoformat(),
+            "tags": epcs,
+        }
+
+        multipart = encode_multipart(BOUNDARY, reading)
+        json_body = json.dumps(reading).encode()
+        json_deflated = zlib.compress(json_body)
+        frame = encode_frames([(reading["rfid_sn"], now, epcs)])
+        frame_deflated = encode_frames([(reading["rfid_sn"], now, epcs)], compress=True)
+
+        def parse_multipart():
+            meta = {"CONTENT_TYPE": MULTIPART_CONTENT, "CONTENT_LENGTH": len(multipart)}
+            MultiPartParser(meta, io.BytesIO(multipart), [MemoryFileUploadHandler()]).parse()
+
+        def parse_json():
+            JSONParser().parse(io.BytesIO(json_body))
+
+        def parse_json_deflated():
+            JSONParser().parse(io.BytesIO(zlib.decompress(json_deflated)))
+
+        def parse_frame():
+            RFIDFrameParser().parse(io.BytesIO(frame), parser_context={"request": _Request()})
+
+        def parse_frame_deflated():
+            RFIDFrameParser().parse(io.BytesIO(frame_deflated), parser_context={"request": _Request("deflate")})
+
+        return [
+            ("multipart", len(multipart), _per_reading_us(parse_multipart, rounds)),
+            ("json", len(json_body), _per_reading_us(parse_json, rounds)),
+            ("json+deflate", len(json_deflated), _per_reading_us(parse_json_deflated, rounds)),
+            ("binary", len(frame), _per_reading_us(parse_frame, rounds)),
+            ("binary+deflate", len(frame_deflated), _per_reading_us(parse_frame_deflated, rounds)),
+        ]
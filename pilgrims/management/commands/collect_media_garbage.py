@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from pilgrims.media_gc import collect_garbage
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete camera frames under counter_image/ that no CameraCounter or Pilgrim row "
+        "references, once untouched for the grace period. The collect_media_garbage beat "
+        "task does the same every hour."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--grace-seconds", type=int, default=settings.PILGRIMS_MEDIA_GC_GRACE_SECONDS)
+        parser.add_argument("--batch-size", type=int, default=settings.PILGRIMS_MEDIA_GC_BATCH)
+        parser.add_argument("--dry-run", action="store_true", help="Only report what would be deleted.")
+
+    def handle(self, *args, **options):
+        report = collect_garbage(options["grace_seconds"], options["batch_size"], options["dry_run"])
+        verb = "would delete" if options["dry_run"] else "deleted"
+        self.stdout.write(
+            f"scanned {report['scanned']} files, {report['orphaned']} unreferenced, "
+            f"{verb} {report['deleted']} ({report['bytes'] / 1024 / 1024:.1f} MB)"
+        )
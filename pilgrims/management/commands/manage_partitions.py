@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from pilgrims.partitions import maintain_partitions
+
+
+class Command(BaseCommand):
+    help = (
+        "Create the daily partitions of the counter and Pilgrim tables for the coming days "
+        "and detach (or drop) the ones past retention. The manage_partitions beat task "
+        "does the same every hour."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--premake-days", type=int, default=settings.PILGRIMS_PARTITION_PREMAKE_DAYS)
+        parser.add_argument("--retention-days", type=int, default=settings.PILGRIMS_PARTITION_RETENTION_DAYS,
+                            help="Expire partitions older than this many days (0 keeps everything).")
+        parser.add_argument("--drop", action="store_true",
+                            default=settings.PILGRIMS_PARTITION_EXPIRED_ACTION == "drop",
+                            help="Drop expired partitions instead of detaching them.")
+
+    def handle(self, *args, **options):
+        created, expired = maintain_partitions(
+            options["premake_days"], options["retention_days"], options["drop"],
+        )
+        for name in created:
+            self.stdout.write(f"created {name}")
+        for name in expired:
+            self.stdout.write(f"{'dropped' if options['drop'] else 'detached'} {name}")
+        self.stdout.write(self.style.SUCCESS(f"{len(created)} created, {len(expired)} expired"))
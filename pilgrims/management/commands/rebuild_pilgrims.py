@@ -0,0 +1,130 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date, datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+
+from office.models import Office
+from pilgrims.buckets import lock_offices, refresh_buckets
+from pilgrims.models import Pilgrim, MergeWatermark
+from pilgrims.rollups import rolled_up_until
+from pilgrims.tasks import merge_window, saudi_tz
+
+
+def _mark_name(day, office_ids):
+    # one watermark per finished shard; what --resume skips
+    return f"rebuild:{day.isoformat()}:{office_ids[0]}-{office_ids[-1]}:{len(office_ids)}"
+
+
+def _rebuild_shard(day, office_ids):
+    """
+    Delete and recompute the Pilgrim rows of `office_ids` for one Riyadh day,
+    in one transaction that also records the shard as done. The part of the
+    day before the rollup horizon is left alone.
+    """
+    start = saudi_tz.localize(datetime.combine(day, datetime.min.time()))
+    end = saudi_tz.localize(datetime.combine(day + timedelta(days=1), datetime.min.time()))
+    started = time.perf_counter()
+    rows = 0
+    try:
+        with transaction.atomic():
+            # the readings behind the horizon are rolled up and gone: the
+            # Pilgrim rows left there are the only record of their frames
+            horizon = rolled_up_until()
+            if horizon is not None:
+                start = max(start, horizon)
+            if start < end:
+                lock_offices(office_ids)
+                Pilgrim.objects.filter(office_id__in=office_ids, time_stamp__gte=start, time_stamp__lt=end).delete()
+                rows = merge_window(start, end, office_ids)
+                # the deleted rows were never taken out of the buckets: recount
+                refresh_buckets(start, end, office_ids)
+            MergeWatermark.objects.update_or_create(name=_mark_name(day, office_ids), defaults={"merged_until": end})
+    finally:
+        connections.close_all()
+    return rows, time.perf_counter() - started
+
+
+def _init_worker():
+    # the parent's connections were closed before forking: every worker
+    # opens its own on first use
+    connections.close_all()
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild Pilgrim rows from CameraCounter/RFIDCounter for a range of days. The range "
+        "is split into (day, office group) shards run in a process pool; an interrupted "
+        "run picks up where it stopped when started again with the same arguments. "
+        "History already rolled up (PILGRIMS_ROLLUP_AFTER_DAYS) is not rebuilt."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--from", dest="from_day", type=date.fromisoformat, required=True,
+                            help="First day (YYYY-MM-DD, Asia/Riyadh).")
+        parser.add_argument("--to", dest="to_day", type=date.fromisoformat, required=True,
+                            help="Last day, inclusive.")
+        parser.add_argument("--offices", type=int, nargs="+",
+                            help="Office ids to rebuild (default: all offices).")
+        parser.add_argument("--offices-per-shard", type=int, default=50)
+        parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+        parser.add_argument("--restart", action="store_true",
+                            help="Forget the shards a previous interrupted run finished.")
+
+    def handle(self, *args, **options):
+        if options["to_day"] < options["from_day"]:
+            raise CommandError("--to is before --from")
+
+        office_ids = sorted(options["offices"] or Office.objects.values_list("id", flat=True))
+        if not office_ids:
+            raise CommandError("No offices to rebuild")
+
+        size = options["offices_per_shard"]
+        groups = [office_ids[i:i + size] for i in range(0, len(office_ids), size)]
+        days = [options["from_day"] + timedelta(days=i)
+                for i in range((options["to_day"] - options["from_day"]).days + 1)]
+        horizon = rolled_up_until()
+        first = saudi_tz.localize(datetime.combine(options["from_day"], datetime.min.time()))
+        if horizon is not None and first < horizon:
+            self.stdout.write(self.style.WARNING(
+                f"Counter history before {horizon.astimezone(saudi_tz):%Y-%m-%d %H:%M} is rolled up; "
+                "its Pilgrim rows are kept as they are"
+            ))
+        shards = [(day, group) for day in days for group in groups]
+        names = [_mark_name(day, group) for day, group in shards]
+
+        if options["restart"]:
+            MergeWatermark.objects.filter(name__in=names).delete()
+        done = set(MergeWatermark.objects.filter(name__in=names).values_list("name", flat=True))
+        todo = [shard for shard, name in zip(shards, names) if name not in done]
+        self.stdout.write(
+            f"{len(shards)} shards ({len(days)} days x {len(groups)} office groups), "
+            f"{len(done)} already done, {options['workers']} workers"
+        )
+
+        started = time.perf_counter()
+        total_rows = 0
+        connections.close_all()
+        with ProcessPoolExecutor(
+            max_workers=options["workers"],
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_worker,
+        ) as pool:
+            futures = {pool.submit(_rebuild_shard, day, group): (day, group) for day, group in todo}
+            for finished, future in enumerate(as_completed(futures), len(done) + 1):
+                day, group = futures[future]
+                rows, seconds = future.result()
+                total_rows += rows
+                self.stdout.write(
+                    f"[{finished}/{len(shards)}] {day} offices {group[0]}-{group[-1]}: "
+                    f"{rows} rows in {seconds:.1f}s"
+                )
+
+        # the whole range is rebuilt: nothing left to resume
+        MergeWatermark.objects.filter(name__in=names).delete()
+        self.stdout.write(self.style.SUCCESS(
+            f"Rebuilt {total_rows} Pilgrim rows in {time.perf_counter() - started:.1f}s"
+        ))
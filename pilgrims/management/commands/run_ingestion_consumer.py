@@ -0,0 +1,48 @@
+import logging
+import socket
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from pilgrims.ingestion_buffer import drain
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Drain the write-behind ingestion buffer into CameraCounter/RFIDCounter "
+        "(PILGRIMS_INGESTION_MODE = buffered). Several consumers can run side by side."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--consumer", default=socket.gethostname(),
+                            help="Consumer name inside the stream's consumer group. Keep it stable across "
+                                 "restarts (the stream joiner's snapshot is kept under it) and give each "
+                                 "consumer on a host its own.")
+        parser.add_argument("--batch-size", type=int, default=settings.PILGRIMS_BUFFER_BATCH_SIZE)
+        parser.add_argument("--max-lag-ms", type=int, default=settings.PILGRIMS_BUFFER_MAX_LAG_MS)
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            f"Consumer {options['consumer']}: batches of {options['batch_size']} "
+            f"or every {options['max_lag_ms']} ms"
+        )
+        written = 0
+        try:
+            while True:
+                close_old_connections()
+                try:
+                    count = drain(options["consumer"], options["batch_size"], options["max_lag_ms"])
+                except Exception:
+                    # Redis or the database away: the batch stays pending, try again
+                    logger.exception("Draining the ingestion buffer failed")
+                    time.sleep(1)
+                    continue
+                written += count
+                if count:
+                    self.stdout.write(f"wrote {count} readings ({written} total)")
+        except KeyboardInterrupt:
+            self.stdout.write(f"Stopped after {written} readings")
@@ -0,0 +1,45 @@
+import asyncio
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pilgrims.rfid_listener import RFIDListener
+
+
+class Command(BaseCommand):
+    help = (
+        "Accept RFID reader reports over raw TCP (one report per line) and/or UDP "
+        "(one datagram per report batch), aggregate them per reader per second and "
+        "store them like /pilgrims/rfid-counter/ does."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="0.0.0.0")
+        parser.add_argument("--tcp-port", type=int, help="Listen for line-delimited reports on this TCP port.")
+        parser.add_argument("--udp-port", type=int, help="Listen for report datagrams on this UDP port.")
+        parser.add_argument("--flush-interval", type=float, default=1.0, help="Seconds between flushes.")
+        parser.add_argument("--grace", type=float, default=1.0,
+                            help="Seconds a closed second stays open for late reports.")
+
+    def handle(self, *args, **options):
+        if options["tcp_port"] is None and options["udp_port"] is None:
+            raise CommandError("Give --tcp-port, --udp-port or both")
+
+        listener = RFIDListener(
+            host=options["host"],
+            tcp_port=options["tcp_port"],
+            udp_port=options["udp_port"],
+            flush_interval=options["flush_interval"],
+            grace=options["grace"],
+        )
+        self.stdout.write(
+            f"RFID listener on {options['host']} "
+            f"tcp={options['tcp_port'] or '-'} udp={options['udp_port'] or '-'}"
+        )
+        try:
+            asyncio.run(listener.serve_forever())
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(
+            f"Stopped: {listener.aggregator.reports} reports, {listener.aggregator.rejected} rejected, "
+            f"{listener.stored} readings stored, {listener.failed} failed"
+        )
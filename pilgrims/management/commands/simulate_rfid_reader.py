@@ -0,0 +1,67 @@
+import asyncio
+import json
+import random
+import socket
+import time
+
+from django.core.management.base import BaseCommand
+
+
+def _report(sn, epcs, fmt):
+    if fmt == "json":
+        return json.dumps({"rfid_sn": sn, "rfid_count": len(epcs), "tags": epcs})
+    return ",".join([sn] + epcs)
+
+
+async def _tcp_reader(host, port, sn, options, sent):
+    _, writer = await asyncio.open_connection(host, port)
+    population = [f"E2801160{random.getrandbits(64):016X}" for _ in range(options["population"])]
+    try:
+        for _ in range(options["reports"]):
+            epcs = random.sample(population, min(options["tags"], len(population)))
+            writer.write((_report(sn, epcs, options["format"]) + "\n").encode())
+            await writer.drain()
+            sent.append(1)
+            await asyncio.sleep(options["interval"])
+    finally:
+        writer.close()
+
+
+async def _udp_reader(host, port, sn, options, sent):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    population = [f"E2801160{random.getrandbits(64):016X}" for _ in range(options["population"])]
+    try:
+        for _ in range(options["reports"]):
+            epcs = random.sample(population, min(options["tags"], len(population)))
+            sock.sendto(_report(sn, epcs, options["format"]).encode(), (host, port))
+            sent.append(1)
+            await asyncio.sleep(options["interval"])
+    finally:
+        sock.close()
+
+
+class Command(BaseCommand):
+    help = "Simulate RFID readers streaming tag reports to run_rfid_listener."
+
+    def add_arguments(self, parser):
+        parser.add_argument("host")
+        parser.add_argument("port", type=int)
+        parser.add_argument("--udp", action="store_true", help="Send datagrams instead of TCP lines.")
+        parser.add_argument("--sn", nargs="+", required=True, help="Serial numbers of the simulated readers.")
+        parser.add_argument("--reports", type=int, default=10, help="Reports per reader.")
+        parser.add_argument("--interval", type=float, default=0.2, help="Seconds between reports.")
+        parser.add_argument("--tags", type=int, default=20, help="EPCs per report.")
+        parser.add_argument("--population", type=int, default=100, help="Distinct EPCs around each reader.")
+        parser.add_argument("--format", choices=["json", "text"], default="text")
+
+    def handle(self, *args, **options):
+        client = _udp_reader if options["udp"] else _tcp_reader
+        sent = []
+        started = time.perf_counter()
+        asyncio.run(self._run(client, options, sent))
+        self.stdout.write(f"sent {len(sent)} reports in {time.perf_counter() - started:.2f} s")
+
+    async def _run(self, client, options, sent):
+        await asyncio.gather(*(
+            client(options["host"], options["port"], sn, options, sent) for sn in options["sn"]
+        ))
@@ -0,0 +1,174 @@
+"""
+Tolerance-window pairing of camera and RFID readings.
+
+A camera and a reader whose clocks are a second apart never produce the
+same time_stamp, so exact matching leaves both halves unpaired. With
+PILGRIMS_MATCH_TOLERANCE_SECONDS = N the merge pairs each camera reading
+with the closest unused RFID reading of its office within ±N seconds and
+records the offset (RFID second - camera second) on the Pilgrim row.
+"""
+from datetime import datetime, timezone as dt_timezone
+from itertools import groupby
+
+from django.db import connection
+
+from .models import CameraCounter, RFIDCounter, Pilgrim
+from .buckets import apply_deltas
+from .stream_join import upsert_pilgrims
+
+_LATEST_SQL = """
+SELECT DISTINCT ON (office_id, date_trunc('second', time_stamp))
+       office_id, extract(epoch FROM date_trunc('second', time_stamp))::bigint, {columns}
+FROM {table}
+WHERE time_stamp >= %s AND time_stamp < %s {offices}
+ORDER BY office_id, date_trunc('second', time_stamp), id DESC
+"""
+
+# rows fetched per round trip from the server-side cursors
+_FETCH_ROWS = 2000
+
+
+def match(cameras, rfids, tolerance):
+    """
+    Pair camera readings (second, count, image) with RFID readings
+    (second, count); both lists sorted by second, at most one per second.
+
+    Exact pairs are taken first so a neighbour never steals them; then each
+    remaining camera reading takes the closest unused RFID reading within
+    ±tolerance (the earlier one on a tie). Two pointers walk the lists, so
+    the cost is O(len(cameras) * tolerance + len(rfids)).
+
+    Yields (second, camera_count, image, rfid_count, offset) rows; unpaired
+    readings come out with None on the missing side.
+    """
+    paired = [None] * len(cameras)
+    used = [False] * len(rfids)
+
+    j = 0
+    for i, (second, _, _) in enumerate(cameras):
+        while j < len(rfids) and rfids[j][0] < second:
+            j += 1
+        if j < len(rfids) and rfids[j][0] == second:
+            paired[i], used[j] = j, True
+
+    if tolerance:
+        j = 0
+        for i, (second, _, _) in enumerate(cameras):
+            if paired[i] is not None:
+                continue
+            while j < len(rfids) and rfids[j][0] < second - tolerance:
+                j += 1
+            best = None
+            k = j
+            while k < len(rfids) and rfids[k][0] <= second + tolerance:
+                if not used[k] and (best is None or abs(rfids[k][0] - second) < abs(rfids[best][0] - second)):
+                    best = k
+                k += 1
+            if best is not None:
+                paired[i], used[best] = best, True
+
+    for (second, camera_count, image), k in zip(cameras, paired):
+        if k is None:
+            yield second, camera_count, image, None, None
+        else:
+            yield second, camera_count, image, rfids[k][1], rfids[k][0] - second
+
+    for (second, rfid_count), taken in zip(rfids, used):
+        if not taken:
+            yield second, None, None, rfid_count, None
+
+
+def _latest_per_second(model, columns, start, end, office_ids):
+    offices = "AND office_id = ANY(%s)" if office_ids else ""
+    params = [start, end] + ([list(office_ids)] if office_ids else [])
+    # a server-side cursor, so a catch-up window is never held whole in memory
+    with connection.chunked_cursor() as cursor:
+        cursor.execute(
+            _LATEST_SQL.format(columns=columns, table=model._meta.db_table, offices=offices), params,
+        )
+        while True:
+            rows = cursor.fetchmany(_FETCH_ROWS)
+            if not rows:
+                return
+            yield from rows
+
+
+def matched_rows(start, end, tolerance, office_ids=None):
+    """
+    Pilgrim rows (office_id, time_stamp, camera_count, rfid_count, image,
+    match_offset) for every second in [start, end), and the (office_id,
+    time_stamp) of the RFID readings in the window that were paired with a
+    camera reading at another second. Readings up to `tolerance` seconds
+    outside the window are read too, so pairs across the window edges come
+    out the same whichever window computes them.
+    """
+    lo = start.timestamp() - tolerance
+    hi = end.timestamp() + tolerance
+    lo_ts = datetime.fromtimestamp(lo, dt_timezone.utc)
+    hi_ts = datetime.fromtimestamp(hi, dt_timezone.utc)
+
+    cameras = groupby(
+        _latest_per_second(CameraCounter, "camera_count, NULLIF(image, '')", lo_ts, hi_ts, office_ids),
+        key=lambda row: row[0],
+    )
+    rfids = groupby(
+        _latest_per_second(RFIDCounter, "rfid_count", lo_ts, hi_ts, office_ids),
+        key=lambda row: row[0],
+    )
+
+    # both cursors are ordered by office: walk them side by side
+    camera_office, camera_group = next(cameras, (None, None))
+    rfid_office, rfid_group = next(rfids, (None, None))
+    start_s, end_s = start.timestamp(), end.timestamp()
+
+    rows, absorbed = [], []
+    while camera_office is not None or rfid_office is not None:
+        if rfid_office is None or (camera_office is not None and camera_office < rfid_office):
+            office_id, office_cameras, office_rfids = camera_office, list(camera_group), []
+            camera_office, camera_group = next(cameras, (None, None))
+        elif camera_office is None or rfid_office < camera_office:
+            office_id, office_cameras, office_rfids = rfid_office, [], list(rfid_group)
+            rfid_office, rfid_group = next(rfids, (None, None))
+        else:
+            office_id, office_cameras, office_rfids = camera_office, list(camera_group), list(rfid_group)
+            camera_office, camera_group = next(cameras, (None, None))
+            rfid_office, rfid_group = next(rfids, (None, None))
+
+        pairs = match(
+            [(second, count, image) for _, second, count, image in office_cameras],
+            [(second, count) for _, second, count in office_rfids],
+            tolerance,
+        )
+        for second, camera_count, image, rfid_count, offset in pairs:
+            if start_s <= second < end_s:
+                rows.append((office_id, datetime.fromtimestamp(second, dt_timezone.utc),
+                             camera_count, rfid_count, image, offset))
+            if offset and start_s <= second + offset < end_s:
+                absorbed.append((office_id, datetime.fromtimestamp(second + offset, dt_timezone.utc)))
+    return rows, absorbed
+
+
+def write_matched(start, end, tolerance, now, office_ids=None):
+    """
+    Upsert the matched rows of [start, end) and delete the RFID-only rows an
+    earlier pass wrote for readings that now belong to a neighbouring second,
+    taking both out of the buckets. Returns the number of rows written.
+    """
+    rows, absorbed = matched_rows(start, end, tolerance, office_ids)
+    # the pairs are recomputed from every reading: a side paired elsewhere
+    # since the last pass must leave its old row, not be kept by COALESCE
+    written = upsert_pilgrims(rows, now, overwrite=True)
+    if absorbed:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM {Pilgrim._meta.db_table} p "
+                "USING unnest(%s::bigint[], %s::timestamptz[]) AS a(office_id, time_stamp) "
+                "WHERE p.office_id = a.office_id AND p.time_stamp = a.time_stamp AND p.camera_count IS NULL "
+                "RETURNING p.office_id, p.time_stamp, p.rfid_count, p.illegal_pilgrims",
+                [[office_id for office_id, _ in absorbed], [ts for _, ts in absorbed]],
+            )
+            apply_deltas(
+                (office_id, time_stamp, 0, -(rfid_count or 0), -(illegal_pilgrims or 0))
+                for office_id, time_stamp, rfid_count, illegal_pilgrims in cursor.fetchall()
+            )
+    return written
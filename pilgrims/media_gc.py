@@ -0,0 +1,135 @@
+"""
+Deferred garbage collection of camera frames.
+
+Frames land under counter_image/ when they are uploaded, whether or not a
+CameraCounter row ends up pointing at them (a rejected or coalesced reading,
+a buffered reading still queued), and stay there after the rows that used
+them are deleted (see pilgrims/rollups.py). `collect_garbage()` (the
+`collect_media_garbage` beat task and management command) diffs the files
+against every CameraCounter.image and Pilgrim.image reference and deletes
+the unreferenced ones in batches:
+
+- only files untouched for PILGRIMS_MEDIA_GC_GRACE_SECONDS are considered,
+  so an upload whose row is not written yet is left alone; an upload that
+  reuses an existing frame touches it (pilgrims/uploads.py);
+- frames of readings not written yet, however old, are kept: with buffered
+  ingestion the ones queued or dead-lettered on the ingestion buffer and
+  held in stream joiner snapshots are read from Redis (before the tables, as
+  a reading leaves Redis only once its row is committed). Without Redis no
+  frame is deleted. Coalesced readings carry no frame;
+- the references are checked in one anti-join per run against a temporary
+  table of candidates, not one lookup per file, through partial indexes on
+  the image columns;
+- abandoned partial uploads (.part files) past the grace period go too.
+"""
+import logging
+import os
+import time
+
+import redis
+from django.conf import settings
+from django.db import connection, transaction
+
+from .ingestion_buffer import get_buffer, is_buffered
+from .models import CameraCounter, Pilgrim
+from .stream_join import snapshot_images
+
+logger = logging.getLogger(__name__)
+
+MEDIA_DIR = "counter_image"
+
+_UNREFERENCED_SQL = """
+SELECT c.name FROM media_gc_candidates c
+WHERE NOT EXISTS (SELECT 1 FROM {camera} WHERE image = c.name AND image > '')
+  AND NOT EXISTS (SELECT 1 FROM {pilgrim} WHERE image = c.name AND image > '')
+""".format(camera=CameraCounter._meta.db_table, pilgrim=Pilgrim._meta.db_table)
+
+
+def _storage():
+    return CameraCounter._meta.get_field("image").storage
+
+
+def _walk(root, prefix):
+    with os.scandir(root) as entries:
+        for entry in entries:
+            name = f"{prefix}/{entry.name}"
+            if entry.is_dir(follow_symlinks=False):
+                yield from _walk(entry.path, name)
+            elif entry.is_file(follow_symlinks=False):
+                stat = entry.stat(follow_symlinks=False)
+                yield name, entry.path, stat.st_mtime, stat.st_size
+
+
+def _candidates(grace_seconds):
+    """(name, path, size) of every frame file older than the grace period."""
+    try:
+        root = _storage().path(MEDIA_DIR)
+    except NotImplementedError:
+        return []
+    if not os.path.isdir(root):
+        return []
+    cutoff = time.time() - grace_seconds
+    return [(name, path, size) for name, path, mtime, size in _walk(root, MEDIA_DIR) if mtime < cutoff]
+
+
+def _queued_frames():
+    """Frames of the readings waiting in Redis; None when Redis cannot say."""
+    if not is_buffered():
+        return set()
+    try:
+        return set(get_buffer().images()) | set(snapshot_images())
+    except redis.RedisError:
+        logger.warning("Media GC: queued readings unknown, keeping every frame", exc_info=True)
+        return None
+
+
+def _unreferenced(names):
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("CREATE TEMPORARY TABLE media_gc_candidates (name text PRIMARY KEY)")
+        for start in range(0, len(names), 1000):
+            chunk = names[start:start + 1000]
+            cursor.execute(
+                "INSERT INTO media_gc_candidates (name) VALUES " + ", ".join(["(%s)"] * len(chunk)),
+                chunk,
+            )
+        cursor.execute("ANALYZE media_gc_candidates")
+        cursor.execute(_UNREFERENCED_SQL)
+        unreferenced = {row[0] for row in cursor.fetchall()}
+        cursor.execute("DROP TABLE media_gc_candidates")
+    return unreferenced
+
+
+def collect_garbage(grace_seconds=None, batch_size=None, dry_run=False):
+    """
+    Delete unreferenced frame files older than `grace_seconds`. Returns
+    {"scanned", "orphaned", "deleted", "bytes"}; with `dry_run` nothing is
+    deleted and "deleted"/"bytes" tell what would be.
+    """
+    grace_seconds = settings.PILGRIMS_MEDIA_GC_GRACE_SECONDS if grace_seconds is None else grace_seconds
+    batch_size = batch_size or settings.PILGRIMS_MEDIA_GC_BATCH
+
+    candidates = _candidates(grace_seconds)
+    partial = [c for c in candidates if os.path.basename(c[0]).endswith(".part")]
+    frames = [c for c in candidates if not os.path.basename(c[0]).endswith(".part")]
+    queued = _queued_frames() if frames else set()
+    # without knowing what is queued, no frame is safe to delete
+    frames = [c for c in frames if c[0] not in queued] if queued is not None else []
+    unreferenced = _unreferenced([c[0] for c in frames]) if frames else set()
+    orphans = [c for c in frames if c[0] in unreferenced]
+    orphans += partial
+
+    report = {"scanned": len(candidates), "orphaned": len(orphans), "deleted": 0, "bytes": 0}
+    for start in range(0, len(orphans), batch_size):
+        cutoff = time.time() - grace_seconds
+        for name, path, size in orphans[start:start + batch_size]:
+            try:
+                # touched since the scan: an upload is reusing it
+                if os.stat(path).st_mtime >= cutoff:
+                    continue
+                if not dry_run:
+                    os.remove(path)
+            except FileNotFoundError:
+                continue
+            report["deleted"] += 1
+            report["bytes"] += size
+    return report
@@ -0,0 +1,53 @@
+# Generated by Django 4.2.24 on 2026-10-18 04:32
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('office', '0001_initial'),
+        ('pilgrims', '0004_pilgrim'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LiveRFIDTag',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('epc_code', models.CharField(max_length=255, unique=True)),
+                ('sn', models.CharField(max_length=255)),
+                ('last_seen', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='cameracounter',
+            name='reading_id',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='rfidcounter',
+            name='reading_id',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='rfidcounter',
+            name='tags',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.CharField(max_length=255), blank=True, default=list, size=None),
+        ),
+        migrations.AddConstraint(
+            model_name='cameracounter',
+            constraint=models.UniqueConstraint(fields=('sn', 'reading_id'), name='unique_camera_reading'),
+        ),
+        migrations.AddConstraint(
+            model_name='rfidcounter',
+            constraint=models.UniqueConstraint(fields=('sn', 'reading_id'), name='unique_rfid_reading'),
+        ),
+        migrations.AddField(
+            model_name='liverfidtag',
+            name='office',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='office.office'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.24 on 2026-10-18 04:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pilgrims', '0005_reading_id'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='cameracounter',
+            index=models.Index(fields=['time_stamp', 'office'], name='cameracounter_ts_office_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='rfidcounter',
+            index=models.Index(fields=['time_stamp', 'office'], name='rfidcounter_ts_office_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.24 on 2026-10-18 05:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pilgrims', '0007_mergewatermark'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pilgrim',
+            name='match_offset',
+            field=models.SmallIntegerField(blank=True, null=True),
+        ),
+    ]
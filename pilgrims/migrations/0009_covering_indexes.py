@@ -0,0 +1,63 @@
+# Generated by Django 4.2.24 on 2026-10-18 05:10
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    # the new indexes are built without blocking ingestion; the indexes they
+    # replace are dropped afterwards
+    atomic = False
+
+    dependencies = [
+        ('office', '0001_initial'),
+        ('pilgrims', '0008_pilgrim_match_offset'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='cameracounter',
+            index=models.Index(fields=['office', 'time_stamp'], name='cameracounter_office_ts_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='cameracounter',
+            index=django.contrib.postgres.indexes.BrinIndex(autosummarize=True, fields=['time_stamp'], name='cameracounter_ts_brin'),
+        ),
+        AddIndexConcurrently(
+            model_name='rfidcounter',
+            index=models.Index(fields=['office', 'time_stamp'], name='rfidcounter_office_ts_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='rfidcounter',
+            index=django.contrib.postgres.indexes.BrinIndex(autosummarize=True, fields=['time_stamp'], name='rfidcounter_ts_brin'),
+        ),
+        AddIndexConcurrently(
+            model_name='pilgrim',
+            index=models.Index(condition=models.Q(('illegal_pilgrims__gt', 0)), fields=['office', '-time_stamp'], name='pilgrim_illegal_office_ts_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='pilgrim',
+            constraint=models.UniqueConstraint(fields=('office', 'time_stamp'), include=('camera_count', 'rfid_count', 'illegal_pilgrims'), name='pilgrim_office_ts_uniq'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='pilgrim',
+            unique_together=set(),
+        ),
+        migrations.AlterField(
+            model_name='cameracounter',
+            name='office',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='office.office'),
+        ),
+        migrations.AlterField(
+            model_name='pilgrim',
+            name='office',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='office.office'),
+        ),
+        migrations.AlterField(
+            model_name='rfidcounter',
+            name='office',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='office.office'),
+        ),
+    ]
@@ -0,0 +1,95 @@
+from datetime import datetime, timedelta
+
+from django.db import migrations, models
+import pytz
+
+saudi_tz = pytz.timezone("Asia/Riyadh")
+
+TABLES = ["pilgrims_cameracounter", "pilgrims_rfidcounter", "pilgrims_pilgrim"]
+MODELS = {"pilgrims_cameracounter": "CameraCounter", "pilgrims_rfidcounter": "RFIDCounter", "pilgrims_pilgrim": "Pilgrim"}
+
+# partitions made ahead of time; manage_partitions keeps this up afterwards
+PREMAKE_DAYS = 7
+
+
+def _day_bounds(day):
+    start = saudi_tz.localize(datetime.combine(day, datetime.min.time()))
+    return start, saudi_tz.localize(datetime.combine(day + timedelta(days=1), datetime.min.time()))
+
+
+def partition_tables(apps, schema_editor):
+    """
+    Rebuild each table as a parent partitioned by RANGE (time_stamp) with a
+    partition per Asia/Riyadh day that has rows and for the week ahead, plus
+    a default partition. The rows are copied over; primary keys become
+    (id, time_stamp) as Postgres requires the partition key in every unique
+    index. Indexes and constraints are recreated from the models.
+    """
+    execute = schema_editor.execute
+    today = datetime.now(saudi_tz).date()
+
+    for table in TABLES:
+        old = f"{table}_unpartitioned"
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+                "WHERE conrelid = %s::regclass AND contype = 'f'",
+                [table],
+            )
+            foreign_keys = cursor.fetchall()
+            cursor.execute(f"SELECT DISTINCT (time_stamp AT TIME ZONE 'Asia/Riyadh')::date FROM {table}")
+            days = {row[0] for row in cursor.fetchall()}
+            cursor.execute(f"SELECT max(id) FROM {table}")
+            max_id = cursor.fetchone()[0]
+
+        execute(f"ALTER TABLE {table} RENAME TO {old}")
+        execute(f"CREATE TABLE {table} (LIKE {old} INCLUDING DEFAULTS INCLUDING IDENTITY) PARTITION BY RANGE (time_stamp)")
+        execute(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT")
+
+        days.update(today + timedelta(days=offset) for offset in range(PREMAKE_DAYS + 1))
+        for day in sorted(days):
+            start, end = _day_bounds(day)
+            execute(
+                f"CREATE TABLE {table}_p{day:%Y%m%d} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)",
+                [start, end],
+            )
+
+        execute(f"INSERT INTO {table} SELECT * FROM {old}")
+        if max_id:
+            execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), %s)", [max_id])
+        execute(f"DROP TABLE {old}")
+
+        execute(f"ALTER TABLE {table} ADD CONSTRAINT {table}_pkey PRIMARY KEY (id, time_stamp)")
+        for name, definition in foreign_keys:
+            execute(f"ALTER TABLE {table} ADD CONSTRAINT {name} {definition}")
+
+        model = apps.get_model("pilgrims", MODELS[table])
+        for constraint in model._meta.constraints:
+            schema_editor.add_constraint(model, constraint)
+        for index in model._meta.indexes:
+            schema_editor.add_index(model, index)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pilgrims', '0009_covering_indexes'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.RemoveConstraint(model_name='cameracounter', name='unique_camera_reading'),
+                migrations.AddConstraint(
+                    model_name='cameracounter',
+                    constraint=models.UniqueConstraint(fields=('sn', 'reading_id', 'time_stamp'), name='unique_camera_reading'),
+                ),
+                migrations.RemoveConstraint(model_name='rfidcounter', name='unique_rfid_reading'),
+                migrations.AddConstraint(
+                    model_name='rfidcounter',
+                    constraint=models.UniqueConstraint(fields=('sn', 'reading_id', 'time_stamp'), name='unique_rfid_reading'),
+                ),
+            ],
+        ),
+        migrations.RunPython(partition_tables),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.24 on 2026-10-18 05:23
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('office', '0001_initial'),
+        ('pilgrims', '0010_partition_by_day'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CounterRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('minute', models.DateTimeField()),
+                ('camera_min', models.IntegerField(blank=True, null=True)),
+                ('camera_max', models.IntegerField(blank=True, null=True)),
+                ('camera_avg', models.FloatField(blank=True, null=True)),
+                ('camera_readings', models.IntegerField(default=0)),
+                ('rfid_min', models.IntegerField(blank=True, null=True)),
+                ('rfid_max', models.IntegerField(blank=True, null=True)),
+                ('rfid_avg', models.FloatField(blank=True, null=True)),
+                ('rfid_readings', models.IntegerField(default=0)),
+                ('distinct_epcs', models.IntegerField(default=0)),
+                ('camera_count', models.IntegerField(default=0)),
+                ('rfid_count', models.IntegerField(default=0)),
+                ('illegal_pilgrims', models.IntegerField(default=0)),
+                ('office', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='office.office')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='counterrollup',
+            constraint=models.UniqueConstraint(fields=('office', 'minute'), name='counterrollup_office_minute_uniq'),
+        ),
+    ]
@@ -0,0 +1,75 @@
+# Generated by Django 4.2.24 on 2026-10-18 05:34
+
+from datetime import datetime, timezone as dt_timezone
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+BUCKETS_FROM_PILGRIMS = """
+INSERT INTO pilgrims_pilgrimbucket (office_id, granularity, bucket, camera_count, rfid_count, illegal_pilgrims)
+SELECT office_id, 'minute', date_trunc('minute', time_stamp, 'Asia/Riyadh'),
+       COALESCE(sum(camera_count), 0), COALESCE(sum(rfid_count), 0), COALESCE(sum(illegal_pilgrims), 0)
+FROM pilgrims_pilgrim
+WHERE time_stamp >= %s
+GROUP BY 1, 3
+"""
+
+# the minutes behind the rollup watermark have lost their raw rows
+BUCKETS_FROM_ROLLUPS = """
+INSERT INTO pilgrims_pilgrimbucket (office_id, granularity, bucket, camera_count, rfid_count, illegal_pilgrims)
+SELECT office_id, 'minute', minute, camera_count, rfid_count, illegal_pilgrims
+FROM pilgrims_counterrollup
+WHERE minute < %s
+"""
+
+BUCKETS_FROM_BUCKETS = """
+INSERT INTO pilgrims_pilgrimbucket (office_id, granularity, bucket, camera_count, rfid_count, illegal_pilgrims)
+SELECT office_id, %s, date_trunc(%s, bucket, 'Asia/Riyadh'),
+       sum(camera_count), sum(rfid_count), sum(illegal_pilgrims)
+FROM pilgrims_pilgrimbucket
+WHERE granularity = %s
+GROUP BY 1, 3
+"""
+
+
+def fill_buckets(apps, schema_editor):
+    MergeWatermark = apps.get_model("pilgrims", "MergeWatermark")
+    mark = MergeWatermark.objects.filter(name="rollup").first()
+    horizon = mark.merged_until if mark else datetime.min.replace(tzinfo=dt_timezone.utc)
+
+    schema_editor.execute(BUCKETS_FROM_ROLLUPS, [horizon])
+    schema_editor.execute(BUCKETS_FROM_PILGRIMS, [horizon])
+    schema_editor.execute(BUCKETS_FROM_BUCKETS, ["hour", "hour", "minute"])
+    schema_editor.execute(BUCKETS_FROM_BUCKETS, ["day", "day", "hour"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('office', '0001_initial'),
+        ('pilgrims', '0011_counterrollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PilgrimBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('granularity', models.CharField(choices=[('minute', 'Minute'), ('hour', 'Hour'), ('day', 'Day')], max_length=6)),
+                ('bucket', models.DateTimeField()),
+                ('camera_count', models.BigIntegerField(default=0)),
+                ('rfid_count', models.BigIntegerField(default=0)),
+                ('illegal_pilgrims', models.BigIntegerField(default=0)),
+                ('office', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='office.office')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='pilgrimbucket',
+            constraint=models.UniqueConstraint(fields=('office', 'granularity', 'bucket'), include=('camera_count', 'rfid_count', 'illegal_pilgrims'), name='pilgrimbucket_office_bucket_uniq'),
+        ),
+        migrations.AddIndex(
+            model_name='pilgrimbucket',
+            index=models.Index(fields=['granularity', 'bucket'], name='pilgrimbucket_bucket_idx'),
+        ),
+        migrations.RunPython(fill_buckets, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.24 on 2026-10-18 06:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY is not available on the partitioned tables;
+    # each partition is indexed in this transaction
+
+    dependencies = [
+        ('pilgrims', '0012_pilgrimbucket'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='cameracounter',
+            index=models.Index(condition=models.Q(('image__gt', '')), fields=['image'], name='cameracounter_image_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pilgrim',
+            index=models.Index(condition=models.Q(('image__gt', '')), fields=['image'], name='pilgrim_image_idx'),
+        ),
+    ]
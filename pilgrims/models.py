@@ -3,6 +3,7 @@ from django.core.exceptions import ValidationError
 from authentication.models import BaseModel, MyUser
 from office.models import Office
 from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import BrinIndex
 
 
 class RFID(BaseModel):
@@ -63,31 +64,82 @@ class Camera(BaseModel):
 
 
 class Pilgrim(BaseModel):
-    office = models.ForeignKey(Office, on_delete=models.CASCADE)
+    # partitioned by day on time_stamp, see pilgrims/partitions.py
+    # indexed by the (office, time_stamp) constraint below
+    office = models.ForeignKey(Office, on_delete=models.CASCADE, db_index=False)
     camera_count = models.IntegerField(null=True, blank=True)
     rfid_count = models.IntegerField(null=True, blank=True)
     time_stamp = models.DateTimeField()
     image = models.ImageField(upload_to='counter_image/%Y/%m/%d/', default="", blank=True, null=True)
     illegal_pilgrims = models.IntegerField(default=0)
+    # RFID second minus camera second of the readings paired in this row
+    # (0 for an exact match); null while one side is missing
+    match_offset = models.SmallIntegerField(null=True, blank=True)
 
     class Meta:
-        unique_together = ('office', 'time_stamp')
-    
+        constraints = [
+            # also the dashboards' index: office + time range, summing the counts
+            # straight from the index
+            models.UniqueConstraint(
+                fields=['office', 'time_stamp'], name='pilgrim_office_ts_uniq',
+                include=['camera_count', 'rfid_count', 'illegal_pilgrims'],
+            )
+        ]
+        indexes = [
+            # the illegal-pilgrim and frame views, newest first
+            models.Index(fields=['office', '-time_stamp'], name='pilgrim_illegal_office_ts_idx',
+                         condition=models.Q(illegal_pilgrims__gt=0)),
+            # the media GC's reference check (pilgrims/media_gc.py)
+            models.Index(fields=['image'], name='pilgrim_image_idx', condition=models.Q(image__gt='')),
+        ]
+
+
+
+class MergeWatermark(models.Model):
+    # How far the Pilgrim merge task has got: every second before
+    # `merged_until` has been merged by the pass called `name`
+    name = models.CharField(max_length=64, unique=True)
+    merged_until = models.DateTimeField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name}: {self.merged_until}"
 
 
 class CameraCounter(BaseModel):
-    office = models.ForeignKey(Office, on_delete=models.CASCADE)
+    # partitioned by day on time_stamp, see pilgrims/partitions.py
+    office = models.ForeignKey(Office, on_delete=models.CASCADE, db_index=False)
     sn = models.CharField(max_length=255)
     camera_count = models.IntegerField()
     time_stamp = models.DateTimeField()
     image = models.ImageField(upload_to='counter_image/%Y/%m/%d/', null=True, blank=True)
+    # Client idempotency key (or the ingestion buffer entry id); retries become no-ops
+    reading_id = models.CharField(max_length=64, null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            # partitioned by day: unique keys have to include time_stamp
+            models.UniqueConstraint(fields=['sn', 'reading_id', 'time_stamp'], name='unique_camera_reading')
+        ]
+        indexes = [
+            # the merge task reads one window of seconds for all offices at once
+            models.Index(fields=['time_stamp', 'office'], name='cameracounter_ts_office_idx'),
+            # per-office ranges (rebuild_pilgrims, tolerance matching); also
+            # serves the foreign key
+            models.Index(fields=['office', 'time_stamp'], name='cameracounter_office_ts_idx'),
+            # long time ranges over the append-only table
+            BrinIndex(fields=['time_stamp'], name='cameracounter_ts_brin', autosummarize=True),
+            # the media GC's reference check (pilgrims/media_gc.py)
+            models.Index(fields=['image'], name='cameracounter_image_idx', condition=models.Q(image__gt='')),
+        ]
 
     def __str__(self):
         return f"Camera: {self.sn} - {self.time_stamp}"
 
 
 class RFIDCounter(BaseModel):
-    office = models.ForeignKey(Office, on_delete=models.CASCADE)
+    # partitioned by day on time_stamp, see pilgrims/partitions.py
+    office = models.ForeignKey(Office, on_delete=models.CASCADE, db_index=False)
     sn = models.CharField(max_length=255)
     rfid_count = models.IntegerField()
     time_stamp = models.DateTimeField()
@@ -96,6 +148,23 @@ class RFIDCounter(BaseModel):
         default=list,
         blank=True
     )
+    # Client idempotency key (or the ingestion buffer entry id); retries become no-ops
+    reading_id = models.CharField(max_length=64, null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            # partitioned by day: unique keys have to include time_stamp
+            models.UniqueConstraint(fields=['sn', 'reading_id', 'time_stamp'], name='unique_rfid_reading')
+        ]
+        indexes = [
+            # the merge task reads one window of seconds for all offices at once
+            models.Index(fields=['time_stamp', 'office'], name='rfidcounter_ts_office_idx'),
+            # per-office ranges (rebuild_pilgrims, tolerance matching); also
+            # serves the foreign key
+            models.Index(fields=['office', 'time_stamp'], name='rfidcounter_office_ts_idx'),
+            # long time ranges over the append-only table
+            BrinIndex(fields=['time_stamp'], name='rfidcounter_ts_brin', autosummarize=True),
+        ]
 
     def __str__(self):
         return f"RFID: {self.sn} - {self.time_stamp}"
@@ -111,3 +180,60 @@ class LiveRFIDTag(models.Model):
 
     def __str__(self):
         return f"{self.epc_code} @ {self.last_seen}"
+
+
+class CounterRollup(models.Model):
+    # One office-minute of counter history, compacted by pilgrims/rollups.py
+    # once its raw CameraCounter/RFIDCounter rows age out
+    office = models.ForeignKey(Office, on_delete=models.CASCADE, db_index=False)
+    minute = models.DateTimeField()
+
+    camera_min = models.IntegerField(null=True, blank=True)
+    camera_max = models.IntegerField(null=True, blank=True)
+    camera_avg = models.FloatField(null=True, blank=True)
+    camera_readings = models.IntegerField(default=0)
+    rfid_min = models.IntegerField(null=True, blank=True)
+    rfid_max = models.IntegerField(null=True, blank=True)
+    rfid_avg = models.FloatField(null=True, blank=True)
+    rfid_readings = models.IntegerField(default=0)
+    distinct_epcs = models.IntegerField(default=0)
+
+    # sums of the minute's Pilgrim rows, what the dashboards add up
+    camera_count = models.IntegerField(default=0)
+    rfid_count = models.IntegerField(default=0)
+    illegal_pilgrims = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['office', 'minute'], name='counterrollup_office_minute_uniq')
+        ]
+
+    def __str__(self):
+        return f"{self.office_id} @ {self.minute}"
+
+
+class PilgrimBucket(models.Model):
+    # Pilgrim sums of one office over one Asia/Riyadh minute, hour or day,
+    # kept up to date by whatever writes Pilgrim rows (pilgrims/buckets.py)
+    GRANULARITIES = [('minute', 'Minute'), ('hour', 'Hour'), ('day', 'Day')]
+
+    office = models.ForeignKey(Office, on_delete=models.CASCADE, db_index=False)
+    granularity = models.CharField(max_length=6, choices=GRANULARITIES)
+    bucket = models.DateTimeField()
+
+    camera_count = models.BigIntegerField(default=0)
+    rfid_count = models.BigIntegerField(default=0)
+    illegal_pilgrims = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['office', 'granularity', 'bucket'], name='pilgrimbucket_office_bucket_uniq',
+                                    include=['camera_count', 'rfid_count', 'illegal_pilgrims'])
+        ]
+        indexes = [
+            # refreshes cover a bucket range of every office
+            models.Index(fields=['granularity', 'bucket'], name='pilgrimbucket_bucket_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.office_id} {self.granularity} @ {self.bucket}"
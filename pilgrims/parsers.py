@@ -0,0 +1,86 @@
+from django.conf import settings
+from django.http.multipartparser import MultiPartParser as DjangoMultiPartParser, MultiPartParserError
+from rest_framework.exceptions import APIException, ParseError
+from rest_framework.parsers import BaseParser, DataAndFiles, MultiPartParser
+
+from .rfid_frames import BodyTooLarge, FrameError, decode_frames
+from .uploads import CameraFrameUploadHandler
+
+
+class FrameTooLarge(APIException):
+    status_code = 413
+    default_detail = 'Image exceeds the maximum frame size.'
+    default_code = 'frame_too_large'
+
+
+class RFIDFramesTooLarge(APIException):
+    status_code = 413
+    default_detail = 'RFID frames exceed the maximum body size.'
+    default_code = 'rfid_frames_too_large'
+
+
+class RFIDFrameParser(BaseParser):
+    """
+    Parses the compact binary RFID framing (see pilgrims/rfid_frames.py) into
+    a list of readings. Honors `Content-Encoding: deflate` for zlib bodies.
+    """
+    media_type = 'application/x-rfid-frames'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        request = parser_context.get('request')
+        encoding = request.META.get('HTTP_CONTENT_ENCODING', '') if request is not None else ''
+        max_bytes = settings.PILGRIMS_RFID_FRAMES_MAX_BYTES
+
+        # DRF hands over the raw stream: DATA_UPLOAD_MAX_MEMORY_SIZE does
+        # not apply, so bound the read (and the inflated size) here
+        body = stream.read(max_bytes + 1) if stream else b''
+        try:
+            return decode_frames(body, compressed=encoding in ('deflate', 'zlib'), max_bytes=max_bytes)
+        except BodyTooLarge:
+            raise RFIDFramesTooLarge()
+        except FrameError as exc:
+            raise ParseError('RFID frame parse error - %s' % str(exc))
+
+
+class CameraFrameParser(MultiPartParser):
+    """
+    Multipart parser that streams the "image" part to storage through
+    CameraFrameUploadHandler. The view may define `frame_wanted(fields)` to
+    veto writing the frame once the fields sent before it are known.
+    """
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        request = parser_context['request']
+        view = parser_context.get('view')
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        meta = request.META.copy()
+        meta['CONTENT_TYPE'] = media_type
+
+        frames = CameraFrameUploadHandler(request, wanted=getattr(view, 'frame_wanted', None))
+        upload_handlers = [frames, *request.upload_handlers]
+
+        try:
+            parser = DjangoMultiPartParser(meta, stream, upload_handlers, encoding)
+            # the handler reads the fields parsed so far when the image part starts;
+            # Django fills parser._post in place while parsing
+            frames.fields = _LazyFields(parser)
+            data, files = parser.parse()
+        except MultiPartParserError as exc:
+            raise ParseError('Multipart form parse error - %s' % str(exc))
+
+        if frames.too_large:
+            raise FrameTooLarge()
+        return DataAndFiles(data, files)
+
+
+class _LazyFields:
+    def __init__(self, parser):
+        self._parser = parser
+
+    def get(self, key, default=None):
+        return self._parser._post.get(key, default)
+
+    def __contains__(self, key):
+        return key in self._parser._post
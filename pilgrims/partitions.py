@@ -0,0 +1,123 @@
+"""
+Daily range partitions of the counter and Pilgrim tables.
+
+Migration 0010 turns pilgrims_cameracounter, pilgrims_rfidcounter and
+pilgrims_pilgrim into tables partitioned by RANGE (time_stamp): one partition
+per Asia/Riyadh day, named <table>_pYYYYMMDD, and a <table>_default partition
+for readings whose day has no partition yet (a device clock far off).
+Queries filtering on time_stamp only touch the partitions of their range, and
+a finished season goes away by detaching or dropping whole days instead of
+DELETEs and the vacuum that follows them.
+
+`maintain_partitions()` (the `manage_partitions` beat task and management
+command) creates the partitions of the next PILGRIMS_PARTITION_PREMAKE_DAYS
+days and, with PILGRIMS_PARTITION_RETENTION_DAYS set, detaches (or with
+PILGRIMS_PARTITION_EXPIRED_ACTION = "drop", drops) older ones. A detached
+partition stays in the database as a plain table to archive or drop by hand.
+"""
+from datetime import datetime, timedelta
+import re
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+import pytz
+
+from .models import CameraCounter, RFIDCounter, Pilgrim
+
+saudi_tz = pytz.timezone("Asia/Riyadh")
+
+PARTITIONED_TABLES = [model._meta.db_table for model in (CameraCounter, RFIDCounter, Pilgrim)]
+
+_DAY_SUFFIX = re.compile(r"_p(\d{8})$")
+
+
+def partition_name(table, day):
+    return f"{table}_p{day:%Y%m%d}"
+
+
+def day_bounds(day):
+    start = saudi_tz.localize(datetime.combine(day, datetime.min.time()))
+    end = saudi_tz.localize(datetime.combine(day + timedelta(days=1), datetime.min.time()))
+    return start, end
+
+
+def partitions(table):
+    """The daily partitions of `table` as {day: partition name}."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = %s::regclass",
+            [table],
+        )
+        names = [row[0] for row in cursor.fetchall()]
+
+    days = {}
+    for name in names:
+        match = _DAY_SUFFIX.search(name)
+        if match:
+            days[datetime.strptime(match.group(1), "%Y%m%d").date()] = name
+    return days
+
+
+def create_partition(table, day):
+    """
+    Create the partition of `day`. Rows that went to the default partition
+    while the day had none are moved into it first, as attaching a range the
+    default partition still holds rows for is refused.
+    """
+    name = partition_name(table, day)
+    start, end = day_bounds(day)
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT EXISTS (SELECT 1 FROM {table}_default WHERE time_stamp >= %s AND time_stamp < %s)",
+            [start, end],
+        )
+        if not cursor.fetchone()[0]:
+            cursor.execute(f"CREATE TABLE {name} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)", [start, end])
+            return name
+
+        cursor.execute(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+        cursor.execute(
+            f"WITH moved AS (DELETE FROM {table}_default WHERE time_stamp >= %s AND time_stamp < %s RETURNING *) "
+            f"INSERT INTO {name} SELECT * FROM moved",
+            [start, end],
+        )
+        cursor.execute(f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)", [start, end])
+    return name
+
+
+def expire_partition(table, name, drop=False):
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"ALTER TABLE {table} DETACH PARTITION {name}")
+        if drop:
+            cursor.execute(f"DROP TABLE {name}")
+
+
+def maintain_partitions(premake_days=None, retention_days=None, drop=None, today=None):
+    """
+    Make sure today and the next `premake_days` days have their partitions
+    and expire the partitions more than `retention_days` days old (0 keeps
+    everything). Returns (created, expired) partition names.
+    """
+    premake_days = settings.PILGRIMS_PARTITION_PREMAKE_DAYS if premake_days is None else premake_days
+    retention_days = settings.PILGRIMS_PARTITION_RETENTION_DAYS if retention_days is None else retention_days
+    if drop is None:
+        drop = settings.PILGRIMS_PARTITION_EXPIRED_ACTION == "drop"
+    today = today or timezone.now().astimezone(saudi_tz).date()
+
+    created, expired = [], []
+    for table in PARTITIONED_TABLES:
+        existing = partitions(table)
+        for offset in range(premake_days + 1):
+            day = today + timedelta(days=offset)
+            if day not in existing:
+                created.append(create_partition(table, day))
+
+        if retention_days:
+            oldest_kept = today - timedelta(days=retention_days)
+            for day, name in sorted(existing.items()):
+                if day < oldest_kept:
+                    expire_partition(table, name, drop)
+                    expired.append(name)
+    return created, expired
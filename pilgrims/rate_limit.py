@@ -0,0 +1,298 @@
+"""
+Per-device rate limiting for the single-reading ingestion endpoints.
+
+Every serial number gets an in-process token bucket (PILGRIMS_RATE_LIMITS
+"rate" readings per second, bursts of "burst"). Readings the local bucket
+lets through are also counted in a shared per-second Redis counter, so a
+device spread over many workers still gets at most "burst" readings a
+second. When Redis is unreachable the local decision stands.
+
+What happens to a reading over the limit depends on the device type's
+"policy":
+
+- "reject":   429 with Retry-After; the device should back off.
+- "drop":     202, nothing is stored.
+- "coalesce": 202, the reading replaces the pending "latest reading" of its
+              device for its second (without its image). The
+              `flush_coalesced_readings` task stores those once a second,
+              through the ingestion buffer when ingestion is buffered (so
+              the stream joiner pairs them too).
+              The pending readings live in Redis, where the task can see
+              them, so "coalesce" needs the "redis" backend.
+
+Every shed reading is counted per device and action; see `shed_counts()` and
+GET /pilgrims/ingestion/shed/.
+"""
+from collections import Counter, namedtuple
+import json
+import math
+import threading
+import time
+
+import redis
+from django.conf import settings
+
+from .ingestion import _buffer_messages
+from .ingestion_buffer import BufferEntry, get_buffer, is_buffered, write_isolating
+from .redis_client import get_redis, get_async_redis
+
+Decision = namedtuple("Decision", ["allowed", "policy", "retry_after"])
+
+ALLOW = Decision(True, None, 0)
+
+SHED_KEY = "pilgrims:shed"
+# coalesced readings the database rejected, with the error
+COALESCE_DEAD_KEY = "pilgrims:coalesce:dead"
+
+
+def _policy(kind):
+    policy = settings.PILGRIMS_RATE_LIMITS.get(kind)
+    if not policy or not policy.get("rate"):
+        return None
+    return policy
+
+
+def _window_key(kind, sn, now):
+    return f"pilgrims:rate:{kind}:{sn}:{int(now)}"
+
+
+class DeviceRateLimiter:
+    def __init__(self, kind):
+        self.kind = kind
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _take_local(self, sn, policy, now):
+        """Token bucket; returns seconds until the next token (0 when allowed)."""
+        rate, burst = policy["rate"], policy.get("burst", 1)
+        with self._lock:
+            tokens, stamp = self._buckets.get(sn, (burst, now))
+            tokens = min(burst, tokens + (now - stamp) * rate)
+            if tokens >= 1:
+                self._buckets[sn] = (tokens - 1, now)
+                return 0
+            self._buckets[sn] = (tokens, now)
+            return (1 - tokens) / rate
+
+    def would_allow(self, sn):
+        """Whether this worker's bucket has a token for `sn`, without taking it."""
+        policy = _policy(self.kind)
+        if policy is None:
+            return True
+        with self._lock:
+            tokens, stamp = self._buckets.get(sn, (policy.get("burst", 1), time.time()))
+        return tokens + (time.time() - stamp) * policy["rate"] >= 1
+
+    def _decide(self, policy, wait, shared_count):
+        if wait:
+            return Decision(False, policy["policy"], math.ceil(wait))
+        if shared_count is not None and shared_count > policy.get("burst", 1):
+            return Decision(False, policy["policy"], 1)
+        return ALLOW
+
+    def check(self, sn):
+        policy = _policy(self.kind)
+        if policy is None:
+            return ALLOW
+
+        now = time.time()
+        wait = self._take_local(sn, policy, now)
+        shared_count = None
+        if not wait and settings.PILGRIMS_RATE_LIMIT_BACKEND == "redis":
+            try:
+                pipe = get_redis().pipeline(transaction=False)
+                pipe.incr(_window_key(self.kind, sn, now))
+                pipe.expire(_window_key(self.kind, sn, now), 2)
+                shared_count = pipe.execute()[0]
+            except redis.RedisError:
+                pass
+        return self._decide(policy, wait, shared_count)
+
+    async def acheck(self, sn):
+        policy = _policy(self.kind)
+        if policy is None:
+            return ALLOW
+
+        now = time.time()
+        wait = self._take_local(sn, policy, now)
+        shared_count = None
+        if not wait and settings.PILGRIMS_RATE_LIMIT_BACKEND == "redis":
+            try:
+                pipe = get_async_redis().pipeline(transaction=False)
+                pipe.incr(_window_key(self.kind, sn, now))
+                pipe.expire(_window_key(self.kind, sn, now), 2)
+                shared_count = (await pipe.execute())[0]
+            except redis.RedisError:
+                pass
+        return self._decide(policy, wait, shared_count)
+
+
+camera_limiter = DeviceRateLimiter("camera")
+rfid_limiter = DeviceRateLimiter("rfid")
+
+
+# ------------------------------------------------------
+# SHED LOAD ACCOUNTING
+# ------------------------------------------------------
+_local_shed = Counter()
+
+
+def record_shed(kind, sn, action):
+    field = f"{kind}:{sn}:{action}"
+    _local_shed[field] += 1
+    try:
+        get_redis().hincrby(SHED_KEY, field, 1)
+    except redis.RedisError:
+        pass
+
+
+async def arecord_shed(kind, sn, action):
+    field = f"{kind}:{sn}:{action}"
+    _local_shed[field] += 1
+    try:
+        await get_async_redis().hincrby(SHED_KEY, field, 1)
+    except redis.RedisError:
+        pass
+
+
+def shed_counts():
+    """
+    Readings shed per device since the counters were last reset, worst first:
+    [{"kind", "sn", "rejected", "dropped", "coalesced"}, ...]. Falls back to
+    this process's counters when Redis is unreachable.
+    """
+    try:
+        fields = get_redis().hgetall(SHED_KEY)
+    except redis.RedisError:
+        fields = _local_shed
+
+    devices = {}
+    for field, count in fields.items():
+        kind, _, rest = field.partition(":")
+        sn, _, action = rest.rpartition(":")
+        row = devices.setdefault((kind, sn), {"kind": kind, "sn": sn, "rejected": 0, "dropped": 0, "coalesced": 0})
+        row[action] = int(count)
+
+    return sorted(devices.values(), key=lambda row: -(row["rejected"] + row["dropped"] + row["coalesced"]))
+
+
+def reset_shed_counts():
+    _local_shed.clear()
+    try:
+        get_redis().delete(SHED_KEY)
+    except redis.RedisError:
+        pass
+
+
+# ------------------------------------------------------
+# COALESCING
+# ------------------------------------------------------
+KINDS = ("camera", "rfid")
+
+
+def _pending_key(kind):
+    return f"pilgrims:coalesce:{kind}"
+
+
+def _pending_field(reading):
+    return f"{reading['sn']}|{int(reading['time_stamp'].timestamp())}"
+
+
+def coalesce(kind, reading):
+    """
+    Keep `reading` (office_id resolved) as its device's latest reading for its
+    second. Returns the shed action recorded: "coalesced", or "dropped" when
+    the pending slot could not be written.
+    """
+    message, = _buffer_messages(kind, [reading])
+    try:
+        get_redis().hset(_pending_key(kind), _pending_field(reading), json.dumps(message))
+    except redis.RedisError:
+        return "dropped"
+    return "coalesced"
+
+
+async def acoalesce(kind, reading):
+    """Async `coalesce`."""
+    message, = _buffer_messages(kind, [reading])
+    try:
+        await get_async_redis().hset(_pending_key(kind), _pending_field(reading), json.dumps(message))
+    except redis.RedisError:
+        return "dropped"
+    return "coalesced"
+
+
+def _forget_flushed(client, kind, flushed):
+    """Delete the `flushed` fields of `kind` that no newer reading replaced meanwhile."""
+    key = _pending_key(kind)
+    fields = list(flushed)
+    with client.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(key)
+                current = pipe.hmget(key, fields)
+                unchanged = [field for field, value in zip(fields, current) if value == flushed[field]]
+                pipe.multi()
+                if unchanged:
+                    pipe.hdel(key, *unchanged)
+                pipe.execute()
+                return
+            except redis.WatchError:
+                continue
+
+
+def _dead_letter(client, failures):
+    pipe = client.pipeline(transaction=False)
+    for entry, error in failures:
+        pipe.xadd(COALESCE_DEAD_KEY, {"kind": entry.kind, "reading": json.dumps(entry.reading), "error": error})
+    pipe.execute()
+
+
+def flush_coalesced():
+    """
+    Store every pending coalesced reading. Returns how many were written.
+
+    Readings leave the pending hashes only after their rows are committed (or
+    queued on the ingestion buffer), so a failed write leaves them for the
+    next run; the rows are keyed, so a reading written twice is stored once.
+    A reading the database rejects on its own (a value it cannot store, an
+    office deleted since) is moved to COALESCE_DEAD_KEY instead, so it cannot
+    hold up the flush.
+    """
+    if settings.PILGRIMS_RATE_LIMIT_BACKEND != "redis":
+        return 0
+
+    client = get_redis()
+    pipe = client.pipeline(transaction=False)
+    for kind in KINDS:
+        pipe.hgetall(_pending_key(kind))
+    pending = dict(zip(KINDS, pipe.execute()))
+
+    # one row per device per second: "coalesced:<epoch second>" is its reading_id
+    messages = {
+        kind: {field: dict(json.loads(message), reading_id=f"coalesced:{field.rpartition('|')[2]}")
+               for field, message in fields.items()}
+        for kind, fields in pending.items()
+    }
+    count = sum(len(readings) for readings in messages.values())
+    if not count:
+        return 0
+
+    if is_buffered():
+        # the consumer writes them and, in PILGRIMS_JOIN_MODE = "stream", pairs them
+        for kind, readings in messages.items():
+            if readings:
+                get_buffer().push_many(kind, list(readings.values()))
+    else:
+        # entry ids are the pending fields
+        written, failures = write_isolating([
+            BufferEntry(field, kind, reading)
+            for kind, readings in messages.items() for field, reading in readings.items()
+        ])
+        if failures:
+            _dead_letter(client, failures)
+        count = len(written)
+    for kind, fields in pending.items():
+        if fields:
+            _forget_flushed(client, kind, fields)
+    return count
@@ -0,0 +1,63 @@
+import asyncio
+
+import redis
+import redis.asyncio
+from django.conf import settings
+
+_client = None
+_async_clients = {}
+_async_pubsub_clients = {}
+
+
+def get_redis():
+    """Process-wide Redis client for the ingestion pipeline (connection pooled)."""
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(
+            settings.PILGRIMS_REDIS_URL,
+            decode_responses=True,
+            # ingestion must not hang on a dead Redis; callers fall back instead
+            socket_connect_timeout=0.5,
+            socket_timeout=0.5,
+        )
+    return _client
+
+
+def for_running_loop(instances, factory):
+    """
+    The object in `instances` for the running event loop, made with
+    `factory()` the first time. Objects of loops closed since (an
+    `asyncio.run()` per call, a restarted worker loop) are dropped then, so
+    the dict does not keep a dead client and its pool per loop ever run.
+    """
+    loop = asyncio.get_running_loop()
+    instance = instances.get(loop)
+    if instance is None:
+        for stale in [other for other in instances if other.is_closed()]:
+            del instances[stale]
+        instance = instances[loop] = factory()
+    return instance
+
+
+def get_async_redis():
+    """redis.asyncio client for the ASGI views; asyncio clients are bound to their event loop."""
+    return for_running_loop(_async_clients, lambda: redis.asyncio.Redis.from_url(
+        settings.PILGRIMS_REDIS_URL,
+        decode_responses=True,
+        socket_connect_timeout=0.5,
+        socket_timeout=0.5,
+    ))
+
+
+def get_async_pubsub():
+    """
+    redis.asyncio pub/sub for the dashboard streams. Subscribers wait on
+    the socket between messages, so unlike get_async_redis() reads have no
+    timeout; the connection gets one for connecting only.
+    """
+    client = for_running_loop(_async_pubsub_clients, lambda: redis.asyncio.Redis.from_url(
+        settings.PILGRIMS_REDIS_URL,
+        decode_responses=True,
+        socket_connect_timeout=0.5,
+    ))
+    return client.pubsub()
@@ -0,0 +1,120 @@
+"""
+Compact binary framing for RFID reader reports.
+
+A request body is one or more frames back to back. All integers are
+big-endian:
+
+    magic       2 bytes   b"RF"
+    version     uint8     1
+    sn_len      uint8     length of the serial number
+    sn          sn_len    ASCII serial number
+    time_stamp  uint32    Unix time, seconds (UTC)
+    rfid_count  uint16
+    epc_len     uint8     bytes per EPC, 12 for 96-bit tags
+    tag_count   uint16
+    tags        tag_count * epc_len raw EPC bytes
+
+Decoded EPCs are upper-case hex strings, the same text the JSON endpoints
+receive. The whole body may be zlib-compressed (Content-Encoding: deflate);
+it is inflated no further than `max_bytes`, so a small request cannot
+expand into an arbitrarily large one.
+"""
+from datetime import datetime, timezone as dt_timezone
+import struct
+import zlib
+
+MAGIC = b"RF"
+VERSION = 1
+
+_HEAD = struct.Struct(">2sBB")
+_BODY = struct.Struct(">IHBH")
+
+
+class FrameError(ValueError):
+    pass
+
+
+class BodyTooLarge(FrameError):
+    pass
+
+
+def encode_frame(sn, time_stamp, epcs, rfid_count=None, epc_len=12):
+    """Encode one reading; `epcs` are hex strings, `time_stamp` an aware datetime."""
+    sn = sn.encode("ascii")
+    tags = bytes.fromhex("".join(epcs))
+    if len(tags) != len(epcs) * epc_len:
+        raise FrameError(f"every EPC must be {epc_len} bytes")
+
+    return (
+        _HEAD.pack(MAGIC, VERSION, len(sn)) + sn
+        + _BODY.pack(int(time_stamp.timestamp()), len(epcs) if rfid_count is None else rfid_count,
+                     epc_len, len(epcs))
+        + tags
+    )
+
+
+def encode_frames(readings, compress=False):
+    """Encode (sn, time_stamp, epcs) readings into one request body."""
+    body = b"".join(encode_frame(sn, time_stamp, epcs) for sn, time_stamp, epcs in readings)
+    return zlib.compress(body) if compress else body
+
+
+def _inflate(body, max_bytes):
+    inflater = zlib.decompressobj()
+    try:
+        # 0 means no limit to decompress()
+        inflated = inflater.decompress(body, max_bytes + 1 if max_bytes else 0)
+    except zlib.error as exc:
+        raise FrameError(f"invalid zlib body: {exc}")
+    if inflater.unconsumed_tail or (max_bytes and len(inflated) > max_bytes):
+        raise BodyTooLarge(f"body inflates to more than {max_bytes} bytes")
+    if not inflater.eof:
+        raise FrameError("truncated zlib body")
+    return inflated
+
+
+def decode_frames(body, compressed=False, max_bytes=None):
+    """
+    Decode a request body into reading dicts shaped like the JSON batch items
+    ({"rfid_sn", "rfid_count", "time_stamp", "tags"}). Raises BodyTooLarge
+    when the (inflated) body is over `max_bytes`.
+    """
+    if compressed:
+        body = _inflate(body, max_bytes)
+    elif max_bytes and len(body) > max_bytes:
+        raise BodyTooLarge(f"body is larger than {max_bytes} bytes")
+
+    readings = []
+    offset, size = 0, len(body)
+    try:
+        while offset < size:
+            magic, version, sn_len = _HEAD.unpack_from(body, offset)
+            if magic != MAGIC or version != VERSION:
+                raise FrameError(f"bad frame header at byte {offset}")
+            offset += _HEAD.size
+
+            sn = body[offset:offset + sn_len].decode("ascii")
+            offset += sn_len
+
+            time_stamp, rfid_count, epc_len, tag_count = _BODY.unpack_from(body, offset)
+            offset += _BODY.size
+
+            if tag_count and not epc_len:
+                raise FrameError(f"zero-length EPCs in frame for {sn}")
+            end = offset + tag_count * epc_len
+            if end > size:
+                raise FrameError(f"truncated tag block in frame for {sn}")
+            # one hex() call for the whole block, with a separator between EPCs
+            tags = body[offset:end].hex(" ", epc_len).upper().split() if tag_count else []
+            offset = end
+
+            readings.append({
+                "rfid_sn": sn,
+                "rfid_count": rfid_count,
+                "time_stamp": datetime.fromtimestamp(time_stamp, dt_timezone.utc).isoformat(),
+                "tags": tags,
+            })
+    except (struct.error, UnicodeDecodeError) as exc:
+        raise FrameError(f"malformed frame at byte {offset}: {exc}")
+
+    return readings
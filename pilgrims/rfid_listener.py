@@ -0,0 +1,265 @@
+"""
+Raw-socket intake for RFID readers (`manage.py run_rfid_listener`).
+
+Readers that can push tag reports over a plain socket skip HTTP entirely:
+
+- TCP: one report per line.
+- UDP: one datagram holds one or more report lines, or binary frames in the
+  `application/x-rfid-frames` layout (see rfid_frames.py).
+
+A report line is either a JSON object with the same fields as the HTTP
+endpoint ({"rfid_sn", "tags", "rfid_count"?, "time_stamp"?}) or the plain
+text form "SN,EPC,EPC,...". Reports are aggregated per reader per second in
+memory; once a second is older than the grace period it is flushed through
+`store_rfid_batch`, so office resolution, idempotency, buffered mode and the
+live tag table behave exactly as for RFIDCounterView. A flush that fails
+(the database is down) puts its readings back for the next one, up to
+MAX_WAITING readings.
+"""
+from collections import OrderedDict
+from datetime import datetime, timezone as dt_timezone
+import asyncio
+import json
+import logging
+import time
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+from django.utils import timezone
+import pytz
+
+from .ingestion import ReadingError, store_rfid_batch
+from .rfid_frames import MAGIC, FrameError, decode_frames
+
+logger = logging.getLogger(__name__)
+
+saudi_tz = pytz.timezone("Asia/Riyadh")
+
+MAX_LINE = 64 * 1024
+# readings kept for retry while the database is unreachable
+MAX_WAITING = 100_000
+
+
+def _epoch_second(time_stamp):
+    parsed = datetime.fromisoformat(time_stamp)
+    # a naive time is Riyadh time, as on the HTTP endpoints (TIME_ZONE)
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed, saudi_tz)
+    return int(parsed.timestamp())
+
+
+def parse_report_line(line, received_at=None):
+    """
+    Turn one report line into (sn, epoch_second, rfid_count, epcs).
+    `rfid_count` is None when the reader did not send one.
+    Raises ReadingError for malformed lines.
+    """
+    received_at = received_at or time.time()
+    line = line.strip()
+    if not line:
+        raise ReadingError("Empty report")
+
+    if line.startswith("{"):
+        try:
+            data = json.loads(line)
+        except ValueError:
+            raise ReadingError("Invalid JSON report")
+        if not isinstance(data, dict):
+            raise ReadingError("Report must be an object")
+        return _from_fields(data, received_at)
+
+    sn, *epcs = [part.strip() for part in line.replace(";", ",").split(",")]
+    if not sn:
+        raise ReadingError("Missing fields")
+    return sn, int(received_at), None, [epc.upper() for epc in epcs if epc]
+
+
+def _from_fields(data, received_at):
+    sn = data.get("rfid_sn")
+    epcs = data.get("tags", [])
+    if not sn or not isinstance(epcs, list):
+        raise ReadingError("Missing fields")
+
+    rfid_count = data.get("rfid_count")
+    time_stamp = data.get("time_stamp")
+    try:
+        rfid_count = None if rfid_count is None else int(rfid_count)
+        second = _epoch_second(time_stamp) if time_stamp else int(received_at)
+    except (TypeError, ValueError):
+        raise ReadingError("Invalid rfid_count or time_stamp")
+
+    return sn, second, rfid_count, epcs
+
+
+class ReadingAggregator:
+    """
+    Folds reports into one reading per (reader, second): the union of the
+    EPCs seen, counted as the largest reported count or the number of
+    distinct EPCs, whichever is higher.
+    """
+
+    def __init__(self, grace=1.0):
+        self.grace = grace
+        self._buckets = OrderedDict()
+        self.reports = 0
+        self.rejected = 0
+
+    def add(self, sn, second, rfid_count, epcs):
+        bucket = self._buckets.get((sn, second))
+        if bucket is None:
+            bucket = self._buckets[(sn, second)] = {"count": 0, "tags": {}}
+        # dict keeps first-seen order and drops repeats
+        bucket["tags"].update(dict.fromkeys(epcs))
+        bucket["count"] = max(bucket["count"], rfid_count or 0, len(bucket["tags"]))
+        self.reports += 1
+
+    def add_line(self, line, received_at=None):
+        try:
+            self.add(*parse_report_line(line, received_at))
+        except ReadingError as exc:
+            self.rejected += 1
+            logger.debug("RFID listener: rejected report %r: %s", line[:80], exc.message)
+
+    def add_datagram(self, payload, received_at=None):
+        if payload.startswith(MAGIC):
+            try:
+                readings = decode_frames(payload)
+            except FrameError as exc:
+                self.rejected += 1
+                logger.debug("RFID listener: rejected frame datagram: %s", exc)
+                return
+            for reading in readings:
+                self.add(*_from_fields(reading, received_at))
+            return
+
+        for line in payload.decode("utf-8", "replace").splitlines():
+            if line.strip():
+                self.add_line(line, received_at)
+
+    def pop_ready(self, now=None, everything=False):
+        """Remove and return the readings whose second has closed, as batch items."""
+        cutoff = (now or time.time()) - self.grace
+        ready = [key for key in self._buckets if everything or key[1] + 1 <= cutoff]
+
+        readings = []
+        for sn, second in ready:
+            bucket = self._buckets.pop((sn, second))
+            readings.append({
+                "rfid_sn": sn,
+                "rfid_count": bucket["count"],
+                "time_stamp": datetime.fromtimestamp(second, dt_timezone.utc).isoformat(),
+                "tags": list(bucket["tags"]),
+            })
+        return readings
+
+    def requeue(self, readings, limit=MAX_WAITING):
+        """
+        Put back readings whose store failed, to go out with the next flush.
+        Returns how many were dropped because `limit` readings already wait.
+        """
+        room = max(limit - len(self._buckets), 0)
+        for reading in readings[:room]:
+            bucket = self._buckets.setdefault(
+                (reading["rfid_sn"], _epoch_second(reading["time_stamp"])), {"count": 0, "tags": {}},
+            )
+            bucket["tags"].update(dict.fromkeys(reading["tags"]))
+            bucket["count"] = max(bucket["count"], reading["rfid_count"], len(bucket["tags"]))
+        return len(readings[room:])
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+def _store(readings):
+    close_old_connections()
+    return store_rfid_batch(readings, max_batch_size=len(readings))
+
+
+class RFIDListener:
+    def __init__(self, host="0.0.0.0", tcp_port=None, udp_port=None, flush_interval=1.0, grace=1.0):
+        self.host = host
+        self.tcp_port = tcp_port
+        self.udp_port = udp_port
+        self.flush_interval = flush_interval
+        self.aggregator = ReadingAggregator(grace)
+        self.stored = 0
+        self.failed = 0
+        self._servers = []
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        if self.tcp_port is not None:
+            server = await asyncio.start_server(self._handle_tcp, self.host, self.tcp_port, limit=MAX_LINE)
+            self.tcp_port = server.sockets[0].getsockname()[1]
+            self._servers.append(server)
+        if self.udp_port is not None:
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda: _DatagramProtocol(self.aggregator), local_addr=(self.host, self.udp_port),
+            )
+            self.udp_port = transport.get_extra_info("sockname")[1]
+            self._servers.append(transport)
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                await self.flush()
+        finally:
+            await self.stop()
+
+    async def stop(self):
+        for server in self._servers:
+            server.close()
+        self._servers = []
+        await self.flush(everything=True)
+
+    async def flush(self, everything=False):
+        readings = self.aggregator.pop_ready(everything=everything)
+        if not readings:
+            return 0
+        try:
+            results = await sync_to_async(_store, thread_sensitive=True)(readings)
+        except Exception:
+            # the database is down: keep the daemon alive and the readings for
+            # the next flush, the readers keep streaming
+            dropped = self.aggregator.requeue(readings)
+            self.failed += dropped
+            logger.exception("RFID listener: could not store %d readings (%d dropped)", len(readings), dropped)
+            return 0
+
+        stored = sum(1 for result in results if result["status"] in (201, 202))
+        self.stored += stored
+        self.failed += len(results) - stored
+        errors = {
+            (result["error"], readings[result["index"]]["rfid_sn"])
+            for result in results if result["status"] >= 400
+        }
+        for error, sn in sorted(errors):
+            logger.warning("RFID listener: %s (%s)", error, sn)
+        return stored
+
+    async def _handle_tcp(self, reader, writer):
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except (asyncio.LimitOverrunError, ValueError):
+                    # over-long line: drop the connection rather than buffer it
+                    self.aggregator.rejected += 1
+                    break
+                if not line:
+                    break
+                self.aggregator.add_line(line.decode("utf-8", "replace"))
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, aggregator):
+        self.aggregator = aggregator
+
+    def datagram_received(self, data, addr):
+        self.aggregator.add_datagram(data)
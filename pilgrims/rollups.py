@@ -0,0 +1,152 @@
+"""
+Per-minute rollups of aged counter history.
+
+With PILGRIMS_ROLLUP_AFTER_DAYS = N, `compact_history()` (the
+`compact_counter_history` beat task) works through everything older than N
+days, minute-aligned and in order:
+
+1. each office-minute of CameraCounter/RFIDCounter/Pilgrim rows becomes one
+   CounterRollup row (min/max/avg counts, distinct EPCs, Pilgrim sums);
+2. the raw counter rows and the Pilgrim rows without illegal pilgrims that
+   were rolled up are deleted, and the "rollup" MergeWatermark moves past
+   the window.
+
+Both happen per PILGRIMS_ROLLUP_CHUNK_MINUTES window in one REPEATABLE READ
+transaction, so the delete sees exactly the rows the rollup read: a late
+reading committed meanwhile stays raw rather than being deleted unrolled.
+Illegal Pilgrim rows stay for the frame views. The frames nothing points at
+any more are left to the media GC (pilgrims/media_gc.py).
+
+The dashboards' Pilgrim sums come from PilgrimBucket (pilgrims/buckets.py),
+which keeps the minutes behind the watermark.
+"""
+from datetime import timedelta
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import CameraCounter, RFIDCounter, Pilgrim, CounterRollup, MergeWatermark
+
+WATERMARK = "rollup"
+
+ROLLUP_SQL = """
+INSERT INTO {rollup} AS r (office_id, minute,
+                           camera_min, camera_max, camera_avg, camera_readings,
+                           rfid_min, rfid_max, rfid_avg, rfid_readings, distinct_epcs,
+                           camera_count, rfid_count, illegal_pilgrims)
+SELECT office_id, minute,
+       max(camera_min), max(camera_max), max(camera_avg), sum(camera_readings),
+       max(rfid_min), max(rfid_max), max(rfid_avg), sum(rfid_readings), sum(distinct_epcs),
+       sum(camera_count), sum(rfid_count), sum(illegal_pilgrims)
+FROM (
+    SELECT office_id, date_trunc('minute', time_stamp) AS minute,
+           min(camera_count) AS camera_min, max(camera_count) AS camera_max,
+           avg(camera_count)::float AS camera_avg, count(*) AS camera_readings,
+           NULL::int AS rfid_min, NULL::int AS rfid_max, NULL::float AS rfid_avg, 0 AS rfid_readings,
+           0 AS distinct_epcs, 0 AS camera_count, 0 AS rfid_count, 0 AS illegal_pilgrims
+    FROM {camera}
+    WHERE time_stamp >= %(start)s AND time_stamp < %(end)s
+    GROUP BY 1, 2
+    UNION ALL
+    SELECT office_id, date_trunc('minute', time_stamp), NULL, NULL, NULL, 0,
+           min(rfid_count), max(rfid_count), avg(rfid_count)::float, count(*), 0, 0, 0, 0
+    FROM {rfid}
+    WHERE time_stamp >= %(start)s AND time_stamp < %(end)s
+    GROUP BY 1, 2
+    UNION ALL
+    SELECT office_id, date_trunc('minute', time_stamp), NULL, NULL, NULL, 0, NULL, NULL, NULL, 0,
+           count(DISTINCT tag), 0, 0, 0
+    FROM {rfid} CROSS JOIN LATERAL unnest(tags) AS tag
+    WHERE time_stamp >= %(start)s AND time_stamp < %(end)s
+    GROUP BY 1, 2
+    UNION ALL
+    SELECT office_id, date_trunc('minute', time_stamp), NULL, NULL, NULL, 0, NULL, NULL, NULL, 0, 0,
+           COALESCE(sum(camera_count), 0), COALESCE(sum(rfid_count), 0), sum(illegal_pilgrims)
+    FROM {pilgrim}
+    WHERE time_stamp >= %(start)s AND time_stamp < %(end)s
+    GROUP BY 1, 2
+) sides
+GROUP BY office_id, minute
+ON CONFLICT (office_id, minute) DO UPDATE SET
+    camera_min = EXCLUDED.camera_min, camera_max = EXCLUDED.camera_max,
+    camera_avg = EXCLUDED.camera_avg, camera_readings = EXCLUDED.camera_readings,
+    rfid_min = EXCLUDED.rfid_min, rfid_max = EXCLUDED.rfid_max,
+    rfid_avg = EXCLUDED.rfid_avg, rfid_readings = EXCLUDED.rfid_readings,
+    distinct_epcs = EXCLUDED.distinct_epcs, camera_count = EXCLUDED.camera_count,
+    rfid_count = EXCLUDED.rfid_count, illegal_pilgrims = EXCLUDED.illegal_pilgrims
+""".format(
+    rollup=CounterRollup._meta.db_table,
+    camera=CameraCounter._meta.db_table,
+    rfid=RFIDCounter._meta.db_table,
+    pilgrim=Pilgrim._meta.db_table,
+)
+
+
+def rollup_window(start, end):
+    """Compact every office-minute in [start, end). Returns the rollup rows written."""
+    with connection.cursor() as cursor:
+        cursor.execute(ROLLUP_SQL, {"start": start, "end": end})
+        return cursor.rowcount
+
+
+def rolled_up_until():
+    """Everything before this moment is in CounterRollup; None before the first run."""
+    mark = MergeWatermark.objects.filter(name=WATERMARK).first()
+    return mark.merged_until if mark else None
+
+
+def _delete_window(start, end):
+    deleted = 0
+    with connection.cursor() as cursor:
+        for table, condition in (
+            (CameraCounter._meta.db_table, ""),
+            (RFIDCounter._meta.db_table, ""),
+            (Pilgrim._meta.db_table, "AND illegal_pilgrims = 0"),
+        ):
+            cursor.execute(
+                f"DELETE FROM {table} WHERE time_stamp >= %s AND time_stamp < %s {condition}", [start, end],
+            )
+            deleted += cursor.rowcount
+    return deleted
+
+
+def compact_history(max_seconds=50.0):
+    """
+    Roll up and delete history older than PILGRIMS_ROLLUP_AFTER_DAYS until
+    caught up or `max_seconds` have passed. Returns (rollup rows, raw rows
+    deleted).
+    """
+    days = settings.PILGRIMS_ROLLUP_AFTER_DAYS
+    if not days:
+        return 0, 0
+
+    deadline = time.monotonic() + max_seconds
+    cutoff = (timezone.now() - timedelta(days=days)).replace(second=0, microsecond=0)
+    chunk = timedelta(minutes=settings.PILGRIMS_ROLLUP_CHUNK_MINUTES)
+
+    if not MergeWatermark.objects.filter(name=WATERMARK).exists():
+        oldest = [
+            model.objects.order_by("time_stamp").values_list("time_stamp", flat=True).first()
+            for model in (CameraCounter, RFIDCounter, Pilgrim)
+        ]
+        start = min([ts for ts in oldest if ts] or [cutoff])
+        MergeWatermark.objects.get_or_create(
+            name=WATERMARK, defaults={"merged_until": start.replace(second=0, microsecond=0)},
+        )
+
+    rolled = deleted = 0
+    while time.monotonic() < deadline:
+        with transaction.atomic(), connection.cursor() as cursor:
+            # one snapshot for the rollup and the delete
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            mark = MergeWatermark.objects.select_for_update(skip_locked=True).filter(name=WATERMARK).first()
+            if mark is None or mark.merged_until >= cutoff:
+                break
+            end = min(mark.merged_until + chunk, cutoff)
+            rolled += rollup_window(mark.merged_until, end)
+            deleted += _delete_window(mark.merged_until, end)
+            mark.merged_until = end
+            mark.save(update_fields=["merged_until", "updated_at"])
+    return rolled, deleted
@@ -0,0 +1,51 @@
+import logging
+
+from celery.signals import worker_process_init
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from office.models import Office
+from .device_registry import camera_registry, rfid_registry, registry_for
+from .models import Camera, RFID
+
+logger = logging.getLogger(__name__)
+
+
+@receiver(pre_save, sender=Camera)
+@receiver(pre_save, sender=RFID)
+def remember_previous_sn(sender, instance, **kwargs):
+    # A device can be renamed; the old serial number must be dropped too.
+    instance._previous_sn = None
+    if instance.pk:
+        instance._previous_sn = sender.objects.filter(pk=instance.pk).values_list("sn", flat=True).first()
+
+
+@receiver(post_save, sender=Camera)
+@receiver(post_save, sender=RFID)
+@receiver(post_delete, sender=Camera)
+@receiver(post_delete, sender=RFID)
+def invalidate_device(sender, instance, **kwargs):
+    sns = {instance.sn, getattr(instance, "_previous_sn", None)} - {None}
+    # after the commit: a lookup until then still reads the old row and
+    # would put it back into Redis
+    registry = registry_for(sender)
+    transaction.on_commit(lambda: registry.invalidate(*sns))
+
+
+@receiver(post_delete, sender=Office)
+def invalidate_office_devices(sender, instance, **kwargs):
+    # on_delete=SET_NULL detaches the devices with a queryset update, which
+    # sends no Camera/RFID signals.
+    transaction.on_commit(camera_registry.invalidate)
+    transaction.on_commit(rfid_registry.invalidate)
+
+
+@worker_process_init.connect
+def warm_device_registries(**kwargs):
+    try:
+        camera_registry.warm()
+        rfid_registry.warm()
+    except Exception:
+        # lookups warm lazily anyway; never keep a worker from starting
+        logger.exception("Could not warm the device registries")
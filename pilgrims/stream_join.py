@@ -0,0 +1,237 @@
+"""
+Streaming join of camera and RFID readings into Pilgrim rows.
+
+With PILGRIMS_JOIN_MODE = "stream" (on top of PILGRIMS_INGESTION_MODE =
+"buffered") the ingestion consumer feeds every batch it writes into a
+StreamJoiner instead of leaving the pairing to the merge task's table scans.
+Each office has a ring buffer of PILGRIMS_JOIN_WINDOW_SECONDS slots indexed
+by second. A slot is written as a Pilgrim row as soon as both its camera
+and its RFID side are in, or once PILGRIMS_JOIN_TIMEOUT_SECONDS have passed
+with one side only. A side arriving later while its slot is still in the
+ring writes the row again, complete.
+
+Rows are upserted so that halves written by different consumers (or a
+restarted one) combine in the table, and their changes are added to the
+minute/hour/day buckets of the rows written (pilgrims/buckets.py). The
+slots not written yet are snapshotted to Redis after every batch, before
+the batch is acknowledged, and restored when the consumer starts again
+under the same name.
+"""
+from datetime import datetime, timezone as dt_timezone
+import json
+import time
+
+import redis
+from django.conf import settings
+from django.db import connection, transaction
+
+from .buckets import DELTA_RETURNING, apply_deltas, lock_offices, row_deltas
+from .models import Pilgrim
+from .redis_client import get_redis
+
+_UPSERT_SQL = """
+INSERT INTO {pilgrim} AS p (created_at, updated_at, office_id, time_stamp,
+                            camera_count, rfid_count, illegal_pilgrims, image, match_offset)
+VALUES {values}
+ON CONFLICT (office_id, time_stamp) DO UPDATE SET
+    updated_at = EXCLUDED.updated_at,
+    camera_count = COALESCE(EXCLUDED.camera_count, p.camera_count),
+    rfid_count = COALESCE(EXCLUDED.rfid_count, p.rfid_count),
+    illegal_pilgrims = GREATEST(
+        COALESCE(COALESCE(EXCLUDED.camera_count, p.camera_count)
+                 - COALESCE(EXCLUDED.rfid_count, p.rfid_count), 0), 0),
+    image = CASE
+        WHEN COALESCE(EXCLUDED.camera_count, p.camera_count)
+             - COALESCE(EXCLUDED.rfid_count, p.rfid_count) > 0
+        THEN COALESCE(EXCLUDED.image, NULLIF(p.image, ''))
+    END,
+    match_offset = CASE
+        WHEN COALESCE(EXCLUDED.camera_count, p.camera_count) IS NOT NULL
+             AND COALESCE(EXCLUDED.rfid_count, p.rfid_count) IS NOT NULL
+        THEN COALESCE(EXCLUDED.match_offset, p.match_offset, 0)
+    END
+""" + DELTA_RETURNING.format(alias="p", pilgrim="{pilgrim}")
+
+# for writers that own both sides of their rows (the tolerance merge): a row
+# is replaced as written, so a reading paired elsewhere now leaves it
+_OVERWRITE_SQL = """
+INSERT INTO {pilgrim} AS p (created_at, updated_at, office_id, time_stamp,
+                            camera_count, rfid_count, illegal_pilgrims, image, match_offset)
+VALUES {values}
+ON CONFLICT (office_id, time_stamp) DO UPDATE SET
+    updated_at = EXCLUDED.updated_at,
+    camera_count = EXCLUDED.camera_count,
+    rfid_count = EXCLUDED.rfid_count,
+    illegal_pilgrims = EXCLUDED.illegal_pilgrims,
+    image = EXCLUDED.image,
+    match_offset = EXCLUDED.match_offset
+""" + DELTA_RETURNING.format(alias="p", pilgrim="{pilgrim}")
+
+
+def upsert_pilgrims(rows, now, overwrite=False):
+    """
+    Write (office_id, time_stamp, camera_count, rfid_count, image[, match_offset])
+    rows in one statement. A side that is None keeps the value already in the
+    table, or with `overwrite` empties it; a row with both sides and no offset
+    is an exact match (offset 0). The changes are added to the rows' buckets.
+    """
+    if not rows:
+        return 0
+
+    params = []
+    for office_id, time_stamp, camera_count, rfid_count, image, *offset in rows:
+        complete = camera_count is not None and rfid_count is not None
+        illegal = max(camera_count - rfid_count, 0) if complete else 0
+        match_offset = (offset[0] if offset and offset[0] is not None else 0) if complete else None
+        params.extend([now, now, office_id, time_stamp, camera_count, rfid_count, illegal,
+                       image if illegal > 0 else None, match_offset])
+
+    sql = (_OVERWRITE_SQL if overwrite else _UPSERT_SQL).format(
+        pilgrim=Pilgrim._meta.db_table,
+        values=", ".join(["(%s, %s, %s, %s, %s, %s, %s, %s, %s)"] * len(rows)),
+    )
+    with transaction.atomic(), connection.cursor() as cursor:
+        lock_offices({row[0] for row in rows})
+        cursor.execute(sql, params)
+        returned = cursor.fetchall()
+        apply_deltas(row_deltas(returned))
+    return len(returned)
+
+
+class _Slot:
+    __slots__ = ("second", "camera_count", "image", "rfid_count", "opened", "written")
+
+    def __init__(self, second, opened):
+        self.second = second
+        self.camera_count = None
+        self.image = None
+        self.rfid_count = None
+        self.opened = opened
+        self.written = False
+
+    def complete(self):
+        return self.camera_count is not None and self.rfid_count is not None
+
+
+class StreamJoiner:
+    def __init__(self, window=None, timeout=None):
+        self.window = window or settings.PILGRIMS_JOIN_WINDOW_SECONDS
+        self.timeout = settings.PILGRIMS_JOIN_TIMEOUT_SECONDS if timeout is None else timeout
+        self._rings = {}    # office_id -> [slot or None] * window, indexed by second % window
+        self._pending = {}  # (office_id, second) -> slot with data not written yet
+
+    def feed(self, kind, office_id, time_stamp, count, image=None, now=None):
+        now = now or time.time()
+        second = int(time_stamp.timestamp())
+        ring = self._rings.get(office_id)
+        if ring is None:
+            ring = self._rings[office_id] = [None] * self.window
+
+        slot = ring[second % self.window]
+        if slot is None or slot.second != second:
+            if slot is not None and second < slot.second:
+                # older than anything the ring still holds: write it on its own
+                slot = _Slot(second, now - self.timeout)
+            else:
+                # the second that used this position falls out of the ring;
+                # anything it still owes is in _pending and gets written
+                slot = ring[second % self.window] = _Slot(second, now)
+
+        if kind == "camera":
+            slot.camera_count = count
+            slot.image = image or slot.image
+        else:
+            slot.rfid_count = count
+        self._pending[(office_id, second)] = slot
+
+    def feed_entries(self, entries, now=None):
+        """Feed a batch drained from the ingestion buffer."""
+        for entry in entries:
+            reading = entry.reading
+            time_stamp = datetime.fromisoformat(reading["time_stamp"])
+            if entry.kind == "camera":
+                self.feed("camera", reading["office_id"], time_stamp, reading["camera_count"],
+                          image=reading.get("image"), now=now)
+            else:
+                self.feed("rfid", reading["office_id"], time_stamp, reading["rfid_count"], now=now)
+
+    def ready(self, now=None, everything=False):
+        """Take the slots due for writing as upsert rows."""
+        now = now or time.time()
+        rows = []
+        for key, slot in list(self._pending.items()):
+            # a late side of a row written already goes out straight away
+            due = everything or slot.written or slot.complete() or now - slot.opened >= self.timeout
+            if not due:
+                continue
+            rows.append((
+                key[0], datetime.fromtimestamp(slot.second, dt_timezone.utc),
+                slot.camera_count, slot.rfid_count, slot.image,
+            ))
+            slot.written = True
+            del self._pending[key]
+        return rows
+
+    def flush(self, now=None, everything=False):
+        return upsert_pilgrims(self.ready(now, everything), datetime.now(dt_timezone.utc))
+
+    # ----- restart survival -----
+    def snapshot(self):
+        return [
+            [office_id, slot.second, slot.camera_count, slot.image, slot.rfid_count, slot.opened]
+            for (office_id, _), slot in self._pending.items()
+        ]
+
+    def restore(self, data):
+        for office_id, second, camera_count, image, rfid_count, opened in data:
+            time_stamp = datetime.fromtimestamp(second, dt_timezone.utc)
+            if camera_count is not None:
+                self.feed("camera", office_id, time_stamp, camera_count, image=image, now=opened)
+            if rfid_count is not None:
+                self.feed("rfid", office_id, time_stamp, rfid_count, now=opened)
+
+    def __len__(self):
+        return len(self._pending)
+
+
+def _snapshot_key(consumer):
+    return f"pilgrims:join:{consumer}"
+
+
+_joiners = {}
+
+
+def joining():
+    return settings.PILGRIMS_JOIN_MODE == "stream" and settings.PILGRIMS_INGESTION_MODE == "buffered"
+
+
+def get_joiner(consumer):
+    """The joiner of a consumer, restored from its Redis snapshot on first use."""
+    joiner = _joiners.get(consumer)
+    if joiner is None:
+        joiner = _joiners[consumer] = StreamJoiner()
+        try:
+            data = get_redis().get(_snapshot_key(consumer))
+        except redis.RedisError:
+            data = None
+        if data:
+            joiner.restore(json.loads(data))
+    return joiner
+
+
+def snapshot_images():
+    """Frame names held by the slots of every consumer's snapshot."""
+    client = get_redis()
+    for key in client.scan_iter(match=_snapshot_key("*"), count=100):
+        data = client.get(key)
+        for _, _, _, image, _, _ in json.loads(data) if data else []:
+            if image:
+                yield image
+
+
+def save_snapshot(consumer, joiner):
+    """
+    Persist the slots not written yet. Called before a batch is acknowledged,
+    so a crash replays the batch or finds its readings here.
+    """
+    get_redis().set(_snapshot_key(consumer), json.dumps(joiner.snapshot()))
@@ -1,153 +1,311 @@
+from billiard.process import current_process
 from celery import shared_task
+from collections import defaultdict
 from datetime import timedelta
+from django.conf import settings
 from django.utils import timezone
-from django.db import transaction
+from django.db import connection, transaction
+from django.db.models import Q
+from django.db.models.functions import Mod
 import pytz
-import os
+import socket
+import time
 
-from .models import CameraCounter, RFIDCounter, Pilgrim
+from office.models import Office
+from .models import CameraCounter, RFIDCounter, Pilgrim, MergeWatermark
+from .buckets import DELTA_RETURNING, apply_deltas, lock_offices, row_deltas
+from .ingestion_buffer import drain
+from .matching import write_matched
+from .media_gc import collect_garbage
+from .partitions import maintain_partitions
+from .rollups import compact_history
+from .rate_limit import flush_coalesced
 
 saudi_tz = pytz.timezone("Asia/Riyadh")
 
 
 # ------------------------------------------------------
-# FIRST STAGE — ALWAYS CREATE ROW
+# SET-BASED MERGE — ONE STATEMENT FOR ALL OFFICES
 # ------------------------------------------------------
-def _merge_for_timestamp(target_ts):
+# For every (office, second) in [start, end) take the latest camera and the
+# latest RFID reading (highest id, as before) and upsert the Pilgrim row.
+# An existing row only gets its missing counts filled in; complete rows are
+# left untouched. The rows written come back for their bucket deltas.
+MERGE_SQL = """
+INSERT INTO {pilgrim} (created_at, updated_at, office_id, time_stamp,
+                       camera_count, rfid_count, illegal_pilgrims, image, match_offset)
+SELECT %(now)s, %(now)s,
+       COALESCE(c.office_id, r.office_id),
+       COALESCE(c.second, r.second),
+       c.camera_count,
+       r.rfid_count,
+       CASE WHEN c.camera_count - r.rfid_count > 0 THEN c.camera_count - r.rfid_count ELSE 0 END,
+       CASE WHEN c.camera_count - r.rfid_count > 0 THEN NULLIF(c.image, '') END,
+       CASE WHEN c.camera_count IS NOT NULL AND r.rfid_count IS NOT NULL THEN 0 END
+FROM (
+    SELECT DISTINCT ON (office_id, date_trunc('second', time_stamp))
+           office_id, date_trunc('second', time_stamp) AS second, camera_count, image
+    FROM {camera}
+    WHERE time_stamp >= %(start)s AND time_stamp < %(end)s
+      AND (%(offices)s::bigint[] IS NULL OR office_id = ANY(%(offices)s))
+    ORDER BY office_id, date_trunc('second', time_stamp), id DESC
+) c
+FULL OUTER JOIN (
+    SELECT DISTINCT ON (office_id, date_trunc('second', time_stamp))
+           office_id, date_trunc('second', time_stamp) AS second, rfid_count
+    FROM {rfid}
+    WHERE time_stamp >= %(start)s AND time_stamp < %(end)s
+      AND (%(offices)s::bigint[] IS NULL OR office_id = ANY(%(offices)s))
+    ORDER BY office_id, date_trunc('second', time_stamp), id DESC
+) r ON r.office_id = c.office_id AND r.second = c.second
+ON CONFLICT (office_id, time_stamp) DO UPDATE SET
+    updated_at = EXCLUDED.updated_at,
+    camera_count = COALESCE({pilgrim}.camera_count, EXCLUDED.camera_count),
+    rfid_count = COALESCE({pilgrim}.rfid_count, EXCLUDED.rfid_count),
+    illegal_pilgrims = GREATEST(
+        COALESCE(COALESCE({pilgrim}.camera_count, EXCLUDED.camera_count)
+                 - COALESCE({pilgrim}.rfid_count, EXCLUDED.rfid_count), 0), 0),
+    image = CASE
+        WHEN COALESCE({pilgrim}.camera_count, EXCLUDED.camera_count)
+             - COALESCE({pilgrim}.rfid_count, EXCLUDED.rfid_count) > 0
+        THEN COALESCE(NULLIF({pilgrim}.image, ''), EXCLUDED.image)
+    END,
+    match_offset = CASE
+        WHEN COALESCE({pilgrim}.camera_count, EXCLUDED.camera_count) IS NOT NULL
+             AND COALESCE({pilgrim}.rfid_count, EXCLUDED.rfid_count) IS NOT NULL
+        THEN COALESCE({pilgrim}.match_offset, 0)
+    END
+WHERE {pilgrim}.camera_count IS NULL OR {pilgrim}.rfid_count IS NULL
+{returning}""".format(
+    pilgrim=Pilgrim._meta.db_table,
+    camera=CameraCounter._meta.db_table,
+    rfid=RFIDCounter._meta.db_table,
+    returning=DELTA_RETURNING.format(alias=Pilgrim._meta.db_table, pilgrim=Pilgrim._meta.db_table),
+)
+
+
+def merge_window(start, end, office_ids=None):
     """
-    ALWAYS creates a Pilgrim row for the timestamp.
-    No updates, no get_or_create — only create().
+    Merge every office's readings (or those of `office_ids`) with time_stamp
+    in [start, end) into Pilgrim rows. Returns the number of rows inserted or
+    completed.
+
+    With PILGRIMS_MATCH_TOLERANCE_SECONDS > 0 the readings are paired by
+    nearest second within the tolerance instead (see pilgrims.matching).
+    The changes of the rows written are added to their minute/hour/day
+    buckets; call it inside a transaction.
     """
+    tolerance = settings.PILGRIMS_MATCH_TOLERANCE_SECONDS
+    lock_offices(office_ids)
+    if tolerance:
+        return write_matched(start, end, tolerance, timezone.now().astimezone(saudi_tz), office_ids)
 
-    target_ts = target_ts.replace(microsecond=0)
+    with connection.cursor() as cursor:
+        cursor.execute(MERGE_SQL, {
+            "now": timezone.now().astimezone(saudi_tz),
+            "start": start,
+            "end": end,
+            "offices": list(office_ids) if office_ids is not None else None,
+        })
+        returned = cursor.fetchall()
+    apply_deltas(row_deltas(returned))
+    return len(returned)
+
+
+# ------------------------------------------------------
+# SHARDS — OFFICES SPLIT BY office_id, ONE LEASE EACH
+# ------------------------------------------------------
+# With PILGRIMS_MERGE_SHARDS = N the offices are split by office_id % N and
+# beat sends one merge task per shard every second. A task merges its shard
+# only while holding the shard's lease, a session advisory lock: a second task
+# for a shard still being merged (a worker catching up) returns at once, and
+# the lease of a worker that dies goes with its connection, so the next tick
+# hands the shard to whichever worker is free.
+MERGE_LEASE_CLASS = 0x4D52  # "MR", first key of the advisory locks
 
-    camera = (
-        CameraCounter.objects.filter(time_stamp=target_ts)
-        .order_by("-id")
-        .first()
-    )
-    rfid = (
-        RFIDCounter.objects.filter(time_stamp=target_ts)
-        .order_by("-id")
-        .first()
-    )
 
-    # If no camera & no RFID — cannot determine office → skip
-    if not camera and not rfid:
-        return
-
-    # Determine office_id
-    office_id = camera.office_id if camera else rfid.office_id
-
-    camera_count = camera.camera_count if camera else None
-    rfid_count = rfid.rfid_count if rfid else None
-    image = camera.image if (camera and camera.image) else None
-
-    # Compute illegal pilgrims
-    if camera_count is not None and rfid_count is not None:
-        illegal = max(camera_count - rfid_count, 0)
-    else:
-        illegal = 0
-
-    # Always create a new row (never update here)
-    Pilgrim.objects.create(
-        office_id=office_id,
-        time_stamp=target_ts,
-        camera_count=camera_count,
-        rfid_count=rfid_count,
-        illegal_pilgrims=illegal,
-        image=image if illegal > 0 else None,
+def shard_offices(shard, shards):
+    """The office ids of `shard`; None (every office) when there is one shard."""
+    if shards <= 1:
+        return None
+    return list(
+        Office.objects.annotate(shard=Mod("id", shards)).filter(shard=shard).values_list("id", flat=True)
     )
 
 
+def _try_lease(shard):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_try_advisory_lock(%s, %s)", [MERGE_LEASE_CLASS, shard])
+        return cursor.fetchone()[0]
+
+
+def _release_lease(shard):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_unlock(%s, %s)", [MERGE_LEASE_CLASS, shard])
+
+
+def _mark_name(kind, shard, shards):
+    # a single shard keeps the watermarks of the unsharded merge
+    return kind if shards <= 1 else f"{kind}:{shard}/{shards}"
+
+
+def _mark_names(kind, shards):
+    return [_mark_name(kind, shard, shards) for shard in range(max(shards, 1))]
+
+
+def _stale_marks(kind, shards):
+    """The `kind` watermarks of shard counts other than `shards`."""
+    return MergeWatermark.objects.filter(
+        Q(name=kind) | Q(name__startswith=f"{kind}:"),
+    ).exclude(name__in=_mark_names(kind, shards))
+
+
+def _previous_slowest(kind, shards):
+    """The slowest `kind` watermark of the shard count last used before `shards`."""
+    counts = defaultdict(list)
+    for name, merged_until, updated_at in _stale_marks(kind, shards).values_list("name", "merged_until", "updated_at"):
+        counts[name.rpartition("/")[2] if "/" in name else "1"].append((updated_at, merged_until))
+    if not counts:
+        return None
+    previous = max(counts.values(), key=lambda marks: max(updated_at for updated_at, _ in marks))
+    return min(merged_until for _, merged_until in previous)
+
+
 # ------------------------------------------------------
-# SECOND STAGE — UPDATE ONLY, NEVER CREATE
+# WATERMARKS — MERGE EVERY SECOND EXACTLY ONCE (PLUS ONE RE-CHECK)
 # ------------------------------------------------------
-def _check_for_timestamp(target_ts):
+def _advance(kind, shard, shards, until, deadline, start=None, office_ids=None):
     """
-    Only update existing Pilgrim row.
-    Never create a new row here — if missing, just ignore.
+    Merge every second from the watermark of `kind` for `shard` up to `until`
+    in chunks of PILGRIMS_MERGE_CHUNK_SECONDS, moving the watermark after each
+    chunk, until caught up or past `deadline`. A run that finds the watermark
+    locked by another worker returns straight away.
     """
+    name = _mark_name(kind, shard, shards)
+    chunk = timedelta(seconds=settings.PILGRIMS_MERGE_CHUNK_SECONDS)
+    if not MergeWatermark.objects.filter(name=name).exists():
+        # a new watermark (first run, or the shard count changed) starts where
+        # the slowest watermark of the previous shard count is: re-merging is
+        # harmless, skipping seconds is not
+        slowest = _previous_slowest(kind, shards)
+        MergeWatermark.objects.get_or_create(name=name, defaults={"merged_until": slowest or start or until})
+        # once every shard has its own, the previous shard count's marks are
+        # spent; left behind they would seed the next change from the past
+        current = _mark_names(kind, shards)
+        if MergeWatermark.objects.filter(name__in=current).count() == len(current):
+            _stale_marks(kind, shards).delete()
 
-    target_ts = target_ts.replace(microsecond=0)
+    rows = 0
+    while time.monotonic() < deadline:
+        with transaction.atomic():
+            mark = MergeWatermark.objects.select_for_update(skip_locked=True).filter(name=name).first()
+            if mark is None or mark.merged_until >= until:
+                break
+            end = min(mark.merged_until + chunk, until)
+            rows += merge_window(mark.merged_until, end, office_ids)
+            mark.merged_until = end
+            mark.save(update_fields=["merged_until", "updated_at"])
+    return rows
 
-    # Fetch existing row
-    pilgrim = Pilgrim.objects.filter(time_stamp=target_ts).first()
-    if not pilgrim:
-        return  # Do NOT create anything here — merge only happens in first stage
 
-    # Fetch latest camera & RFID rows
-    camera = (
-        CameraCounter.objects.filter(time_stamp=target_ts)
-        .order_by("-id")
-        .first()
-    )
-    rfid = (
-        RFIDCounter.objects.filter(time_stamp=target_ts)
-        .order_by("-id")
-        .first()
-    )
+# ------------------------------------------------------
+# MAIN CELERY BEAT TASK — RUNS EVERY SECOND (PER SHARD)
+# ------------------------------------------------------
+@shared_task
+def merge_pilgrims_every_second(max_seconds=0.9, shard=0, recheck_only=False):
+    """
+    For the offices of `shard`:
 
-    updated = False
+    1. "merge": every second up to NOW - PILGRIMS_MERGE_GRACE_SECONDS gets its
+       Pilgrim rows, resuming from the watermark after any outage.
+    2. "recheck": the same seconds are merged once more when they are
+       PILGRIMS_MERGE_RECHECK_SECONDS old, picking up late readings.
 
-    # ------------------------
-    # FILL missing values only
-    # ------------------------
-    if pilgrim.camera_count is None and camera:
-        pilgrim.camera_count = camera.camera_count
-        updated = True
+    With `recheck_only` (the stream joiner writes the rows, see
+    main/settings.py) only the second pass runs, pairing within
+    PILGRIMS_MATCH_TOLERANCE_SECONDS what the joiner paired by equal second.
+    """
+    shards = settings.PILGRIMS_MERGE_SHARDS
+    if not _try_lease(shard):
+        return 0, 0
 
-    if pilgrim.rfid_count is None and rfid:
-        pilgrim.rfid_count = rfid.rfid_count
-        updated = True
+    try:
+        now = timezone.now().astimezone(saudi_tz).replace(microsecond=0)
+        deadline = time.monotonic() + max_seconds
+        merge_until = now - timedelta(seconds=settings.PILGRIMS_MERGE_GRACE_SECONDS)
+        recheck_until = now - timedelta(seconds=settings.PILGRIMS_MERGE_RECHECK_SECONDS)
+        office_ids = shard_offices(shard, shards)
+        if recheck_only:
+            return 0, _advance("recheck", shard, shards, recheck_until, deadline, office_ids=office_ids)
 
-    # Recalc illegal
-    if pilgrim.camera_count is not None and pilgrim.rfid_count is not None:
-        pilgrim.illegal_pilgrims = max(
-            pilgrim.camera_count - pilgrim.rfid_count, 0
+        # a fresh install starts with the seconds still inside the re-check horizon
+        merged = _advance("merge", shard, shards, merge_until, deadline, start=recheck_until, office_ids=office_ids)
+        # never re-check seconds the first pass has not reached yet (catch-up)
+        merged_until = MergeWatermark.objects.get(name=_mark_name("merge", shard, shards)).merged_until
+        rechecked = _advance(
+            "recheck", shard, shards, min(recheck_until, merged_until), deadline, office_ids=office_ids,
         )
-    else:
-        pilgrim.illegal_pilgrims = 0
-
-    # Update image logic
-    if pilgrim.illegal_pilgrims > 0:
-        if camera and camera.image:
-            pilgrim.image = camera.image
-    else:
-        # remove image when illegal = 0
-        if pilgrim.image:
-            try:
-                if hasattr(pilgrim.image, "path") and os.path.exists(pilgrim.image.path):
-                    os.remove(pilgrim.image.path)
-            except:
-                pass
-            pilgrim.image = None
-
-    if updated:
-        pilgrim.save()
+        return merged, rechecked
+    finally:
+        _release_lease(shard)
 
 
 # ------------------------------------------------------
-# MAIN CELERY BEAT TASK — RUNS EVERY SECOND
+# WRITE-BEHIND INGESTION BUFFER
 # ------------------------------------------------------
 @shared_task
-def merge_pilgrims_every_second():
+def drain_ingestion_buffer(max_seconds=1.0):
     """
-    Runs every second:
-    1. Create row for NOW - 5 seconds
-    2. Update row for NOW - 5 minutes
-    3. Update row for NOW - 10 minutes
+    Drain the ingestion buffer batch by batch until it is empty or
+    `max_seconds` have passed (the beat interval), whichever comes first.
     """
+    # stable across worker restarts, so the stream joiner finds its snapshot
+    # (pool processes keep their index when they are replaced)
+    consumer = f"celery-{socket.gethostname()}-{getattr(current_process(), 'index', 0)}"
+    deadline = time.monotonic() + max_seconds
+    written = 0
+
+    while time.monotonic() < deadline:
+        count = drain(consumer)
+        written += count
+        if not count:
+            break
+
+    return written
+
+
+# ------------------------------------------------------
+# RATE-LIMITED DEVICES — STORE COALESCED READINGS
+# ------------------------------------------------------
+@shared_task
+def flush_coalesced_readings():
+    """Store the latest reading per device per second kept back by the "coalesce" policy."""
+    return flush_coalesced()
+
+
+# ------------------------------------------------------
+# DAILY PARTITIONS — CREATE AHEAD, EXPIRE OLD
+# ------------------------------------------------------
+@shared_task
+def manage_partitions():
+    """Create the coming days' partitions and expire those past retention."""
+    created, expired = maintain_partitions()
+    return len(created), len(expired)
 
-    now_saudi = timezone.now().astimezone(saudi_tz).replace(microsecond=0)
 
-    ts_5s = now_saudi - timedelta(seconds=5)
-    ts_5m = now_saudi - timedelta(minutes=5)
-    ts_10m = now_saudi - timedelta(minutes=10)
+# ------------------------------------------------------
+# AGED HISTORY — ROLL UP PER MINUTE, DELETE RAW ROWS
+# ------------------------------------------------------
+@shared_task
+def compact_counter_history(max_seconds=50.0):
+    """Roll up and delete counter history older than PILGRIMS_ROLLUP_AFTER_DAYS."""
+    return compact_history(max_seconds)
 
-    # First stage: ALWAYS create row
-    _merge_for_timestamp(ts_5s)
 
-    # Second stage: ONLY update row
-    _check_for_timestamp(ts_5m)
-    _check_for_timestamp(ts_10m)
+# ------------------------------------------------------
+# MEDIA GC — UNREFERENCED FRAMES, OFF THE MERGE PATH
+# ------------------------------------------------------
+@shared_task
+def collect_media_garbage():
+    """Delete frame files no row points at any more; returns the report."""
+    return collect_garbage()
@@ -1,3 +1,1153 @@
-from django.test import TestCase
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+import asyncio
+import hashlib
+import importlib.util
+import json
+import os
+import posixpath
+import tempfile
+import time
+from unittest import mock
+import zlib
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+import fakeredis
+import redis
+from django.conf import settings
+from django.db import OperationalError, connection, connections
+from django.db.models import Sum
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from authentication.models import Company, MyUser
+from office.models import Office
+from pilgrims.device_registry import camera_registry
+from pilgrims.buckets import _branch, pilgrim_totals, plan_range, refresh_buckets
+from pilgrims.dashboard_cache import cached_payload
+from pilgrims import dashboard_events
+from pilgrims.dashboard_events import DashboardHub, company_channel, get_hub, offices_changed
+from pilgrims.ingestion import (
+    _audit_now, store_camera_batch, store_rfid_batch, update_live_tags, upsert_live_tags, write_buffered_entries,
+)
+from pilgrims.ingestion_buffer import LocalBuffer, drain
+from pilgrims.matching import match
+from pilgrims.media_gc import collect_garbage
+from pilgrims.models import (
+    RFID, Camera, CameraCounter, CounterRollup, LiveRFIDTag, MergeWatermark, Pilgrim, PilgrimBucket, RFIDCounter,
+)
+from pilgrims.partitions import create_partition
+from pilgrims.rate_limit import camera_limiter, coalesce, flush_coalesced, rfid_limiter
+from pilgrims import rfid_listener
+from pilgrims.management.commands.rebuild_pilgrims import _rebuild_shard
+from pilgrims.management.commands.simulate_rfid_reader import _tcp_reader
+from pilgrims.rollups import compact_history
+from pilgrims.stream_join import StreamJoiner, upsert_pilgrims
+from pilgrims.rfid_frames import BodyTooLarge, FrameError, decode_frames, encode_frame, encode_frames
+from pilgrims.tasks import (
+    MERGE_LEASE_CLASS, MERGE_SQL, _advance, _release_lease, _try_lease, merge_pilgrims_every_second, merge_window,
+    saudi_tz, shard_offices,
+)
+
+
+def create_pilgrims(rows):
+    """Pilgrim rows from dicts of their fields, stamped as the ingestion stamps them."""
+    now = _audit_now()
+    return Pilgrim.objects.bulk_create(Pilgrim(**fields, created_at=now, updated_at=now) for fields in rows)
+
+
+class IndexUsageTests(TestCase):
+    """
+    The query shapes of the merge task and the dashboard/frame views must be
+    able to use the indexes of migration 0009. Sequential scans are switched
+    off so the planner shows which index it would use on a table too small to
+    bother with one.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        now = _audit_now()
+        offices = [Office.objects.create(name=f"tent {i}", longitude="0", latitude="0") for i in range(10)]
+        cls.office = offices[0]
+        cls.start = datetime(2025, 6, 1, 7, 0, tzinfo=dt_timezone.utc)
+        # appended second by second, all offices at once, as the devices do
+        seconds = [cls.start + timedelta(seconds=i) for i in range(600)]
+        CameraCounter.objects.bulk_create(
+            CameraCounter(office=office, sn=f"C{office.id}", camera_count=3, time_stamp=second,
+                          created_at=now, updated_at=now)
+            for second in seconds for office in offices
+        )
+        RFIDCounter.objects.bulk_create(
+            RFIDCounter(office=office, sn=f"R{office.id}", rfid_count=2, tags=[], time_stamp=second,
+                        created_at=now, updated_at=now)
+            for second in seconds for office in offices
+        )
+        create_pilgrims(
+            dict(office=office, time_stamp=second, camera_count=3, rfid_count=2, illegal_pilgrims=i % 2)
+            for i, second in enumerate(seconds) for office in offices
+        )
+
+    def setUp(self):
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE pilgrims_cameracounter, pilgrims_rfidcounter, pilgrims_pilgrim")
+            cursor.execute("SET LOCAL enable_seqscan = off")
+
+    def _explain(self, sql, params):
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN " + sql, params)
+            return "\n".join(row[0] for row in cursor.fetchall())
+
+    def assertUsesIndex(self, index, plan, scan="Scan"):
+        # the tables are partitioned by day: plans name the partitions' copies
+        # of an index
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = %s::regclass",
+                [index],
+            )
+            names = [row[0] for row in cursor.fetchall()]
+        self.assertTrue(
+            any(f"{scan} using {name} " in plan or f"{scan} on {name} " in plan for name in names),
+            f"{index} not used:\n{plan}",
+        )
+
+    def test_merge_window_uses_time_stamp_index(self):
+        plan = self._explain(MERGE_SQL, {
+            "now": self.start, "start": self.start, "end": self.start + timedelta(seconds=1), "offices": None,
+        })
+        self.assertUsesIndex("cameracounter_ts_office_idx", plan)
+        self.assertUsesIndex("rfidcounter_ts_office_idx", plan)
+        self.assertIn("Conflict Arbiter Indexes: pilgrim_office_ts_uniq", plan)
+
+    def test_office_range_uses_office_index(self):
+        plan = self._explain(MERGE_SQL, {
+            "now": self.start, "start": self.start, "end": self.start + timedelta(days=1), "offices": [self.office.id],
+        })
+        self.assertUsesIndex("cameracounter_office_ts_idx", plan)
+        self.assertUsesIndex("rfidcounter_office_ts_idx", plan)
+
+    def test_long_range_uses_brin_index(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL enable_indexscan = off")
+        plan = CameraCounter.objects.filter(
+            time_stamp__gte=self.start, time_stamp__lt=self.start + timedelta(days=10),
+        ).values("office").annotate(total=Sum("camera_count")).explain()
+        self.assertUsesIndex("cameracounter_ts_brin", plan)
+
+    def test_totals_edges_use_office_index(self):
+        # the seconds pilgrim_totals() reads from Pilgrim at the edges of a
+        # range; whether the scan is index-only depends on the visibility map
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL enable_bitmapscan = off")
+        params = [[self.office.id]]
+        sql = _branch(None, self.start, self.start + timedelta(seconds=30), params)
+        self.assertUsesIndex("pilgrim_office_ts_uniq", self._explain(sql, params))
+
+    def test_frame_views_use_partial_index(self):
+        frames = Pilgrim.objects.filter(
+            office__id=self.office.id, illegal_pilgrims__gt=0, image__isnull=False,
+        ).order_by("-time_stamp")[:30]
+        self.assertUsesIndex("pilgrim_illegal_office_ts_idx", frames.explain())
+
+        illegal = Pilgrim.objects.filter(
+            illegal_pilgrims__gt=0, office_id__in=[self.office.id],
+            time_stamp__range=(self.start, self.start + timedelta(minutes=5)),
+        ).order_by("-time_stamp")
+        self.assertUsesIndex("pilgrim_illegal_office_ts_idx", illegal.explain())
+
+
+class PartitionTests(TestCase):
+    def test_partition_takes_rows_from_default_and_prunes(self):
+        office = Office.objects.create(name="tent", longitude="0", latitude="0")
+        time_stamp = datetime(2025, 6, 1, 7, 0, tzinfo=dt_timezone.utc)
+        create_pilgrims([dict(office=office, time_stamp=time_stamp, camera_count=3, rfid_count=2)])
+
+        name = create_partition(Pilgrim._meta.db_table, date(2025, 6, 1))
+
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT count(*) FROM {name}")
+            self.assertEqual(cursor.fetchone()[0], 1)
+        plan = Pilgrim.objects.filter(
+            office=office, time_stamp__gte=time_stamp, time_stamp__lt=time_stamp + timedelta(hours=1),
+        ).explain()
+        self.assertIn(name, plan)
+        self.assertNotIn("pilgrims_pilgrim_default", plan)
+
+
+class BucketTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.office = Office.objects.create(name="tent", longitude="0", latitude="0")
+        # 23:00 Riyadh, so the rows span two Riyadh days
+        cls.start = datetime(2025, 6, 1, 20, 0, tzinfo=dt_timezone.utc)
+        cls.end = cls.start + timedelta(hours=26)
+        create_pilgrims(
+            dict(office=cls.office, time_stamp=cls.start + timedelta(seconds=second), camera_count=second % 5,
+                 rfid_count=2, illegal_pilgrims=max(second % 5 - 2, 0))
+            for second in range(0, 26 * 3600, 7)
+        )
+        refresh_buckets(cls.start, cls.end, [cls.office.id])
+
+    def test_plan_uses_coarsest_whole_buckets(self):
+        start = datetime(2025, 6, 1, 20, 59, 30, tzinfo=dt_timezone.utc)
+        end = datetime(2025, 6, 2, 22, 1, 10, tzinfo=dt_timezone.utc)
+        self.assertEqual(
+            [(granularity, low.astimezone(dt_timezone.utc), high.astimezone(dt_timezone.utc))
+             for granularity, low, high in plan_range(start, end)],
+            [
+                (None, start, datetime(2025, 6, 1, 21, 0, tzinfo=dt_timezone.utc)),
+                ("day", datetime(2025, 6, 1, 21, 0, tzinfo=dt_timezone.utc),
+                 datetime(2025, 6, 2, 21, 0, tzinfo=dt_timezone.utc)),
+                ("hour", datetime(2025, 6, 2, 21, 0, tzinfo=dt_timezone.utc),
+                 datetime(2025, 6, 2, 22, 0, tzinfo=dt_timezone.utc)),
+                ("minute", datetime(2025, 6, 2, 22, 0, tzinfo=dt_timezone.utc),
+                 datetime(2025, 6, 2, 22, 1, tzinfo=dt_timezone.utc)),
+                (None, datetime(2025, 6, 2, 22, 1, tzinfo=dt_timezone.utc), end),
+            ],
+        )
+
+    def test_totals_match_pilgrim_rows(self):
+        for start, end in (
+            (None, None),
+            (self.start + timedelta(seconds=13), self.end - timedelta(minutes=7, seconds=3)),
+            (self.start + timedelta(hours=1, minutes=2), self.start + timedelta(hours=3, seconds=59)),
+            (self.start + timedelta(seconds=5), self.start + timedelta(seconds=50)),
+        ):
+            rows = Pilgrim.objects.filter(office=self.office)
+            if start is not None:
+                rows = rows.filter(time_stamp__gte=start, time_stamp__lte=end)
+            expected = rows.aggregate(
+                camera_count=Sum("camera_count"), rfid_count=Sum("rfid_count"),
+                illegal_pilgrims=Sum("illegal_pilgrims"),
+            )
+            self.assertEqual(pilgrim_totals([self.office.id], start, end)[self.office.id], expected)
+
+    def test_refresh_drops_deleted_rows(self):
+        minute = self.start + timedelta(hours=5)
+        Pilgrim.objects.filter(time_stamp__gte=minute, time_stamp__lt=minute + timedelta(minutes=1)).delete()
+        refresh_buckets(minute, minute + timedelta(minutes=1), [self.office.id])
+        self.assertFalse(PilgrimBucket.objects.filter(granularity="minute", bucket=minute).exists())
+        self.assertEqual(
+            PilgrimBucket.objects.get(granularity="day", bucket=datetime(2025, 6, 1, 21, 0, tzinfo=dt_timezone.utc))
+            .camera_count,
+            Pilgrim.objects.filter(time_stamp__gte=datetime(2025, 6, 1, 21, 0, tzinfo=dt_timezone.utc),
+                                   time_stamp__lt=datetime(2025, 6, 2, 21, 0, tzinfo=dt_timezone.utc))
+            .aggregate(total=Sum("camera_count"))["total"],
+        )
+
+
+class MergeTests(TestCase):
+    def setUp(self):
+        self.paired, self.camera_only, self.rfid_only = [
+            Office.objects.create(name=f"tent {i}", longitude="0", latitude="0") for i in range(3)
+        ]
+        self.start = datetime(2025, 6, 1, 7, 0, tzinfo=dt_timezone.utc)
+
+    def _reading(self, kind, office, count, seconds=0.0):
+        now = _audit_now()
+        time_stamp = self.start + timedelta(seconds=seconds)
+        if kind == "camera":
+            CameraCounter.objects.create(office=office, sn=f"CAM-{office.id}", camera_count=count, image="frame.jpg",
+                                         time_stamp=time_stamp, created_at=now, updated_at=now)
+        else:
+            RFIDCounter.objects.create(office=office, sn=f"RFID-{office.id}", rfid_count=count, tags=[],
+                                       time_stamp=time_stamp, created_at=now, updated_at=now)
+
+    def _rows(self):
+        return {
+            pilgrim.office_id: (pilgrim.camera_count, pilgrim.rfid_count, pilgrim.illegal_pilgrims,
+                                pilgrim.match_offset, pilgrim.image or None)
+            for pilgrim in Pilgrim.objects.all()
+        }
+
+    def test_one_statement_merges_every_office(self):
+        self._reading("camera", self.paired, 2, 0.2)
+        # the latest reading of a second wins
+        self._reading("camera", self.paired, 5, 0.7)
+        self._reading("rfid", self.paired, 3, 0.5)
+        self._reading("camera", self.camera_only, 4)
+        self._reading("rfid", self.rfid_only, 6)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(merge_window(self.start, self.start + timedelta(seconds=1)), 3)
+        self.assertEqual(sum("INSERT INTO pilgrims_pilgrim (" in query["sql"] for query in queries), 1)
+        self.assertEqual(self._rows(), {
+            self.paired.id: (5, 3, 2, 0, "frame.jpg"),
+            self.camera_only.id: (4, None, 0, None, None),
+            self.rfid_only.id: (None, 6, 0, None, None),
+        })
+
+    def test_late_side_fills_in_the_row_and_complete_rows_stay(self):
+        self._reading("camera", self.paired, 5)
+        self._reading("rfid", self.paired, 3)
+        self._reading("camera", self.camera_only, 4)
+        merge_window(self.start, self.start + timedelta(seconds=1))
+        complete = Pilgrim.objects.get(office=self.paired).updated_at
+
+        self._reading("rfid", self.camera_only, 1)
+        # a later reading of a complete row's second does not rewrite it
+        self._reading("camera", self.paired, 9, 0.5)
+        self.assertEqual(merge_window(self.start, self.start + timedelta(seconds=1)), 1)
+        self.assertEqual(self._rows(), {
+            self.paired.id: (5, 3, 2, 0, "frame.jpg"),
+            self.camera_only.id: (4, 1, 3, 0, "frame.jpg"),
+        })
+        self.assertEqual(Pilgrim.objects.get(office=self.paired).updated_at, complete)
+
+
+class BucketDeltaTests(TestCase):
+    def setUp(self):
+        self.office = Office.objects.create(name="tent", longitude="0", latitude="0")
+        self.start = datetime(2025, 6, 1, 7, 0, tzinfo=dt_timezone.utc)
+
+    def _reading(self, kind, seconds, count):
+        now = _audit_now()
+        time_stamp = self.start + timedelta(seconds=seconds)
+        if kind == "camera":
+            CameraCounter.objects.create(office=self.office, sn="CAM-1", camera_count=count, time_stamp=time_stamp,
+                                         created_at=now, updated_at=now)
+        else:
+            RFIDCounter.objects.create(office=self.office, sn="RFID-1", rfid_count=count, tags=[],
+                                       time_stamp=time_stamp, created_at=now, updated_at=now)
+
+    def _buckets(self):
+        return {
+            bucket.granularity: (bucket.camera_count, bucket.rfid_count, bucket.illegal_pilgrims)
+            for bucket in PilgrimBucket.objects.filter(office=self.office)
+        }
+
+    def _recounted(self):
+        totals = Pilgrim.objects.filter(office=self.office).aggregate(
+            camera_count=Sum("camera_count"), rfid_count=Sum("rfid_count"), illegal_pilgrims=Sum("illegal_pilgrims"),
+        )
+        counts = tuple(totals[name] or 0 for name in ("camera_count", "rfid_count", "illegal_pilgrims"))
+        return {granularity: counts for granularity in ("minute", "hour", "day")}
+
+    def test_merge_adds_what_it_wrote(self):
+        end = self.start + timedelta(minutes=1)
+        self._reading("camera", 10, 5)
+        self.assertEqual(merge_window(self.start, end), 1)
+        self.assertEqual(self._buckets(), self._recounted())
+
+        # a row the merge did not write stays out of the buckets: nothing is recounted
+        create_pilgrims([dict(office=self.office, time_stamp=self.start + timedelta(seconds=30), camera_count=7,
+                              rfid_count=7, illegal_pilgrims=0)])
+        # the missing half of the first row only adds its own delta
+        self._reading("rfid", 10, 3)
+        self.assertEqual(merge_window(self.start, end), 1)
+        self.assertEqual(self._buckets(), {granularity: (5, 3, 2) for granularity in ("minute", "hour", "day")})
+
+        # the re-check pass finds complete rows and adds nothing
+        self.assertEqual(merge_window(self.start, end), 0)
+        self.assertEqual(self._buckets(), {granularity: (5, 3, 2) for granularity in ("minute", "hour", "day")})
+
+    @override_settings(PILGRIMS_MATCH_TOLERANCE_SECONDS=1)
+    def test_matched_merge_takes_absorbed_rows_out(self):
+        self._reading("rfid", 10, 3)
+        merge_window(self.start, self.start + timedelta(seconds=11))
+        self.assertEqual(self._buckets(), self._recounted())
+        # the camera reading a second later takes the RFID reading from its own row
+        self._reading("camera", 11, 4)
+        merge_window(self.start, self.start + timedelta(minutes=1))
+        self.assertEqual(Pilgrim.objects.filter(office=self.office).count(), 1)
+        self.assertEqual(self._buckets(), self._recounted())
+
+    @override_settings(PILGRIMS_MATCH_TOLERANCE_SECONDS=1)
+    def test_reading_paired_again_leaves_its_old_row(self):
+        self._reading("camera", 10, 4)
+        self._reading("rfid", 11, 3)
+        merge_window(self.start, self.start + timedelta(minutes=1))
+        # a late camera reading takes the RFID reading at its own second
+        self._reading("camera", 11, 5)
+        merge_window(self.start, self.start + timedelta(minutes=1))
+        self.assertEqual(
+            list(Pilgrim.objects.order_by("time_stamp").values_list(
+                "camera_count", "rfid_count", "illegal_pilgrims", "match_offset")),
+            [(4, None, 0, None), (5, 3, 2, 0)],
+        )
+        self.assertEqual(self._buckets(), self._recounted())
+
+    def test_joiner_adds_late_sides(self):
+        joiner = StreamJoiner(window=60, timeout=0)
+        joiner.feed("camera", self.office.id, self.start, 4)
+        self.assertEqual(joiner.flush(), 1)
+        joiner.feed("rfid", self.office.id, self.start, 6)
+        joiner.feed("camera", self.office.id, self.start + timedelta(seconds=1), 2)
+        self.assertEqual(joiner.flush(), 2)
+        self.assertEqual(self._buckets(), self._recounted())
+        self.assertEqual(self._buckets()["day"][:2], (6, 6))
+
+
+@override_settings(PILGRIMS_ROLLUP_AFTER_DAYS=1, PILGRIMS_ROLLUP_CHUNK_MINUTES=24 * 60)
+class RollupTests(TransactionTestCase):
+    def setUp(self):
+        now = _audit_now()
+        self.office = Office.objects.create(name="tent", longitude="0", latitude="0")
+        self.start = (timezone.now() - timedelta(days=3)).replace(second=0, microsecond=0)
+        CameraCounter.objects.bulk_create(
+            CameraCounter(office=self.office, sn="CAM-1", camera_count=3, time_stamp=self.start + timedelta(seconds=i),
+                          created_at=now, updated_at=now)
+            for i in range(2)
+        )
+        create_pilgrims(
+            dict(office=self.office, time_stamp=self.start + timedelta(seconds=i), camera_count=3, rfid_count=3 - i,
+                 illegal_pilgrims=i, image="frame.jpg" if i else None)
+            for i in range(2)
+        )
+        compact_history(max_seconds=30)
+
+    def test_rolled_up_rows_are_deleted_and_late_ones_kept(self):
+        self.assertEqual(CounterRollup.objects.get(office=self.office).camera_readings, 2)
+        self.assertFalse(CameraCounter.objects.exists())
+        self.assertEqual(list(Pilgrim.objects.values_list("illegal_pilgrims", flat=True)), [1])
+
+        # a reading arriving behind the watermark is not deleted unrolled
+        now = _audit_now()
+        CameraCounter.objects.create(office=self.office, sn="CAM-1", camera_count=4, time_stamp=self.start,
+                                     created_at=now, updated_at=now)
+        compact_history(max_seconds=30)
+        self.assertEqual(CameraCounter.objects.count(), 1)
+
+    def test_rebuild_keeps_rolled_up_pilgrim_rows(self):
+        _rebuild_shard(self.start.astimezone(saudi_tz).date(), [self.office.id])
+        self.assertEqual(list(Pilgrim.objects.values_list("illegal_pilgrims", flat=True)), [1])
+
+
+class MergeShardTests(TestCase):
+    def setUp(self):
+        self.start = datetime(2025, 6, 1, 7, 0, tzinfo=dt_timezone.utc)
+
+    def _seed(self, shard, shards):
+        # a deadline already passed: the watermark is created, nothing merged
+        _advance("merge", shard, shards, self.start, time.monotonic())
+        return MergeWatermark.objects.get(name=f"merge:{shard}/{shards}" if shards > 1 else "merge").merged_until
+
+    def test_offices_split_by_id(self):
+        offices = [Office.objects.create(name=f"tent {i}", longitude="0", latitude="0").id for i in range(4)]
+        self.assertIsNone(shard_offices(0, 1))
+        split = [shard_offices(shard, 2) for shard in range(2)]
+        self.assertEqual(sorted(split[0] + split[1]), offices)
+        self.assertTrue(all(office_id % 2 == shard for shard in range(2) for office_id in split[shard]))
+
+    def test_new_shard_count_seeds_from_the_previous_one_only(self):
+        # left over from a shard count used a month ago
+        MergeWatermark.objects.create(name="merge:0/3", merged_until=self.start - timedelta(days=30))
+        MergeWatermark.objects.filter(name="merge:0/3").update(updated_at=self.start - timedelta(days=30))
+        MergeWatermark.objects.create(name="merge", merged_until=self.start - timedelta(hours=1))
+
+        # 1 -> 2 shards: both start where the single shard was, and once both
+        # have a mark the others go
+        self.assertEqual(self._seed(0, 2), self.start - timedelta(hours=1))
+        self.assertTrue(MergeWatermark.objects.filter(name="merge").exists())
+        MergeWatermark.objects.filter(name="merge:0/2").update(merged_until=self.start - timedelta(minutes=5))
+        self.assertEqual(self._seed(1, 2), self.start - timedelta(hours=1))
+        MergeWatermark.objects.filter(name="merge:1/2").update(merged_until=self.start - timedelta(minutes=2))
+        self.assertEqual(sorted(MergeWatermark.objects.values_list("name", flat=True)), ["merge:0/2", "merge:1/2"])
+
+        # back to 1 shard: not the old plain mark, but where the shards are
+        self.assertEqual(self._seed(0, 1), self.start - timedelta(minutes=5))
+        self.assertEqual(list(MergeWatermark.objects.values_list("name", flat=True)), ["merge"])
+
+    def test_shard_held_by_another_worker_is_skipped(self):
+        other = connections.create_connection("default")
+        try:
+            with other.cursor() as cursor:
+                cursor.execute("SELECT pg_try_advisory_lock(%s, %s)", [MERGE_LEASE_CLASS, 1])
+                with mock.patch("pilgrims.tasks._advance") as advance:
+                    self.assertEqual(merge_pilgrims_every_second(shard=1), (0, 0))
+                advance.assert_not_called()
+                # handed over once the other worker lets go
+                cursor.execute("SELECT pg_advisory_unlock(%s, %s)", [MERGE_LEASE_CLASS, 1])
+        finally:
+            other.close()
+        self.assertTrue(_try_lease(1))
+        _release_lease(1)
+
+
+class WatermarkTests(TestCase):
+    def setUp(self):
+        self.office = Office.objects.create(name="tent", longitude="0", latitude="0")
+        self.now = datetime(2025, 6, 1, 7, 0, tzinfo=dt_timezone.utc)
+        patcher = mock.patch("pilgrims.tasks.timezone.now", return_value=self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _camera(self, ago):
+        now = _audit_now()
+        CameraCounter.objects.create(office=self.office, sn="CAM-1", camera_count=3, time_stamp=self.now - ago,
+                                     created_at=now, updated_at=now)
+
+    def _marks(self, merge, recheck):
+        MergeWatermark.objects.create(name="merge", merged_until=self.now - merge)
+        MergeWatermark.objects.create(name="recheck", merged_until=self.now - recheck)
+
+    def _merged_until(self):
+        return {mark.name: self.now - mark.merged_until for mark in MergeWatermark.objects.all()}
+
+    def test_merge_catches_up_after_a_gap(self):
+        # an hour down: twelve chunks, in one run with time to spare
+        self._marks(timedelta(hours=1), timedelta(hours=1))
+        for ago in (timedelta(minutes=50), timedelta(seconds=20)):
+            self._camera(ago)
+        self.assertEqual(merge_pilgrims_every_second(max_seconds=30), (2, 1))
+        self.assertEqual(Pilgrim.objects.count(), 2)
+        self.assertEqual(self._merged_until(), {"merge": timedelta(seconds=5), "recheck": timedelta(minutes=10)})
+
+    def test_recheck_picks_up_readings_behind_the_merge(self):
+        self._marks(timedelta(seconds=5), timedelta(minutes=11))
+        # arrived after its second was merged
+        self._camera(timedelta(minutes=10, seconds=30))
+        self.assertEqual(merge_pilgrims_every_second(max_seconds=30), (0, 1))
+        self.assertEqual(Pilgrim.objects.get().time_stamp, self.now - timedelta(minutes=10, seconds=30))
+        self.assertEqual(self._merged_until(), {"merge": timedelta(seconds=5), "recheck": timedelta(minutes=10)})
+
+
+    @override_settings(PILGRIMS_MATCH_TOLERANCE_SECONDS=1)
+    def test_recheck_only_pairs_the_joiners_rows_within_the_tolerance(self):
+        MergeWatermark.objects.create(name="recheck", merged_until=self.now - timedelta(minutes=11))
+        second = self.now - timedelta(minutes=10, seconds=30)
+        self._camera(timedelta(minutes=10, seconds=30))
+        now = _audit_now()
+        RFIDCounter.objects.create(office=self.office, sn="RFID-1", rfid_count=1, tags=[],
+                                   time_stamp=second + timedelta(seconds=1), created_at=now, updated_at=now)
+        # as the stream joiner wrote them: one side each
+        upsert_pilgrims([(self.office.id, second, 3, None, None),
+                         (self.office.id, second + timedelta(seconds=1), None, 1, None)], now)
+
+        merge_pilgrims_every_second(max_seconds=30, recheck_only=True)
+        self.assertEqual(list(Pilgrim.objects.values_list("time_stamp", "camera_count", "rfid_count", "match_offset")),
+                         [(second, 3, 1, 1)])
+        self.assertEqual(self._merged_until(), {"recheck": timedelta(minutes=10)})
+
+
+class MergeScheduleTests(SimpleTestCase):
+    """The merge beat entries main/settings.py sets up for the join mode."""
+
+    def _merge_entries(self, **env):
+        path = os.path.join(settings.BASE_DIR, "main", "settings.py")
+        spec = importlib.util.spec_from_file_location("settings_under_test", path)
+        module = importlib.util.module_from_spec(spec)
+        with mock.patch.dict(os.environ, env):
+            spec.loader.exec_module(module)
+        return {name: entry["kwargs"] for name, entry in module.CELERY_BEAT_SCHEDULE.items()
+                if entry["task"] == "pilgrims.tasks.merge_pilgrims_every_second"}
+
+    def test_stream_join_keeps_a_recheck_merge_for_the_tolerance(self):
+        stream = {"PILGRIMS_JOIN_MODE": "stream", "PILGRIMS_INGESTION_MODE": "buffered"}
+        self.assertEqual(self._merge_entries(PILGRIMS_MATCH_TOLERANCE_SECONDS="0", **stream), {})
+        self.assertEqual(self._merge_entries(PILGRIMS_MATCH_TOLERANCE_SECONDS="2", **stream),
+                         {"merge-pilgrims-every-second": {"recheck_only": True}})
+        self.assertEqual(
+            self._merge_entries(PILGRIMS_MATCH_TOLERANCE_SECONDS="2", PILGRIMS_MERGE_SHARDS="2", **stream),
+            {f"merge-pilgrims-every-second-{shard}": {"recheck_only": True, "shard": shard} for shard in range(2)},
+        )
+        self.assertEqual(self._merge_entries(PILGRIMS_JOIN_MODE="merge", PILGRIMS_MATCH_TOLERANCE_SECONDS="2"),
+                         {"merge-pilgrims-every-second": {}})
+
+
+class WatermarkLockTests(TransactionTestCase):
+    def test_locked_watermark_is_left_where_it_was(self):
+        start = datetime(2025, 6, 1, 7, 0, tzinfo=dt_timezone.utc)
+        MergeWatermark.objects.create(name="merge", merged_until=start)
+        other = connections.create_connection("default")
+        try:
+            with other.cursor() as cursor:
+                cursor.execute("BEGIN")
+                cursor.execute("SELECT 1 FROM pilgrims_mergewatermark WHERE name = 'merge' FOR UPDATE")
+                self.assertEqual(_advance("merge", 0, 1, start + timedelta(minutes=5), time.monotonic() + 5), 0)
+                cursor.execute("ROLLBACK")
+        finally:
+            other.close()
+        self.assertEqual(MergeWatermark.objects.get(name="merge").merged_until, start)
+
+
+class MatchTests(SimpleTestCase):
+    def test_pairs_within_the_tolerance_only(self):
+        cameras, rfids = [(10, 5, "a.jpg")], [(12, 3)]
+        self.assertEqual(list(match(cameras, rfids, 1)), [(10, 5, "a.jpg", None, None), (12, None, None, 3, None)])
+        self.assertEqual(list(match(cameras, rfids, 2)), [(10, 5, "a.jpg", 3, 2)])
+        self.assertEqual(list(match(cameras, rfids, 0)), [(10, 5, "a.jpg", None, None), (12, None, None, 3, None)])
+
+    def test_tie_goes_to_the_earlier_reading(self):
+        self.assertEqual(list(match([(10, 5, None)], [(9, 3), (11, 4)], 1)),
+                         [(10, 5, None, 3, -1), (11, None, None, 4, None)])
+
+    def test_exact_pair_is_not_taken_by_a_neighbour(self):
+        # camera 10 is closest to RFID 11 too, but 11 pairs with its own second
+        self.assertEqual(list(match([(10, 5, None), (11, 6, None)], [(11, 4)], 1)),
+                         [(10, 5, None, None, None), (11, 6, None, 4, 0)])
+
+    def test_each_rfid_reading_pairs_once(self):
+        # greedy in camera order: the earlier camera reading takes RFID 11
+        self.assertEqual(list(match([(10, 5, None), (12, 6, None)], [(11, 4)], 1)),
+                         [(10, 5, None, 4, 1), (12, 6, None, None, None)])
+
+
+@override_settings(PILGRIMS_RATE_LIMITS={
+    "camera": {"rate": 1, "burst": 1, "policy": "coalesce"},
+    "rfid": {"rate": 1, "burst": 1, "policy": "reject"},
+})
+class AsyncIngestionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.office = Office.objects.create(name="tent", longitude="0", latitude="0")
+        Camera.objects.create(sn="ASYNC-CAM", office=cls.office)
+        RFID.objects.create(sn="ASYNC-RFID", office=cls.office)
+
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        media_root = override_settings(MEDIA_ROOT=media.name)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        self.redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+        patcher = mock.patch("pilgrims.rate_limit.get_async_redis", return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for limiter in (camera_limiter, rfid_limiter):
+            self.addCleanup(limiter._buckets.clear)
+
+    def _camera(self, **fields):
+        return dict({"camera_sn": "ASYNC-CAM", "camera_count": 4, "time_stamp": "2025-06-01T10:00:00+03:00"}, **fields)
+
+    def _rfid(self):
+        return {"rfid_sn": "ASYNC-RFID", "rfid_count": 1, "time_stamp": "2025-06-01T10:00:00+03:00", "tags": ["E-1"]}
+
+    async def test_camera_reading_is_stored_with_its_frame(self):
+        response = await self.async_client.post(
+            "/pilgrims/async/camera-counter/", self._camera(image=SimpleUploadedFile("frame.jpg", b"jpeg bytes")),
+        )
+        self.assertEqual(response.status_code, 201)
+        stored = await CameraCounter.objects.aget()
+        self.assertEqual((stored.id, stored.camera_count), (json.loads(response.content)["id"], 4))
+        with stored.image.open("rb") as frame:
+            self.assertEqual(frame.read(), b"jpeg bytes")
+
+    async def test_camera_reading_over_the_limit_is_coalesced(self):
+        responses = [
+            await self.async_client.post("/pilgrims/async/camera-counter/", self._camera(camera_count=count),
+                                         content_type="application/json")
+            for count in (4, 5)
+        ]
+        self.assertEqual([response.status_code for response in responses], [201, 202])
+        self.assertTrue(json.loads(responses[1].content)["coalesced"])
+        self.assertEqual(await CameraCounter.objects.acount(), 1)
+        pending, = (await self.redis.hgetall("pilgrims:coalesce:camera")).values()
+        self.assertEqual(json.loads(pending)["camera_count"], 5)
+
+    async def test_rfid_reading_is_stored_with_its_tags(self):
+        response = await self.async_client.post("/pilgrims/async/rfid-counter/", self._rfid(),
+                                                content_type="application/json")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual((await RFIDCounter.objects.aget()).id, json.loads(response.content)["id"])
+        tag = await LiveRFIDTag.objects.aget()
+        self.assertEqual((tag.epc_code, tag.office_id, tag.sn), ("E-1", self.office.id, "ASYNC-RFID"))
+
+    async def test_rfid_reading_over_the_limit_is_rejected(self):
+        for _ in range(2):
+            response = await self.async_client.post("/pilgrims/async/rfid-counter/", self._rfid(),
+                                                    content_type="application/json")
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "1")
+        self.assertEqual(await RFIDCounter.objects.acount(), 1)
+
+
+@override_settings(PILGRIMS_RATE_LIMITS={}, PILGRIMS_MAX_FRAME_BYTES=1024)
+class FrameUploadTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        office = Office.objects.create(name="tent", longitude="0", latitude="0")
+        Camera.objects.create(sn="UPLOAD-CAM", office=office)
+
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.media = media.name
+        media_root = override_settings(MEDIA_ROOT=media.name)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+
+    def _post(self, frame, seq):
+        return self.client.post("/pilgrims/camera-counter/", {
+            "camera_sn": "UPLOAD-CAM", "camera_count": 4, "time_stamp": "2025-06-01T10:00:00+03:00", "seq": seq,
+            "image": SimpleUploadedFile("frame.JPG", frame),
+        })
+
+    def _files(self):
+        return sorted(os.path.relpath(os.path.join(folder, name), self.media)
+                      for folder, _, names in os.walk(self.media) for name in names)
+
+    def test_frame_is_stored_under_its_hash(self):
+        frame = os.urandom(900)
+        self.assertEqual(self._post(frame, 1).status_code, 201)
+        stored = CameraCounter.objects.get()
+        self.assertEqual(posixpath.basename(stored.image.name), hashlib.sha256(frame).hexdigest() + ".jpg")
+        with stored.image.open("rb") as saved:
+            self.assertEqual(saved.read(), frame)
+        # the same frame again reuses the file
+        self.assertEqual(self._post(frame, 2).status_code, 201)
+        self.assertEqual(self._files(), [stored.image.name])
+
+    def test_oversize_frame_is_rejected_and_its_part_file_removed(self):
+        self.assertEqual(self._post(os.urandom(4096), 1).status_code, 413)
+        self.assertFalse(CameraCounter.objects.exists())
+        self.assertEqual(self._files(), [])
+
+
+class LiveTagTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.offices = [Office.objects.create(name=f"tent {i}", longitude="0", latitude="0") for i in range(2)]
+        cls.seen = datetime(2025, 6, 1, 7, 0, tzinfo=dt_timezone.utc)
+
+    def _tags(self):
+        return {tag.epc_code: (tag.office_id, tag.sn, tag.last_seen) for tag in LiveRFIDTag.objects.all()}
+
+    def test_new_and_known_tags_in_one_statement(self):
+        first, second = self.offices
+        upsert_live_tags([("E-2", first.id, "R-1", self.seen)])
+        later = self.seen + timedelta(seconds=5)
+        with CaptureQueriesContext(connection) as queries:
+            upsert_live_tags([
+                ("E-3", second.id, "R-2", later),
+                ("E-2", second.id, "R-2", later),
+                # the same tag twice: the last sighting wins
+                ("E-1", first.id, "R-1", self.seen),
+                ("E-1", second.id, "R-2", later),
+                ("", first.id, "R-1", later),
+            ])
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(self._tags(), {
+            "E-1": (second.id, "R-2", later),
+            "E-2": (second.id, "R-2", later),
+            "E-3": (second.id, "R-2", later),
+        })
+
+    def test_rows_go_in_epc_order(self):
+        # concurrent upserts lock the unique index entries in the same order
+        with CaptureQueriesContext(connection) as queries:
+            update_live_tags(self.offices[0].id, "R-1", ["E-3", "E-1", "E-2"], self.seen)
+        sql = queries[0]["sql"]
+        self.assertLess(sql.index("'E-1'"), sql.index("'E-2'"))
+        self.assertLess(sql.index("'E-2'"), sql.index("'E-3'"))
+
+
+class BatchIngestionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        office = Office.objects.create(name="tent", longitude="0", latitude="0")
+        Camera.objects.create(sn="CAM-1", office=office)
+        RFID.objects.create(sn="RFID-1", office=office)
+
+    def test_values_the_columns_cannot_hold_reject_only_their_item(self):
+        time_stamp = "2025-06-01T10:00:00"
+        results = store_camera_batch([
+            {"camera_sn": "CAM-1", "camera_count": 4, "time_stamp": time_stamp},
+            {"camera_sn": "CAM-1", "camera_count": 2 ** 31, "time_stamp": time_stamp},
+            {"camera_sn": "C" * 256, "camera_count": 4, "time_stamp": time_stamp},
+        ])
+        self.assertEqual([result["status"] for result in results], [201, 400, 400])
+
+        results = store_rfid_batch([
+            {"rfid_sn": "RFID-1", "rfid_count": 1, "time_stamp": time_stamp, "tags": ["E" * 24]},
+            {"rfid_sn": "RFID-1", "rfid_count": 1, "time_stamp": time_stamp, "tags": ["E" * 256]},
+        ])
+        self.assertEqual([result["status"] for result in results], [201, 400])
+        self.assertEqual(CameraCounter.objects.count() + RFIDCounter.objects.count(), 2)
+
+    def test_keyed_readings_report_their_row_id(self):
+        reading = {"camera_sn": "CAM-1", "camera_count": 4, "time_stamp": "2025-06-01T10:00:00", "reading_id": "r-1"}
+        first, = store_camera_batch([reading])
+        # a retry the Redis seen-keys did not catch is answered with the stored row
+        retry, = store_camera_batch([reading])
+        self.assertIsNotNone(first["id"])
+        self.assertEqual(retry["id"], first["id"])
+        self.assertEqual(CameraCounter.objects.get().id, first["id"])
+
+
+class DeviceRegistryTests(TestCase):
+    def test_unknown_serial_is_found_once_created(self):
+        office = Office.objects.create(name="tent", longitude="0", latitude="0")
+        self.assertIsNone(camera_registry.resolve("CAM-NEW"))
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            camera = Camera.objects.create(sn="CAM-NEW", office=office)
+            # invalidated once the save commits, not before
+            self.assertIsNone(camera_registry.resolve("CAM-NEW"))
+        self.assertTrue(callbacks)
+        self.assertEqual(camera_registry.resolve("CAM-NEW"), (camera.id, office.id))
+
+    @override_settings(DEVICE_REGISTRY_LOCAL_MAX=10)
+    def test_unknown_serials_do_not_grow_the_local_cache(self):
+        camera_registry.resolve_many([f"BOGUS-{i}" for i in range(50)])
+        self.assertLessEqual(len(camera_registry._local), 10)
+
+
+class IngestionBufferTests(TestCase):
+    def test_rejected_entry_is_dead_lettered_and_the_rest_written(self):
+        office = Office.objects.create(name="tent", longitude="0", latitude="0")
+        buffer = LocalBuffer()
+        time_stamp = datetime(2025, 6, 1, 7, 0, tzinfo=dt_timezone.utc)
+        buffer.push_many("camera", [
+            {"sn": sn, "camera_count": count, "time_stamp": time_stamp.isoformat(), "office_id": office.id,
+             "received_at": time_stamp.isoformat(), "image": None}
+            # a value the column cannot hold, queued before it was validated
+            for sn, count in (("CAM-1", 3), ("CAM-2", 2 ** 31))
+        ])
+
+        self.assertEqual(drain("test", max_lag_ms=50, buffer=buffer), 2)
+        self.assertEqual(list(CameraCounter.objects.values_list("sn", flat=True)), ["CAM-1"])
+        self.assertEqual([entry.reading["sn"] for entry, _ in buffer.dead], ["CAM-2"])
+        # nothing left pending to be delivered again
+        buffer.requeue_pending()
+        self.assertEqual(drain("test", max_lag_ms=50, buffer=buffer), 0)
+
+    def _reading(self, **fields):
+        time_stamp = datetime(2025, 6, 1, 7, 0, tzinfo=dt_timezone.utc).isoformat()
+        return dict({"sn": "CAM-1", "camera_count": 3, "time_stamp": time_stamp, "office_id": self.office.id,
+                     "received_at": time_stamp, "image": None}, **fields)
+
+    def test_malformed_entry_is_dead_lettered(self):
+        self.office = Office.objects.create(name="tent", longitude="0", latitude="0")
+        buffer = LocalBuffer()
+        buffer.push_many("camera", [self._reading(), self._reading(sn="CAM-2", camera_count="3"),
+                                    self._reading(sn="CAM-3", time_stamp="yesterday")])
+        self.assertEqual(drain("test", max_lag_ms=50, buffer=buffer), 3)
+        self.assertEqual(list(CameraCounter.objects.values_list("sn", flat=True)), ["CAM-1"])
+        self.assertEqual([error for _, error in buffer.dead], [
+            "MalformedEntry: camera_count is missing or not int",
+            "MalformedEntry: time_stamp is not an ISO date",
+        ])
+
+    def test_writer_bug_fails_the_consumer(self):
+        self.office = Office.objects.create(name="tent", longitude="0", latitude="0")
+        buffer = LocalBuffer()
+        buffer.push_many("camera", [self._reading()])
+        with mock.patch("pilgrims.ingestion.write_buffered_entries", side_effect=TypeError("bug")):
+            with self.assertRaises(TypeError):
+                drain("test", max_lag_ms=50, buffer=buffer)
+        self.assertEqual(buffer.dead, [])
+        # still pending, delivered again once the writer is fixed
+        buffer.requeue_pending()
+        self.assertEqual(drain("test", max_lag_ms=50, buffer=buffer), 1)
+        self.assertEqual(CameraCounter.objects.count(), 1)
+
+
+class CoalesceTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.office = Office.objects.create(name="tent", longitude="0", latitude="0")
+
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis(decode_responses=True)
+        patcher = mock.patch("pilgrims.rate_limit.get_redis", return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _coalesce(self, count, sn="CAM-1"):
+        reading = {"sn": sn, "camera_count": count, "office_id": self.office.id,
+                   "time_stamp": datetime(2025, 6, 1, 7, 0, tzinfo=dt_timezone.utc)}
+        self.assertEqual(coalesce("camera", reading), "coalesced")
+
+    def test_rejected_reading_is_dead_lettered_and_the_rest_written(self):
+        self._coalesce(3)
+        # a value the column cannot hold
+        self._coalesce(2 ** 31, sn="CAM-2")
+        self.assertEqual(flush_coalesced(), 1)
+        self.assertEqual(list(CameraCounter.objects.values_list("sn", flat=True)), ["CAM-1"])
+        (_, dead), = self.redis.xrange("pilgrims:coalesce:dead")
+        self.assertEqual(json.loads(dead["reading"])["sn"], "CAM-2")
+        self.assertTrue(dead["error"].startswith("DataError"))
+        # neither holds up the next flush
+        self.assertEqual(self.redis.hlen("pilgrims:coalesce:camera"), 0)
+        self.assertEqual(flush_coalesced(), 0)
+
+    def test_failed_write_leaves_the_readings_pending(self):
+        self._coalesce(3)
+        with mock.patch("pilgrims.ingestion.write_buffered_entries", side_effect=OperationalError):
+            with self.assertRaises(OperationalError):
+                flush_coalesced()
+        self.assertEqual(self.redis.hlen("pilgrims:coalesce:camera"), 1)
+
+        self.assertEqual(flush_coalesced(), 1)
+        self.assertEqual(CameraCounter.objects.get().camera_count, 3)
+        self.assertEqual(self.redis.hlen("pilgrims:coalesce:camera"), 0)
+
+    def test_reading_coalesced_during_the_write_stays_pending(self):
+        self._coalesce(3)
+
+        def write_and_coalesce(entries):
+            write_buffered_entries(entries)
+            self._coalesce(4)
+
+        with mock.patch("pilgrims.ingestion.write_buffered_entries", side_effect=write_and_coalesce):
+            self.assertEqual(flush_coalesced(), 1)
+        message, = self.redis.hvals("pilgrims:coalesce:camera")
+        self.assertEqual(json.loads(message)["camera_count"], 4)
+
+    @override_settings(PILGRIMS_INGESTION_MODE="buffered", PILGRIMS_JOIN_MODE="stream")
+    def test_stream_joiner_pairs_coalesced_readings(self):
+        buffer = LocalBuffer()
+        self._coalesce(3)
+        with mock.patch("pilgrims.rate_limit.get_buffer", return_value=buffer):
+            self.assertEqual(flush_coalesced(), 1)
+        time_stamp = datetime(2025, 6, 1, 7, 0, tzinfo=dt_timezone.utc).isoformat()
+        buffer.push_many("rfid", [{"sn": "RFID-1", "rfid_count": 1, "tags": [], "office_id": self.office.id,
+                                   "time_stamp": time_stamp, "received_at": time_stamp}])
+
+        with mock.patch("pilgrims.stream_join.get_redis", return_value=self.redis), \
+                mock.patch.dict("pilgrims.stream_join._joiners"):
+            self.assertEqual(drain("test", max_lag_ms=50, buffer=buffer), 2)
+        pilgrim = Pilgrim.objects.get(office=self.office)
+        self.assertEqual((pilgrim.camera_count, pilgrim.rfid_count, pilgrim.illegal_pilgrims), (3, 1, 2))
+
+    def test_only_admins_reset_the_shed_counters(self):
+        company = Company.objects.create(name="company")
+        client = APIClient()
+        for is_admin, status in ((False, 403), (True, 204)):
+            client.force_authenticate(MyUser.objects.create(
+                email=f"user{is_admin}@example.com", username=f"user{is_admin}", company=company, is_admin=is_admin))
+            self.assertEqual(client.delete("/pilgrims/ingestion/shed/").status_code, status)
+
+
+@override_settings(PILGRIMS_DASHBOARD_CACHE_TTL=30, PILGRIMS_DASHBOARD_CACHE_WAIT_MS=100)
+class DashboardCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.companies = [Company.objects.create(name=f"company {i}") for i in range(2)]
+        cls.offices = [Office.objects.create(company=company, name="tent", longitude="0", latitude="0")
+                       for company in cls.companies]
+
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis(decode_responses=True)
+        for target in ("pilgrims.dashboard_cache.get_redis", "pilgrims.dashboard_events.get_redis"):
+            patcher = mock.patch(target, return_value=self.redis)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _get(self, company, compute):
+        return cached_payload(company.id, f"scope:{company.id}", compute)
+
+    def test_payload_is_kept_until_its_company_changes(self):
+        first, second = mock.Mock(return_value={"n": 1}), mock.Mock(return_value={"n": 2})
+        for _ in range(2):
+            self.assertEqual(self._get(self.companies[0], first), {"n": 1})
+            self.assertEqual(self._get(self.companies[1], second), {"n": 2})
+        self.assertEqual((first.call_count, second.call_count), (1, 1))
+
+        # a write to the second company's tent leaves the first one cached
+        offices_changed([self.offices[1].id])
+        self._get(self.companies[0], first)
+        self._get(self.companies[1], second)
+        self.assertEqual((first.call_count, second.call_count), (1, 2))
+
+    def test_waits_for_the_request_computing_it(self):
+        company = self.companies[0]
+        self.redis.set(f"scope:{company.id}:lock:0", "other request")
+
+        def other_request_done(_):
+            self.redis.set(f"scope:{company.id}", json.dumps({"version": "0", "payload": {"n": 3}}))
+
+        compute = mock.Mock(return_value={"n": 1})
+        with mock.patch("pilgrims.dashboard_cache.time.sleep", side_effect=other_request_done):
+            self.assertEqual(self._get(company, compute), {"n": 3})
+        compute.assert_not_called()
+
+    def test_only_its_own_lock_is_released(self):
+        company = self.companies[0]
+        lock = f"scope:{company.id}:lock:0"
+        self._get(company, lambda: {"n": 1})
+        self.assertIsNone(self.redis.get(lock))
+
+        def slow_compute():
+            # the lock expired meanwhile and another request took it
+            self.redis.set(lock, "other request")
+            return {"n": 1}
+
+        offices_changed([self.offices[0].id])
+        lock = f"scope:{company.id}:lock:1"
+        self._get(company, slow_compute)
+        self.assertEqual(self.redis.get(lock), "other request")
+
+
+class DashboardHubTests(SimpleTestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+        self.channel = company_channel(1)
+
+    def _pubsubs(self, *pubsubs):
+        patcher = mock.patch("pilgrims.dashboard_events.get_async_pubsub", side_effect=pubsubs)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_failed_subscribe_is_subscribed_again_by_the_next_stream(self):
+        broken = self.redis.pubsub()
+        broken.subscribe = mock.AsyncMock(side_effect=redis.ConnectionError)
+        self._pubsubs(broken, self.redis.pubsub())
+        hub = DashboardHub()
+        with self.assertRaises(redis.ConnectionError):
+            await hub.subscribe(self.channel, 10)
+        self.assertEqual(dict(hub._queues), {})
+
+        queue = await hub.subscribe(self.channel, 10)
+        await self.redis.publish(self.channel, json.dumps([{"tent_id": 1}]))
+        self.assertEqual(await asyncio.wait_for(queue.get(), 3), [{"tent_id": 1}])
+        reader = hub._reader
+        await hub.unsubscribe(self.channel, queue)
+        await asyncio.wait_for(reader, 3)
+
+    async def test_hub_is_dropped_once_its_reader_stops(self):
+        self._pubsubs(self.redis.pubsub())
+        hub = get_hub()
+        queue = await hub.subscribe(self.channel, 10)
+        reader = hub._reader
+        self.assertIs(get_hub(), hub)
+        await hub.unsubscribe(self.channel, queue)
+        await asyncio.wait_for(reader, 3)
+        self.assertNotIn(asyncio.get_running_loop(), dashboard_events._hubs)
+
+
+class MediaGCTests(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        overrides = override_settings(MEDIA_ROOT=media.name, PILGRIMS_INGESTION_MODE="buffered")
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+        self.frames = {}
+        folder = os.path.join(media.name, "counter_image", "2025", "06", "01")
+        os.makedirs(folder)
+        # older than the grace period, as a long buffer backlog would be
+        for name in ("stored", "orphan", "queued", "joining"):
+            path = self.frames[name] = os.path.join(folder, f"{name}.jpg")
+            open(path, "wb").close()
+            os.utime(path, (time.time() - 7200, time.time() - 7200))
+
+        office = Office.objects.create(name="tent", longitude="0", latitude="0")
+        now = _audit_now()
+        CameraCounter.objects.create(office=office, sn="CAM-1", camera_count=3, time_stamp=now,
+                                     image="counter_image/2025/06/01/stored.jpg", created_at=now, updated_at=now)
+        self.buffer = LocalBuffer()
+        self.buffer.push_many("camera", [{"sn": "CAM-1", "camera_count": 3, "office_id": office.id,
+                                          "image": "counter_image/2025/06/01/queued.jpg"}])
+        self.redis = fakeredis.FakeRedis(decode_responses=True)
+        self.redis.set("pilgrims:join:consumer-1", json.dumps(
+            [[office.id, 1748761200, 4, "counter_image/2025/06/01/joining.jpg", None, 0]]))
+        for target, value in (("pilgrims.media_gc.get_buffer", self.buffer),
+                              ("pilgrims.stream_join.get_redis", self.redis)):
+            patcher = mock.patch(target, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_frames_of_readings_not_written_yet_are_kept(self):
+        report = collect_garbage(grace_seconds=3600)
+        self.assertEqual((report["scanned"], report["deleted"]), (4, 1))
+        self.assertEqual([name for name, path in self.frames.items() if os.path.exists(path)],
+                         ["stored", "queued", "joining"])
+
+    def test_nothing_is_deleted_while_redis_is_away(self):
+        with mock.patch.object(self.redis, "scan_iter", side_effect=redis.ConnectionError):
+            self.assertEqual(collect_garbage(grace_seconds=3600)["deleted"], 0)
+        self.assertTrue(all(os.path.exists(path) for path in self.frames.values()))
+
+    def test_queries_do_not_grow_with_the_candidates(self):
+        folder = os.path.dirname(self.frames["orphan"])
+        counts = []
+        for extra in (5, 50):
+            for index in range(extra):
+                path = os.path.join(folder, f"extra-{extra}-{index}.jpg")
+                open(path, "wb").close()
+                os.utime(path, (time.time() - 7200, time.time() - 7200))
+            with CaptureQueriesContext(connection) as queries:
+                collect_garbage(grace_seconds=3600, dry_run=True)
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
+
+class RFIDFrameTests(TestCase):
+    time_stamp = datetime(2025, 6, 1, 7, 0, tzinfo=dt_timezone.utc)
+
+    def test_round_trip(self):
+        epcs = ["E2000017221101441890" + "ABCD", "300833B2DDD9014000000000"]
+        for compress in (False, True):
+            body = encode_frames([("R-1", self.time_stamp, epcs), ("R-2", self.time_stamp, [])], compress=compress)
+            self.assertEqual(decode_frames(body, compressed=compress), [
+                {"rfid_sn": "R-1", "rfid_count": 2, "time_stamp": self.time_stamp.isoformat(), "tags": epcs},
+                {"rfid_sn": "R-2", "rfid_count": 0, "time_stamp": self.time_stamp.isoformat(), "tags": []},
+            ])
+
+    def test_truncated_frames_are_rejected(self):
+        body = encode_frame("R-1", self.time_stamp, ["300833B2DDD9014000000000"])
+        for cut in (1, 5, len(body) - 1):
+            with self.assertRaises(FrameError):
+                decode_frames(body[:cut])
+        with self.assertRaises(FrameError):
+            decode_frames(zlib.compress(body)[:-4], compressed=True)
+
+    def test_zero_length_epcs_are_rejected(self):
+        with self.assertRaises(FrameError):
+            decode_frames(encode_frame("R-1", self.time_stamp, ["", ""], epc_len=0))
+
+    def test_oversized_bodies_are_rejected(self):
+        # 64 MB of zeros deflate to about 64 KB
+        bomb = zlib.compress(bytes(64 * 1024 * 1024))
+        with self.assertRaises(BodyTooLarge):
+            decode_frames(bomb, compressed=True, max_bytes=1024 * 1024)
+        with self.assertRaises(BodyTooLarge):
+            decode_frames(bytes(2048), max_bytes=1024)
+
+        response = self.client.post("/pilgrims/rfid-counter/binary/", bomb,
+                                    content_type="application/x-rfid-frames", HTTP_CONTENT_ENCODING="deflate")
+        self.assertEqual(response.status_code, 413)
+
+
+class RFIDListenerTests(TransactionTestCase):
+    # the listener stores from a worker thread: it needs committed devices
+
+    def setUp(self):
+        for sn in ("R-1", "R-2"):
+            RFID.objects.create(sn=sn, office=Office.objects.create(name=sn, longitude="0", latitude="0"))
+
+    def tearDown(self):
+        # close the connection the listener's worker thread opened
+        asyncio.run(sync_to_async(connections.close_all)())
+
+    async def _serve(self, send):
+        listener = rfid_listener.RFIDListener(host="127.0.0.1", tcp_port=0, grace=0)
+        await listener.start()
+        await send("127.0.0.1", listener.tcp_port)
+        await asyncio.sleep(0.1)
+        await listener.stop()
+        return listener
+
+    def test_simulated_readers_are_stored(self):
+        options = {"reports": 5, "interval": 0, "tags": 3, "population": 10, "format": "text"}
+
+        async def send(host, port):
+            await asyncio.gather(*(_tcp_reader(host, port, sn, options, []) for sn in ("R-1", "R-2")))
+
+        listener = asyncio.run(self._serve(send))
+        self.assertEqual(listener.aggregator.reports, 10)
+        self.assertEqual(set(RFIDCounter.objects.values_list("sn", flat=True)), {"R-1", "R-2"})
+        self.assertEqual(listener.stored, RFIDCounter.objects.count())
+
+    def test_naive_time_stamps_are_riyadh_time(self):
+        async def send(host, port):
+            _, writer = await asyncio.open_connection(host, port)
+            writer.write(b'{"rfid_sn": "R-1", "tags": ["AA"], "time_stamp": "2025-06-01T10:00:00"}\n')
+            await writer.drain()
+            writer.close()
+
+        asyncio.run(self._serve(send))
+        self.assertEqual(RFIDCounter.objects.get().time_stamp, datetime(2025, 6, 1, 7, 0, tzinfo=dt_timezone.utc))
+
+    def test_failed_flush_is_retried(self):
+        listener = rfid_listener.RFIDListener(grace=0)
+        listener.aggregator.add("R-1", int(datetime(2025, 6, 1, 7, 0, tzinfo=dt_timezone.utc).timestamp()), 2, ["AA"])
+        with mock.patch.object(rfid_listener, "store_rfid_batch", side_effect=OperationalError):
+            self.assertEqual(asyncio.run(listener.flush(everything=True)), 0)
+        self.assertEqual(listener.failed, 0)
+        self.assertEqual(asyncio.run(listener.flush(everything=True)), 1)
+        self.assertEqual(RFIDCounter.objects.get().rfid_count, 2)
@@ -0,0 +1,131 @@
+"""
+Streaming upload handling for camera frames.
+
+Django's default handlers spool an uploaded frame into memory (or a temp
+file), and ImageField then copies it into MEDIA_ROOT. CameraFrameUploadHandler
+writes the "image" part straight into the counter_image/ directory chunk by
+chunk, hashing it on the way, so memory per request stays at one chunk
+whatever the frame size:
+
+- frames over PILGRIMS_MAX_FRAME_BYTES are abandoned mid-stream;
+- frames the request will not keep (unknown device, rate limited, retried
+  reading) are never written, when the form fields precede the image;
+- the stored name is the SHA-256 of the content, so a retried upload of the
+  same frame reuses the file already on disk.
+"""
+import hashlib
+import os
+import posixpath
+import uuid
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, SkipFile, StopFutureHandlers
+
+from .models import CameraCounter
+
+
+class StoredFrame(UploadedFile):
+    """An uploaded frame that already sits in storage under `stored_name`."""
+
+    def __init__(self, stored_name, sha256, content_type, size, charset, content_type_extra=None):
+        super().__init__(None, posixpath.basename(stored_name), content_type, size, charset, content_type_extra)
+        self.stored_name = stored_name
+        self.sha256 = sha256
+
+
+class _PartialFrame:
+    def __init__(self, file_name):
+        field = CameraCounter._meta.get_field("image")
+        self.storage = field.storage
+        self.directory = posixpath.dirname(field.generate_filename(None, file_name))
+        self.extension = os.path.splitext(file_name)[1].lower()
+        # raises NotImplementedError for storages without local paths
+        self.path = self.storage.path(posixpath.join(self.directory, f".{uuid.uuid4().hex}.part"))
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = open(self.path, "xb")
+        self.sha256 = hashlib.sha256()
+
+    def write(self, chunk):
+        self.sha256.update(chunk)
+        self.file.write(chunk)
+
+    def discard(self):
+        self.file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def finish(self):
+        self.file.close()
+        digest = self.sha256.hexdigest()
+        name = posixpath.join(self.directory, digest + self.extension)
+        final_path = self.storage.path(name)
+        if os.path.exists(final_path):
+            # the same frame was stored before (a retry): keep that copy, and
+            # touch it so the media GC does not take it while it is reused
+            os.remove(self.path)
+            os.utime(final_path)
+        else:
+            os.replace(self.path, final_path)
+            if self.storage.file_permissions_mode is not None:
+                os.chmod(final_path, self.storage.file_permissions_mode)
+        return name, digest
+
+
+class CameraFrameUploadHandler(FileUploadHandler):
+    """
+    Handles the "image" file field only; every other part falls through to
+    the default handlers. `wanted(fields)` is asked, with the form fields
+    parsed so far, whether the frame is worth writing at all.
+    """
+
+    def __init__(self, request=None, wanted=None, max_bytes=None):
+        super().__init__(request)
+        self.wanted = wanted
+        self.max_bytes = max_bytes or settings.PILGRIMS_MAX_FRAME_BYTES
+        self.fields = None
+        self.too_large = False
+        self.skipped = False
+        self._frame = None
+
+    def new_file(self, field_name, file_name, content_type, content_length, charset=None, content_type_extra=None):
+        super().new_file(field_name, file_name, content_type, content_length, charset, content_type_extra)
+        self._frame = None
+        if field_name != "image":
+            return
+
+        if content_length and content_length > self.max_bytes:
+            self.too_large = True
+            raise SkipFile()
+        if self.wanted is not None and self.fields is not None and not self.wanted(self.fields):
+            self.skipped = True
+            raise SkipFile()
+
+        try:
+            self._frame = _PartialFrame(file_name)
+        except NotImplementedError:
+            return
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        if self._frame is None:
+            return raw_data
+        if start + len(raw_data) > self.max_bytes:
+            self._frame.discard()
+            self._frame = None
+            self.too_large = True
+            raise SkipFile()
+        self._frame.write(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        if self._frame is None:
+            return None
+        name, digest = self._frame.finish()
+        self._frame = None
+        return StoredFrame(name, digest, self.content_type, file_size, self.charset, self.content_type_extra)
+
+    def upload_interrupted(self):
+        if self._frame is not None:
+            self._frame.discard()
+            self._frame = None
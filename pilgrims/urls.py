@@ -1,8 +1,15 @@
 from django.urls import path, include
-from .views import CameraCounterView, RFIDCounterView, IlligalPilgrimsView, get_pilgrims_statistics_for_tent, PilgrimFramesAPIView, LiveTagStatusAPIView
+from . import async_views
+from .views import CameraCounterView, RFIDCounterView, CameraCounterBatchView, RFIDCounterBatchView, RFIDCounterBinaryView, IngestionShedView, IlligalPilgrimsView, get_pilgrims_statistics_for_tent, PilgrimFramesAPIView, LiveTagStatusAPIView
 urlpatterns = [
     path('camera-counter/', CameraCounterView.as_view()),
     path('rfid-counter/', RFIDCounterView.as_view()),
+    path('camera-counter/batch/', CameraCounterBatchView.as_view()),
+    path('rfid-counter/batch/', RFIDCounterBatchView.as_view()),
+    path('rfid-counter/binary/', RFIDCounterBinaryView.as_view()),
+    path('async/camera-counter/', async_views.camera_counter),
+    path('async/rfid-counter/', async_views.rfid_counter),
+    path('ingestion/shed/', IngestionShedView.as_view()),
     path('live-tags/', LiveTagStatusAPIView.as_view()),
     path('illigal-pilgrims/', IlligalPilgrimsView.as_view()),
     path('illegal-pilgrims/<int:pk>', IlligalPilgrimsView.as_view()),
@@ -8,6 +8,17 @@ from .models import Camera, RFID, CameraCounter, RFIDCounter, Pilgrim, LiveRFIDT
 from rfid_registry.models import RFIDTag
 from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
 from .serializers import PilgrimSerializer
+from .parsers import RFIDFrameParser, CameraFrameParser, FrameTooLarge
+from .ingestion import (
+    ReadingError, parse_camera_reading, parse_rfid_reading, extract_readings,
+    store_camera_batch, store_rfid_batch, update_live_tags, enqueue_readings,
+    build_camera_counter, build_rfid_counter, save_counters,
+)
+from .idempotency import already_seen, mark_seen
+from .rate_limit import camera_limiter, rfid_limiter, coalesce, record_shed, shed_counts, reset_shed_counts
+from .ingestion_buffer import is_buffered
+from .device_registry import camera_registry, rfid_registry
+from .buckets import pilgrim_totals
 from django.utils.dateparse import parse_datetime
 from django.utils import timezone
 from datetime import datetime, timedelta
@@ -15,7 +26,6 @@ from django.db.models import OuterRef, Exists, Subquery, BooleanField, Case, Whe
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.pagination import PageNumberPagination
 from django.http import JsonResponse
-from django.db.models import Sum
 import pytz, os
 
 saudi_tz = pytz.timezone('Asia/Riyadh')
@@ -30,82 +40,217 @@ def normalize_time(ts):
     return obj.replace(microsecond=0)
 
 
+def _stored_payload(message, obj):
+    # rows written with a reading_id (ignore_conflicts) come back without a pk
+    payload = {"message": message, "id": obj.id}
+    if obj.reading_id:
+        payload["reading_id"] = obj.reading_id
+    return payload
+
+
+def _shed_response(kind, decision, reading):
+    # over its device's rate limit: answer according to the device type's policy
+    if decision.policy == "reject":
+        record_shed(kind, reading["sn"], "rejected")
+        response = Response({"error": "Rate limit exceeded", "retry_after": decision.retry_after}, status=429)
+        response["Retry-After"] = str(decision.retry_after)
+        return response
+
+    action = coalesce(kind, reading) if decision.policy == "coalesce" else "dropped"
+    record_shed(kind, reading["sn"], action)
+    return Response({"message": f"Reading {action} (rate limited)", action: True}, status=202)
+
+
+def _duplicate_response(reading):
+    return Response({
+        "message": "Duplicate reading ignored",
+        "reading_id": reading["reading_id"],
+        "duplicate": True,
+    }, status=200)
+
+
 @method_decorator(csrf_exempt, name='dispatch')
 class CameraCounterView(APIView):
-    parser_classes = (MultiPartParser, FormParser, JSONParser)
+    # multipart frames are streamed straight to counter_image/ (see pilgrims/uploads.py)
+    parser_classes = (CameraFrameParser, FormParser, JSONParser)
+
+    def frame_wanted(self, fields):
+        """
+        Called while the body is parsed, when the image part starts. Frames the
+        request is going to discard anyway are not written to storage.
+        """
+        if "camera_sn" not in fields:
+            return True  # image sent before the fields: cannot tell yet
+        try:
+            reading = parse_camera_reading(fields)
+        except ReadingError:
+            return False
 
-    def post(self, request):
-        sn = request.data.get("camera_sn")
-        camera_count = request.data.get("camera_count")
-        time_stamp = request.data.get("time_stamp")
-        image = request.data.get("image")
+        camera = camera_registry.resolve(reading["sn"])
+        if camera is None or camera.office_id is None:
+            return False
+        if not camera_limiter.would_allow(reading["sn"]):
+            return False
+        return not already_seen("camera", [reading])[0]
 
-        if sn in [None, ""] or time_stamp in [None, ""] or camera_count is None:
-            return Response({"error": "Missing fields"}, status=400)
+    def post(self, request):
+        try:
+            image = request.data.get("image")
+        except FrameTooLarge as exc:
+            return Response({"error": str(exc.detail)}, status=exc.status_code)
 
         try:
-            camera = Camera.objects.get(sn=sn)
-            office = camera.office
-        except Camera.DoesNotExist:
+            reading = parse_camera_reading(request.data)
+        except ReadingError as exc:
+            return Response({"error": exc.message}, status=exc.status)
+
+        camera = camera_registry.resolve(reading["sn"])
+        if camera is None:
             return Response({"error": "Invalid Camera SN"}, status=404)
+        if camera.office_id is None:
+            return Response({"error": "Device is not assigned to an office"}, status=400)
+        reading["office_id"] = camera.office_id
 
-        obj = CameraCounter.objects.create(
-            office=office,
-            sn=sn,
-            camera_count=int(camera_count),
-            time_stamp=datetime.fromisoformat(time_stamp),
-            image=image,
-        )
+        decision = camera_limiter.check(reading["sn"])
+        if not decision.allowed:
+            return _shed_response("camera", decision, reading)
 
-        return Response({
-            "message": "Camera data stored",
-            "id": obj.id
-        }, status=201)
+        if already_seen("camera", [reading])[0]:
+            return _duplicate_response(reading)
+
+        if is_buffered():
+            entry_id, = enqueue_readings("camera", [reading], images=[image])
+            mark_seen("camera", [reading])
+            return Response({
+                "message": "Camera data queued",
+                "entry_id": entry_id
+            }, status=202)
+
+        obj, = save_counters(CameraCounter, [build_camera_counter(reading, image=image)])
+        mark_seen("camera", [reading])
+
+        return Response(_stored_payload("Camera data stored", obj), status=201)
 @method_decorator(csrf_exempt, name='dispatch') 
 class RFIDCounterView(APIView): 
     parser_classes = (MultiPartParser, FormParser, JSONParser)        
     def post(self, request):
-        sn = request.data.get("rfid_sn")
-        rfid_count = request.data.get("rfid_count")
-        time_stamp = request.data.get("time_stamp")
-        epcs = request.data.get("tags", [])
-
-        if sn in [None, ""] or time_stamp in [None, ""] or rfid_count is None:
-            return Response({"error": "Missing fields"}, status=400)
-
         try:
-            rfid = RFID.objects.get(sn=sn)
-            office = rfid.office
-        except RFID.DoesNotExist:
+            reading = parse_rfid_reading(request.data)
+        except ReadingError as exc:
+            return Response({"error": exc.message}, status=exc.status)
+
+        rfid = rfid_registry.resolve(reading["sn"])
+        if rfid is None:
             return Response({"error": "Invalid RFID SN"}, status=404)
+        if rfid.office_id is None:
+            return Response({"error": "Device is not assigned to an office"}, status=400)
+        reading["office_id"] = rfid.office_id
+
+        decision = rfid_limiter.check(reading["sn"])
+        if not decision.allowed:
+            return _shed_response("rfid", decision, reading)
 
-        ts = datetime.fromisoformat(time_stamp)
+        if already_seen("rfid", [reading])[0]:
+            return _duplicate_response(reading)
+
+        if is_buffered():
+            entry_id, = enqueue_readings("rfid", [reading])
+            mark_seen("rfid", [reading])
+            return Response({
+                "message": "RFID data queued",
+                "entry_id": entry_id
+            }, status=202)
 
         # ✅ Store history
-        obj = RFIDCounter.objects.create(
-            office=office,
-            sn=sn,
-            rfid_count=int(rfid_count),
-            time_stamp=ts,
-            tags =epcs,
-        )
+        obj, = save_counters(RFIDCounter, [build_rfid_counter(reading)])
 
         # ✅ UPDATE LIVE TABLE HERE (THIS IS WHAT YOU WANT)
-        now = timezone.now()
-
-        for epc in epcs:
-            LiveRFIDTag.objects.update_or_create(
-                epc_code=epc,
-                defaults={
-                    "office": office,
-                    "last_seen": now
-                }
-            )
+        update_live_tags(rfid.office_id, reading["sn"], reading["tags"])
+        mark_seen("rfid", [reading])
+
+        return Response(_stored_payload("RFID data stored", obj), status=201)
 
-        return Response({
-            "message": "RFID data stored",
-            "id": obj.id
-        }, status=201)
+
+def _batch_response(results, label):
+    accepted_status = 202 if is_buffered() else 201
+    accepted = sum(1 for result in results if result["status"] == accepted_status)
+    # retries of readings already stored count as delivered, not as failures
+    duplicates = sum(1 for result in results if result.get("duplicate"))
+    verb = "queued" if is_buffered() else "stored"
+    message = f"{accepted} of {len(results)} {label} readings {verb}"
+    if duplicates:
+        message += f", {duplicates} duplicates ignored"
+    return Response({
+        "message": message,
+        "results": results,
+    }, status=207 if accepted + duplicates < len(results) else accepted_status)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class CameraCounterBatchView(APIView):
+    #POST /pilgrims/camera-counter/batch/
+    #- JSON: {"readings": [{"camera_sn", "camera_count", "time_stamp"}, ...]}
+    #- optional "reading_id" (or integer "seq") per reading makes retries idempotent
+    #- multipart: "readings" holds the JSON array, images as files "image_<index>"
+    parser_classes = (MultiPartParser, FormParser, JSONParser)
+
+    def post(self, request):
+        try:
+            readings = extract_readings(request.data)
+            results = store_camera_batch(readings, files=request.FILES)
+        except ReadingError as exc:
+            return Response({"error": exc.message}, status=exc.status)
+
+        return _batch_response(results, "camera")
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class RFIDCounterBatchView(APIView):
+    #POST /pilgrims/rfid-counter/batch/
+    #- JSON: {"readings": [{"rfid_sn", "rfid_count", "time_stamp", "tags"}, ...]}
+    #- optional "reading_id" (or integer "seq") per reading makes retries idempotent
+    parser_classes = (JSONParser, MultiPartParser, FormParser)
+
+    def post(self, request):
+        try:
+            readings = extract_readings(request.data)
+            results = store_rfid_batch(readings)
+        except ReadingError as exc:
+            return Response({"error": exc.message}, status=exc.status)
+
+        return _batch_response(results, "RFID")
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class RFIDCounterBinaryView(APIView):
+    #POST /pilgrims/rfid-counter/binary/
+    #- Content-Type: application/x-rfid-frames, optionally Content-Encoding: deflate
+    #- body: one or more frames, see pilgrims/rfid_frames.py
+    parser_classes = (RFIDFrameParser,)
+
+    def post(self, request):
+        try:
+            readings = extract_readings(request.data)
+            results = store_rfid_batch(readings)
+        except ReadingError as exc:
+            return Response({"error": exc.message}, status=exc.status)
+
+        return _batch_response(results, "RFID")
+
+
+class IngestionShedView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    #GET /pilgrims/ingestion/shed/ -> readings shed by the per-device rate limits, worst device first
+    #DELETE /pilgrims/ingestion/shed/ -> reset the counters (admins only)
+    def get(self, request):
+        return Response({"devices": shed_counts()}, status=200)
+
+    def delete(self, request):
+        if not request.user.is_admin:
+            return Response({"error": "Only admins can reset the shed counters"}, status=403)
+        reset_shed_counts()
+        return Response(status=204)
 
 
 @api_view(["GET"])
@@ -124,17 +269,11 @@ def get_pilgrims_statistics_for_tent(request, tent_id, date=None):
             hour=0, minute=0, second=0, microsecond=0)
         end_time = filter_date.replace(
             hour=23, minute=59, second=59, microsecond=999999)
-        counter_history = Pilgrim.objects.filter(
-            office=tent_id, time_stamp__range=[start_time, end_time])
-
-        # Sum the total_in and total_out for the specific date range
-        total_camera_count = counter_history.aggregate(Sum('camera_count'))[
-            'camera_count__sum'] or 0
-        total_rfid_count = counter_history.aggregate(Sum('rfid_count'))[
-            'rfid_count__sum'] or 0
-        
-        total_pilgrims_count = counter_history.aggregate(Sum('illegal_pilgrims'))[
-            'illegal_pilgrims__sum'] or 0
+        # day/hour/minute buckets plus the Pilgrim rows at the edges
+        totals = pilgrim_totals([tent_id], start_time, end_time)[tent_id]
+        total_camera_count = totals["camera_count"]
+        total_rfid_count = totals["rfid_count"]
+        total_pilgrims_count = totals["illegal_pilgrims"]
 
         # Append the summed values for the cameras on the specific date
         camera_stats.append({
@@ -146,14 +285,10 @@ def get_pilgrims_statistics_for_tent(request, tent_id, date=None):
         })
     else:
         # If no date is provided, calculate the sums for all available data
-        pilgrims_data = Pilgrim.objects.filter(office=tent_id)
-        total_camera_count = pilgrims_data.aggregate(Sum('camera_count'))[
-            'camera_count__sum'] or 0
-        total_rfid_count = pilgrims_data.aggregate(Sum('rfid_count'))[
-            'rfid_count__sum'] or 0
-        
-        total_pilgrims_count = pilgrims_data.aggregate(Sum('illegal_pilgrims'))[
-            'illegal_pilgrims__sum'] or 0
+        totals = pilgrim_totals([tent_id])[tent_id]
+        total_camera_count = totals["camera_count"]
+        total_rfid_count = totals["rfid_count"]
+        total_pilgrims_count = totals["illegal_pilgrims"]
 
         camera = Camera.objects.filter(office_id=tent_id).first()
         rfid = RFID.objects.filter(office_id=tent_id).first()